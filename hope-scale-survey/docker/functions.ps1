@@ -170,6 +170,8 @@ function UpdateContainerAppJob {
             $UPDATE_ARGS += "$($EnvVar.Key)=`"$($EnvVar.Value)`""
         }
     }
+    # The job caps its phase deadlines by its own replica timeout
+    $UPDATE_ARGS += "REPLICA_TIMEOUT=`"$REPLICA_TIMEOUT`""
 
     # Set az context
     az account set --subscription $AZURE_SUBSCRIPTION_ID
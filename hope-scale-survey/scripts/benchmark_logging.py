@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Benchmark ptmlog throughput under different logging configurations.
+
+Each configuration runs in a child process (ptmlog is configured at import
+time) that logs a sync-like workload: per-appointment debug detail events, info
+events, and procedure runs with a large return value. Output goes to a file,
+as container logs would. Timings include waiting for the background writer to
+finish.
+
+Configurations:
+- before:       PTMLOG_LEVEL=NOTSET, synchronous print writer, no value cap
+- level:        PTMLOG_LEVEL=INFO, synchronous print writer
+- level+queue:  PTMLOG_LEVEL=INFO, background writer (the default)
+- debug+queue:  PTMLOG_LEVEL=DEBUG, background writer
+
+Usage:
+    python scripts/benchmark_logging.py --events 50000
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+SRC_DIR = Path(__file__).resolve().parent.parent / 'src'
+
+CONFIGURATIONS = {
+    'before'     : {'PTMLOG_LEVEL': 'NOTSET', 'PTMLOG_QUEUE': '0', 'PTMLOG_MAX_VALUE_CHARS': '0'},
+    'level'      : {'PTMLOG_LEVEL': 'INFO',   'PTMLOG_QUEUE': '0'},
+    'level+queue': {'PTMLOG_LEVEL': 'INFO',   'PTMLOG_QUEUE': '1'},
+    'debug+queue': {'PTMLOG_LEVEL': 'DEBUG',  'PTMLOG_QUEUE': '1'},
+}
+
+
+def child(events: int, procedures: int) -> None:
+    sys.path.insert(0, str(SRC_DIR))
+    from shared import ptmlog
+
+    @ptmlog.procedure('benchmark_logging')
+    def run(count: int) -> dict:
+        logger = ptmlog.get_logger()
+        for i in range(count):
+            # Four per-row debug events for every info event, as in sync_appointments
+            if i % 5:
+                logger.debug(f'appointment_{i}_details', patient_name=f'PATIENT{i} TEST{i}', provider='BHUC COMMON GROUND', type='CLINICIAN', appointment_status='Seen')
+            else:
+                logger.info('creating appointment in azure table', patient_name=f'PATIENT{i} TEST{i}')
+        return {'rows': [{'row_key': f'{i:032x}', 'status': 'created'} for i in range(2000)]}
+
+    started = time.perf_counter()
+    for _ in range(procedures):
+        run(events // procedures)
+    ptmlog.flush()
+    elapsed = time.perf_counter() - started
+    print(json.dumps({'elapsed': elapsed}), file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark ptmlog logging throughput')
+    parser.add_argument('--events', type=int, default=50_000, help='Events logged per configuration')
+    parser.add_argument('--procedures', type=int, default=10, help='Procedure runs the events are spread over')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.events, args.procedures)
+        return
+
+    print(f'events={args.events} procedures={args.procedures}')
+    with tempfile.TemporaryDirectory() as directory:
+        for name, overrides in CONFIGURATIONS.items():
+            output = Path(directory) / f'{name}.log'
+            env = {**os.environ, 'PTMLOG_CONSOLE': '0', 'PTMLOG_SPANS': '1', **overrides}
+            with open(output, 'w') as stdout:
+                completed = subprocess.run(
+                    [sys.executable, __file__, '--child', '--events', str(args.events), '--procedures', str(args.procedures)],
+                    env=env, stdout=stdout, stderr=subprocess.PIPE, text=True, check=True,
+                )
+            elapsed = json.loads(completed.stderr.strip().splitlines()[-1])['elapsed']
+            size = output.stat().st_size
+            print(f'{name:<12} {elapsed:>7.3f}s  {args.events / elapsed:>10.0f} events/s  {size / 1e6:>7.2f} MB written')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Profile the memory of a backfill sync offline and fail when it grows too much per date.
+
+Runs `backfill.backfill_sync_appointments`, the code `backfill.py` uses, over
+`--chunk-days` chunks, with the Playwright scrape replaced by synthetic
+print-view schedule pages (padded to `--page-kb` to stand in for the rest of
+the SPA markup) and the in-memory storage backend. Memory is profiled as with `backfill.py --profile-memory`:
+tracemalloc and RSS after each date and at each phase boundary.
+
+Exits with status 1 when the mean traced growth per date exceeds
+`--budget-mb-per-date` (or MEMORY_BUDGET_PER_DATE_MB).
+
+Usage:
+    python scripts/benchmark_memory.py --dates 30 --appointments-per-date 40 --page-kb 512 --budget-mb-per-date 2
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+from datetime import date, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+
+STATUSES  = ['Seen', 'Seen', 'Seen', 'Cancelled', 'No show']
+TYPES     = ['CLINICIAN', 'CLINICIAN', 'INTAKE']
+PROVIDERS = ['BHUC COMMON GROUND', 'ES OAKLAND', 'ES MACOMB', 'CNS']
+
+
+def synthetic_schedule_page(target_date: date, appointments: int, page_kb: int, rng: random.Random) -> str:
+    """A print-view schedule page that `parse_schedule_page` accepts."""
+    rows = []
+    for i in range(appointments):
+        dob = date(1960, 1, 1) + timedelta(days=rng.randrange(20_000))
+        hour, minute = divmod(8 * 60 + 15 * i, 60)
+        rows.append(
+            '<tr>'
+            f'<td data-element="td-intake-status">{rng.choice(STATUSES)}</td>'
+            f'<td data-element="td-patient-name">PATIENT{i} {target_date:%b%d}\n{dob:%m/%d/%Y}\n(248) 555-{rng.randrange(10_000):04d}</td>'
+            f'<td data-element="td-start-at">{(hour - 1) % 12 + 1:02d}:{minute:02d} {"AM" if hour < 12 else "PM"}</td>'
+            f'<td data-element="td-provider-name">{rng.choice(PROVIDERS)}</td>'
+            f'<td data-element="td-appointment-type">{rng.choice(TYPES)}</td>'
+            '</tr>'
+        )
+    padding = ''.join(
+        f'<div class="ng-scope row-{i}" data-element="filler">{rng.randrange(10**12):x}</div>'
+        for i in range(page_kb * 1024 // 60)
+    )
+    return (
+        f'<html><body>{padding}'
+        f'<h3>Schedule Standard view - {target_date:%A, %B, %d, %Y}</h3>'
+        f'<table data-element="table-agenda-print"><tr><th>Status</th></tr>{"".join(rows)}</table>'
+        '</body></html>'
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Profile backfill sync memory per date offline')
+    parser.add_argument('--dates', type=int, default=30, help='Dates to backfill')
+    parser.add_argument('--appointments-per-date', type=int, default=40, help='Appointments on each schedule page')
+    parser.add_argument('--page-kb', type=int, default=256, help='Approximate size of each schedule page')
+    parser.add_argument('--chunk-days', type=int, default=7, help='Dates per backfill chunk')
+    parser.add_argument('--budget-mb-per-date', type=float, help='Fail above this mean traced growth per date (MEMORY_BUDGET_PER_DATE_MB)')
+    parser.add_argument('--top', type=int, default=10, help='Allocation sites to report')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='benchmark-memory-')
+    os.environ['STORAGE_BACKEND']     = 'memory'
+    os.environ['MEMORY_PROFILE']      = '1'
+    os.environ['MEMORY_PROFILE_TOP']  = str(args.top)
+    os.environ['KNOWN_ROW_KEYS_PATH'] = os.path.join(work_dir, 'known_row_keys.json')
+    os.environ['BACKFILL_STATE_PATH'] = os.path.join(work_dir, 'backfill_state.json')
+    os.environ['RUN_HISTORY']         = '0'
+    os.environ.setdefault('PTMLOG_CONSOLE', '0')
+    if args.budget_mb_per_date is not None:
+        os.environ['MEMORY_BUDGET_PER_DATE_MB'] = str(args.budget_mb_per_date)
+
+    import backfill
+    import memory_profile
+    import practice_fusion_utils
+    from backfill_plan import BackfillPlan
+
+    rng = random.Random(args.seed)
+
+    async def synthetic_schedule_pages_chunked(chunks, workers, on_chunk, on_failure) -> None:
+        # Stands in for get_schedule_pages_chunked: one page per date, with the same date checkpoints
+        for key, target_dates in chunks.items():
+            schedule_pages = []
+            for target_date in target_dates:
+                schedule_pages.append(synthetic_schedule_page(target_date, args.appointments_per_date, args.page_kb, rng))
+                await asyncio.sleep(0)
+                memory_profile.checkpoint('date', str(target_date))
+            await on_chunk(key, schedule_pages)
+
+    practice_fusion_utils.get_schedule_pages_chunked = synthetic_schedule_pages_chunked
+
+    start = date(2025, 1, 6)
+    plan = BackfillPlan.create(start, start + timedelta(days=args.dates - 1), args.chunk_days)
+    print(f'dates={args.dates} chunk_days={args.chunk_days} appointments_per_date={args.appointments_per_date} page_kb={args.page_kb}')
+
+    memory_profile.start()
+    result = backfill.backfill_sync_appointments(plan)
+    print(f"sync: retrieved={result['total_retrieved']} after_filtering={result['after_filtering']} created={result['created']}")
+
+    report = memory_profile.log_report()
+    memory_profile.print_report(report)
+    sys.exit(1 if report['over_budget'] else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Benchmark the survey send path offline against the local Twilio emulator.
+
+Starts `mock/twilio.py` in-process, points the real `twilio_utils` client at it
+with TWILIO_BASE_URL, seeds synthetic appointments into the in-memory storage
+backend and runs them through `survey_sender.send_surveys_concurrently`, the
+same code `send_surveys` and `backfill.py` use. `--rounds` repeats this with
+fresh appointments for a soak test.
+
+Usage:
+    python scripts/benchmark_send.py --appointments 500 --workers 8 --messages-per-second 20 \
+        --latency-ms 150 --max-per-second 15 --error-rate 0.02
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import urllib.request
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+
+from benchmark_storage import synthetic_appointments
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark survey sending against the local Twilio emulator')
+    parser.add_argument('--appointments', type=int, default=200, help='Appointments per round')
+    parser.add_argument('--rounds', type=int, default=1, help='Rounds to run (soak test)')
+    parser.add_argument('--workers', type=int, default=4, help='TWILIO_SEND_WORKERS')
+    parser.add_argument('--messages-per-second', type=float, default=10, help='TWILIO_MESSAGES_PER_SECOND')
+    parser.add_argument('--port', type=int, default=8089, help='Emulator port')
+    parser.add_argument('--latency', default='lognormal', help='Emulator latency distribution')
+    parser.add_argument('--latency-ms', type=float, default=150, help='Emulator latency')
+    parser.add_argument('--latency-jitter-ms', type=float, default=50, help='Emulator latency spread')
+    parser.add_argument('--max-per-second', type=float, default=0, help='Emulator per-second cap (0 disables)')
+    parser.add_argument('--burst-every-s', type=float, default=0, help='Emulator 429 burst period (0 disables)')
+    parser.add_argument('--burst-duration-s', type=float, default=0, help='Emulator 429 burst length')
+    parser.add_argument('--error-rate', type=float, default=0, help='Emulator 503 rate')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    os.environ['STORAGE_BACKEND']            = 'memory'
+    os.environ['TWILIO_BASE_URL']            = f'http://127.0.0.1:{args.port}'
+    os.environ['TWILIO_SEND_WORKERS']        = str(args.workers)
+    os.environ['TWILIO_MESSAGES_PER_SECOND'] = str(args.messages_per_second)
+    os.environ['SEND_JOURNAL_PATH']          = str(Path(tempfile.mkdtemp()) / 'send_journal.jsonl')
+    os.environ['ALLOWED_PROVIDERS']          = 'BHUC COMMON GROUND,ES OAKLAND,ES MACOMB,CNS'
+    os.environ['SURVEY_COOLDOWN_DAYS']       = '0'
+    os.environ.setdefault('TWILIO_ACCOUNT_SID', 'ACbenchmark')
+    os.environ.setdefault('TWILIO_AUTH_TOKEN', 'benchmark')
+    os.environ.setdefault('TWILIO_CAMPAIGN_SID', 'MGbenchmark')
+    os.environ.setdefault('TWILIO_SURVEY_LINK', 'https://survey.example.com/?code=benchmark')
+
+    import appointments_table_utils
+    import survey_sender
+    from mock.twilio import EmulatorConfig, serve
+
+    server = serve(EmulatorConfig(
+        latency           = args.latency,
+        latency_ms        = args.latency_ms,
+        latency_jitter_ms = args.latency_jitter_ms,
+        max_per_second    = args.max_per_second,
+        burst_every_s     = args.burst_every_s,
+        burst_duration_s  = args.burst_duration_s,
+        error_rate        = args.error_rate,
+        seed              = args.seed,
+    ), port=args.port)
+
+    print(f'appointments={args.appointments} rounds={args.rounds} workers={args.workers} messages_per_second={args.messages_per_second} '
+          f'latency={args.latency}:{args.latency_ms}ms max_per_second={args.max_per_second or "-"} error_rate={args.error_rate}')
+
+    appointments = synthetic_appointments(args.appointments * args.rounds)
+    for appointment in appointments:
+        # The emulator, like Twilio, rejects numbers that are not E.164
+        appointment['patient_phone'] = '+1' + appointment['patient_phone']
+
+    try:
+        for round_number in range(args.rounds):
+            for appointment in appointments[round_number * args.appointments:(round_number + 1) * args.appointments]:
+                appointments_table_utils.create_new_appointment(**appointment)
+            pending = appointments_table_utils.get_appointments()
+
+            started = time.perf_counter()
+            result = survey_sender.send_surveys_concurrently(pending)
+            elapsed = time.perf_counter() - started
+
+            attempted = len(pending) - result['invalid_phone'] - result['known_bad_phone']
+            print(f"round {round_number + 1}: {attempted} surveys in {elapsed:.2f}s ({result['sent'] / elapsed if elapsed else 0:.1f} sent/s) "
+                  f"sent={result['sent']} errors={result['errors']} retries={result['retries']} "
+                  f"throttled={result['throttled_errors']} retryable={result['retryable_errors']} permanent={result['permanent_errors']} "
+                  f"invalid_phone={result['invalid_phone']} known_bad_phone={result['known_bad_phone']} "
+                  f"final_concurrency={result['final_concurrency']}")
+
+        with urllib.request.urlopen(f'http://127.0.0.1:{args.port}/_emulator/stats') as response:
+            print('emulator:', json.dumps(json.loads(response.read()), sort_keys=True))
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+Benchmark the appointment storage path offline.
+
+Runs synthetic appointments through the same functions the sync and send
+procedures use (create, duplicate create, pending query, update) against the
+in-memory or SQLite storage backend, optionally with injected latency and
+throttling, and prints throughput for each phase.
+
+Usage:
+    python scripts/benchmark_storage.py --backend sqlite --appointments 2000 --latency-ms 20 --workers 8
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+
+
+def synthetic_appointments(count: int) -> list[dict]:
+    rng = random.Random(42)
+    start = datetime(2025, 1, 6, 8, 0)
+    appointments = []
+    for i in range(count):
+        appointments.append(dict(
+            patient_name       = f'PATIENT{i} TEST{i}',
+            patient_dob        = date(1960, 1, 1) + timedelta(days=rng.randrange(20_000)),
+            # 555-0100 to 555-0199 are fictional and rejected before sending
+            patient_phone      = f'248555{200 + i % 9_800:04d}',
+            appointment_time   = start + timedelta(minutes=15 * i),
+            appointment_status = 'Seen',
+            provider           = rng.choice(['BHUC COMMON GROUND', 'ES OAKLAND', 'ES MACOMB', 'CNS']),
+            type               = 'CLINICIAN',
+        ))
+    return appointments
+
+
+def timed(label: str, count: int, func):
+    started = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - started
+    rate = count / elapsed if elapsed else float('inf')
+    print(f'{label:<28} {count:>7} ops  {elapsed:>8.2f}s  {rate:>10.1f} ops/s')
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark appointment storage throughput offline')
+    parser.add_argument('--backend', choices=['memory', 'sqlite'], default='memory', help='Storage backend to benchmark')
+    parser.add_argument('--sqlite-path', default='benchmark.sqlite3', help='SQLite file (recreated on each run)')
+    parser.add_argument('--appointments', type=int, default=1000, help='Number of synthetic appointments')
+    parser.add_argument('--workers', type=int, default=1, help='Concurrent workers for inserts and updates')
+    parser.add_argument('--latency-ms', type=float, default=0, help='Injected latency per storage operation')
+    parser.add_argument('--jitter-ms', type=float, default=0, help='Injected random extra latency per operation')
+    parser.add_argument('--max-ops-per-second', type=float, default=0, help='Injected throttling limit (0 disables)')
+    args = parser.parse_args()
+
+    os.environ['STORAGE_BACKEND']            = args.backend
+    os.environ['STORAGE_SQLITE_PATH']        = args.sqlite_path
+    os.environ['STORAGE_LATENCY_MS']         = str(args.latency_ms)
+    os.environ['STORAGE_LATENCY_JITTER_MS']  = str(args.jitter_ms)
+    os.environ['STORAGE_MAX_OPS_PER_SECOND'] = str(args.max_ops_per_second)
+    os.environ.setdefault('ALLOWED_PROVIDERS', 'BHUC COMMON GROUND,ES OAKLAND,ES MACOMB,CNS')
+    if args.backend == 'sqlite':
+        Path(args.sqlite_path).unlink(missing_ok=True)
+
+    from azure.core.exceptions import ResourceExistsError
+
+    import appointments_table_utils
+    from storage_backends import StorageThrottledError
+
+    appointments = synthetic_appointments(args.appointments)
+    outcomes = {'created': 0, 'duplicates': 0, 'throttled': 0}
+
+    def create(appointment: dict) -> None:
+        try:
+            appointments_table_utils.create_new_appointment(**appointment)
+            outcomes['created'] += 1
+        except ResourceExistsError:
+            outcomes['duplicates'] += 1
+        except StorageThrottledError:
+            outcomes['throttled'] += 1
+
+    def query_pending():
+        # Queries are retried on injected throttling so every phase completes
+        while True:
+            try:
+                return appointments_table_utils.get_appointments()
+            except StorageThrottledError:
+                outcomes['throttled'] += 1
+                time.sleep(0.1)
+
+    def run_all(func, items) -> None:
+        with ThreadPoolExecutor(max_workers=args.workers) as pool:
+            list(pool.map(func, items))
+
+    print(f'backend={args.backend} appointments={args.appointments} workers={args.workers} '
+          f'latency_ms={args.latency_ms} jitter_ms={args.jitter_ms} max_ops_per_second={args.max_ops_per_second or "-"}')
+
+    timed('insert', len(appointments), lambda: run_all(create, appointments))
+    timed('insert (all duplicates)', len(appointments), lambda: run_all(create, appointments))
+    pending = timed('query pending', 1, query_pending)
+
+    sent_on = datetime.now(timezone.utc)
+    def update(table_appointment) -> None:
+        try:
+            appointments_table_utils.update_appointment(table_appointment.row_key, table_appointment.partition_key, sent_on, 'SMbenchmark')
+        except StorageThrottledError:
+            outcomes['throttled'] += 1
+
+    timed('update sent', len(pending), lambda: run_all(update, pending))
+    timed('query pending (after)', 1, query_pending)
+
+    print(f"created={outcomes['created']} duplicates={outcomes['duplicates']} throttled={outcomes['throttled']} pending_found={len(pending)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -12,4 +12,38 @@ docker tag practicefusion commongroundcr.azurecr.io/practicefusion:latest
 az acr login --name commongroundcr
 
 # Push the image to ACR
-docker push commongroundcr.azurecr.io/practicefusion:latest
\ No newline at end of file
+docker push commongroundcr.azurecr.io/practicefusion:latest
+
+# Mount the Azure Files share that holds the send journal into the job, so the
+# journal survives between runs (see "Mount the Send Journal Volume" in
+# docs/deployment/docker.md). Skipped unless the job settings below are set.
+if [ -n "$RESOURCE_GROUP" ] && [ -n "$CONTAINER_APP_ENV" ] && [ -n "$CONTAINER_APP_JOB" ] \
+    && [ -n "$STORAGE_ACCOUNT_NAME" ] && [ -n "$STORAGE_ACCOUNT_KEY" ]; then
+    STATE_SHARE_NAME=${STATE_SHARE_NAME:-hope-scale-state}
+
+    az storage share-rm create \
+        --resource-group "$RESOURCE_GROUP" \
+        --storage-account "$STORAGE_ACCOUNT_NAME" \
+        --name "$STATE_SHARE_NAME" \
+        --quota 1
+
+    az containerapp env storage set \
+        --name "$CONTAINER_APP_ENV" \
+        --resource-group "$RESOURCE_GROUP" \
+        --storage-name "$STATE_SHARE_NAME" \
+        --azure-file-account-name "$STORAGE_ACCOUNT_NAME" \
+        --azure-file-account-key "$STORAGE_ACCOUNT_KEY" \
+        --azure-file-share-name "$STATE_SHARE_NAME" \
+        --access-mode ReadWrite
+
+    JOB_ID=$(az containerapp job show --name "$CONTAINER_APP_JOB" --resource-group "$RESOURCE_GROUP" --query id -o tsv)
+    az resource update \
+        --ids "$JOB_ID" \
+        --set "properties.template.volumes=[{\"name\": \"state\", \"storageType\": \"AzureFile\", \"storageName\": \"$STATE_SHARE_NAME\"}]" \
+        --set "properties.template.containers[0].volumeMounts=[{\"volumeName\": \"state\", \"mountPath\": \"/mnt/state\"}]"
+
+    az containerapp job update \
+        --name "$CONTAINER_APP_JOB" \
+        --resource-group "$RESOURCE_GROUP" \
+        --set-env-vars SEND_JOURNAL_PATH=/mnt/state/send_journal.jsonl
+fi
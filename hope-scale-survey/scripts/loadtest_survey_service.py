@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+Load test the survey serve/submit service (`src/survey_service.py`) offline.
+
+Seeds synthetic appointments into the in-memory storage backend (with injected
+table latency) and drives the ASGI app with concurrent requests, reporting
+requests/sec and latency per phase:
+
+- serve by signed token (no table read)
+- serve by bare id, cold and warm id cache
+- submit by token (one table read each, answers written in batches)
+
+By default requests are passed to the ASGI app in-process, which measures the
+service without HTTP overhead. With `--http` the app is run under uvicorn and
+requests go over a real socket with aiohttp.
+
+Usage:
+    python scripts/loadtest_survey_service.py --appointments 2000 --concurrency 50 --storage-latency-ms 20
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import threading
+import time
+from pathlib import Path
+from urllib.parse import urlencode
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+
+from benchmark_storage import synthetic_appointments
+
+ANSWERS = {
+    'SatisfactionWithService'  : 'Satisfied',
+    'LikelihoodToRecommendBHUC': 'Very Likely',
+    'ProceedWithMoreQuestions' : 'No',
+}
+
+
+async def call_in_process(app, path: str, query: str) -> int:
+    """Send one GET through the ASGI app; returns the status code."""
+    scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': query.encode(), 'headers': []}
+    status = 0
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        nonlocal status
+        if message['type'] == 'http.response.start':
+            status = message['status']
+
+    await app(scope, receive, send)
+    return status
+
+
+async def run_phase(label: str, requests: list[tuple[str, str]], concurrency: int, call) -> None:
+    latencies: list[float] = []
+    errors = 0
+    queue = list(reversed(requests))
+
+    async def worker():
+        nonlocal errors
+        while queue:
+            path, query = queue.pop()
+            started = time.perf_counter()
+            status = await call(path, query)
+            latencies.append(time.perf_counter() - started)
+            if status != 200:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    p50 = statistics.median(latencies) * 1000
+    p99 = latencies[int(len(latencies) * 0.99) - 1] * 1000 if latencies else 0
+    print(f'{label:<26} {len(requests):>7} req  {elapsed:>7.2f}s  {len(requests) / elapsed:>9.1f} req/s  '
+          f'p50 {p50:>7.2f}ms  p99 {p99:>7.2f}ms  errors {errors}')
+
+
+async def run(args) -> None:
+    import appointments_table_utils
+    import survey_service
+    from survey_token_utils import issue_token
+
+    appointments = synthetic_appointments(args.appointments)
+    for appointment in appointments:
+        appointments_table_utils.create_new_appointment(**appointment)
+    row_keys = [entity['RowKey'] for entity in appointments_table_utils.query_appointments(select=['RowKey'])]
+    tokens = {row_key: issue_token(row_key) for row_key in row_keys}
+
+    app = survey_service.SurveyService.from_env()
+    server = None
+    if args.http:
+        import aiohttp
+        import uvicorn
+
+        server = uvicorn.Server(uvicorn.Config(app, port=args.port, log_level='warning', lifespan='on'))
+        threading.Thread(target=server.run, daemon=True).start()
+        while not server.started:
+            await asyncio.sleep(0.05)
+        session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=args.concurrency))
+
+        async def call(path: str, query: str) -> int:
+            async with session.get(f'http://127.0.0.1:{args.port}{path}?{query}') as response:
+                await response.read()
+                return response.status
+    else:
+        app.writer.start()
+
+        async def call(path: str, query: str) -> int:
+            return await call_in_process(app, path, query)
+
+    print(f"appointments={len(row_keys)} concurrency={args.concurrency} storage_latency_ms={args.storage_latency_ms} "
+          f"batch_size={args.batch_size} flush_seconds={args.flush_seconds} transport={'http' if args.http else 'in-process'}")
+
+    try:
+        await run_phase('serve (token)', [('/api/serve', urlencode({'token': tokens[key]})) for key in row_keys], args.concurrency, call)
+        await run_phase('serve (id, cold cache)', [('/api/serve', urlencode({'id': key})) for key in row_keys], args.concurrency, call)
+        await run_phase('serve (id, warm cache)', [('/api/serve', urlencode({'id': key})) for key in row_keys], args.concurrency, call)
+        # The warm cache would answer submits too; clear it so each submit does its table read
+        app.states.entries.clear()
+        await run_phase('submit (token)', [('/api/submit', urlencode({'token': tokens[key], **ANSWERS})) for key in row_keys], args.concurrency, call)
+
+        started = time.perf_counter()
+        if server is None:
+            await app.writer.stop()
+        else:
+            await session.close()
+            server.should_exit = True
+            while server.started:
+                await asyncio.sleep(0.05)
+        print(f'{"final flush":<26} {time.perf_counter() - started:>21.2f}s')
+    finally:
+        if server is not None and not session.closed:
+            await session.close()
+
+    completed = sum(1 for _ in appointments_table_utils.query_appointments([('surveyCompletedOn', 'ne', '')], select=['RowKey']))
+    print(f"writer: {app.writer.stats}  completed_in_table={completed}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the survey serve/submit service')
+    parser.add_argument('--appointments', type=int, default=1000, help='Appointments (survey links) to exercise')
+    parser.add_argument('--concurrency', type=int, default=50, help='Concurrent requests')
+    parser.add_argument('--storage-latency-ms', type=float, default=20, help='Injected latency per table operation')
+    parser.add_argument('--batch-size', type=int, default=100, help='SURVEY_SUBMIT_BATCH_SIZE')
+    parser.add_argument('--flush-seconds', type=float, default=1.0, help='SURVEY_SUBMIT_FLUSH_SECONDS')
+    parser.add_argument('--http', action='store_true', help='Serve over HTTP with uvicorn and load with aiohttp')
+    parser.add_argument('--port', type=int, default=7071, help='Port for --http')
+    args = parser.parse_args()
+
+    os.environ['STORAGE_BACKEND']             = 'memory'
+    os.environ['STORAGE_LATENCY_MS']          = str(args.storage_latency_ms)
+    os.environ['SURVEY_SUBMIT_BATCH_SIZE']    = str(args.batch_size)
+    os.environ['SURVEY_SUBMIT_FLUSH_SECONDS'] = str(args.flush_seconds)
+    os.environ.setdefault('SURVEY_TOKEN_SECRET', 'loadtest')
+
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,15 @@
-from azure.data.tables import TableClient, TableEntity
 from datetime import datetime, date
+from typing import Any, Iterator
 import hashlib
 import uuid
 import os
 
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+
+import archive_appointments
 from models import TableAppointment
 from shared import ptmlog
+from storage_backends import Filter, get_table_store
 
 def calculate_row_key(patient_dob: date, patient_name: str, patient_phone: str, appointment_time: datetime) -> str:
     """
@@ -27,14 +31,17 @@ def create_new_appointment(
 ) -> None: 
     """
     Create a new appointment entity in the Azure Table Storage.
-    Raises azure.core.exceptions.ResourceExistsError if the entity already exists.
+    Raises azure.core.exceptions.ResourceExistsError if the entity already exists,
+    in the live table or in the archive.
     """
-    STORAGE_ACCOUNT_CONNECTION_STRING = os.environ['STORAGE_ACCOUNT_CONNECTION_STRING']
-    table_client = TableClient.from_connection_string(STORAGE_ACCOUNT_CONNECTION_STRING, 'appointments')
+    table_store = get_table_store('appointments')
 
     row_key = calculate_row_key(patient_dob, patient_name, patient_phone, appointment_time)
+    if archive_appointments.is_archived(row_key, appointment_time.strftime(r'%Y-%m-%dT%H:%M')):
+        # Re-creating it would leave sentOn empty and the patient would be texted again
+        raise ResourceExistsError(f'appointment already archived: {row_key}')
 
-    table_client.create_entity(TableEntity(
+    table_store.create_entity(dict(
         RowKey            = row_key,
         PartitionKey      = row_key[-1],
         sentOn            = '',
@@ -54,51 +61,128 @@ def get_appointments() -> list[TableAppointment]:
     """
     logger = ptmlog.get_logger()
 
-    STORAGE_ACCOUNT_CONNECTION_STRING = os.environ['STORAGE_ACCOUNT_CONNECTION_STRING']
-    table_client = TableClient.from_connection_string(STORAGE_ACCOUNT_CONNECTION_STRING, 'appointments')
+    table_store = get_table_store('appointments')
 
     # Build provider filter from environment (comma-separated list). Default to BHUC for backward compatibility.
     allowed_providers_raw = os.getenv('ALLOWED_PROVIDERS', 'BHUC COMMON GROUND')
     allowed_providers = [p.strip() for p in allowed_providers_raw.split(',') if p.strip()]
 
-    # Escape single quotes for OData filter safety
-    def escape_odate_literal(value: str) -> str:
-        return value.replace("'", "''")
-
     if not allowed_providers:
         # Fallback safety: if somehow empty, default to BHUC
         allowed_providers = ['BHUC COMMON GROUND']
 
-    provider_conditions = [f"provider eq '{escape_odate_literal(p)}'" for p in allowed_providers]
-    provider_filter = f"({' or '.join(provider_conditions)})"
-
-    my_filter = f"appointmentStatus eq 'Seen' and {provider_filter} and type eq 'CLINICIAN' and sentOn eq ''"
+    # Literal escaping is handled by the storage backend
+    my_filter = [
+        ('appointmentStatus', 'eq', 'Seen'),
+        ('provider',          'in', allowed_providers),
+        ('type',              'eq', 'CLINICIAN'),
+        ('sentOn',            'eq', ''),
+    ]
 
     logger.debug('table_query_filter', filter=my_filter, allowed_providers=allowed_providers)
 
-    entities = table_client.query_entities(my_filter)
+    entities = table_store.query_entities(my_filter)
 
     table_appointments = []
     for entity in entities:
+        try:
+            appointment_time = datetime.strptime(entity.get('appointmentTime', ''), r'%Y-%m-%dT%H:%M')
+        except (TypeError, ValueError):
+            appointment_time = None
         table_appointments.append(TableAppointment(
-            row_key       = entity['RowKey'],
-            partition_key = entity['PartitionKey'],
-            patient_name  = entity['patientName'],
-            patient_phone = entity['patientPhone'],
+            row_key          = entity['RowKey'],
+            partition_key    = entity['PartitionKey'],
+            patient_name     = entity['patientName'],
+            patient_phone    = entity['patientPhone'],
+            appointment_time = appointment_time,
         ))
 
     return table_appointments
 
-def update_appointment(row_key: str, partition_key: str, sent_on: datetime, message_sid: str):
+def get_appointment(row_key: str) -> dict[str, Any] | None:
+    """
+    Point read of one appointment entity by row key, or None if it does not exist.
+    """
+    table_store = get_table_store('appointments')
+
+    try:
+        return table_store.get_entity(row_key[-1], row_key)
+    except ResourceNotFoundError:
+        return None
+
+def update_appointment(row_key: str, partition_key: str, sent_on: datetime, message_sid: str, skipped_reason: str | None = None):
     logger = ptmlog.get_logger()
 
-    STORAGE_ACCOUNT_CONNECTION_STRING = os.environ['STORAGE_ACCOUNT_CONNECTION_STRING']
-    table_client = TableClient.from_connection_string(STORAGE_ACCOUNT_CONNECTION_STRING, 'appointments')
+    table_store = get_table_store('appointments')
 
-    logger.info('updating entity', row_key=row_key, partition_key=partition_key, sent_on=sent_on, message_sid=message_sid)
-    table_client.update_entity(TableEntity(
+    logger.info('updating entity', row_key=row_key, partition_key=partition_key, sent_on=sent_on, message_sid=message_sid, skipped_reason=skipped_reason)
+    entity = dict(
         PartitionKey = partition_key,
         RowKey       = row_key,
         sentOn       = sent_on,
         message_sid  = message_sid,
-    ))
+    )
+    if skipped_reason is not None:
+        entity['surveySkippedReason'] = skipped_reason
+    table_store.update_entity(entity)
+
+def update_appointments(updates: list[dict[str, Any]]):
+    """
+    Merge partial entities (PartitionKey, RowKey and the changed properties) in batches:
+    one transaction per partition and 100 rows, all-or-nothing within each transaction.
+    """
+    logger = ptmlog.get_logger()
+
+    table_store = get_table_store('appointments')
+
+    logger.info('updating entities in batch', count=len(updates))
+    table_store.submit_batch([('update', update) for update in updates])
+
+def query_appointments(
+    filters        : list[Filter] | None = None,
+    select         : list[str] | None = None,
+    include_archive: bool = False,
+    archive_months : list[str] | None = None,
+) -> Iterator[dict[str, Any]]:
+    """
+    Stream appointment entities matching every filter from the live table.
+    With `include_archive`, archived appointments (optionally only `archive_months`, as YYYY-MM)
+    are streamed afterwards; rows present in both tiers are returned once, from the live table.
+    """
+    table_store = get_table_store('appointments')
+
+    if not include_archive:
+        yield from table_store.query_entities(filters, select=select)
+        return
+
+    def project(entity: dict[str, Any]) -> dict[str, Any]:
+        return {key: entity[key] for key in select if key in entity} if select else entity
+
+    # RowKey is needed to drop rows caught mid-archive in both tiers
+    live_select = select + ['RowKey'] if select and 'RowKey' not in select else select
+    seen_row_keys: set[str] = set()
+    for entity in table_store.query_entities(filters, select=live_select):
+        seen_row_keys.add(entity['RowKey'])
+        yield project(entity)
+
+    for entity in archive_appointments.query_archive(filters, months=archive_months):
+        if entity['RowKey'] not in seen_row_keys:
+            yield project(entity)
+
+def get_row_keys_modified_since(since: datetime | None) -> list[str]:
+    """
+    Returns the row keys of appointment entities written at or after `since`.
+    When `since` is None every row key ever written is returned, including archived rows.
+    Only the RowKey property is selected so the scan stays cheap.
+    """
+    logger = ptmlog.get_logger()
+
+    if since is None:
+        entities = query_appointments(select=['RowKey'], include_archive=True)
+    else:
+        entities = query_appointments([('Timestamp', 'ge', since)], select=['RowKey'])
+
+    row_keys = [entity['RowKey'] for entity in entities]
+    logger.debug('fetched appointment row keys', since=since, count=len(row_keys))
+
+    return row_keys
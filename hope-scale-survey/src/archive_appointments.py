@@ -0,0 +1,236 @@
+"""
+Archive old appointments out of the live `appointments` table.
+
+Usage:
+    python src/archive_appointments.py --max-age-days 180 [--dry-run]
+
+Rows whose appointmentTime is older than the configured age are written to
+gzip-compressed JSON Lines blobs partitioned by month
+(`appointments-archive/YYYY-MM.jsonl.gz`) and then deleted from the hot table
+in batches. A month blob is merged by RowKey, so re-running the job (or
+resuming after a crash between upload and delete) never loses or duplicates rows.
+
+Archived rows stay readable through `appointments_table_utils.query_appointments(..., include_archive=True)`.
+
+The newest cutoff ever used is kept in `appointments-archive/cutoff.json`.
+`appointments_table_utils.create_new_appointment` checks appointments older
+than it against the month blob (`is_archived`), so a sync or backfill over
+archived dates cannot re-create a row with an empty `sentOn` and text the
+patient again.
+"""
+from datetime import datetime, timedelta, timezone
+from typing import Any, Iterator
+import argparse
+import gzip
+import json
+import os
+import sys
+from zoneinfo import ZoneInfo
+
+from azure.core.exceptions import ResourceNotFoundError
+
+import run_history
+from shared import ptmlog
+from storage_backends import Filter, MAX_BATCH_SIZE, get_blob_store, get_table_store, matches_filters
+
+EASTERN_TZ = ZoneInfo('America/New_York')
+
+ARCHIVE_CONTAINER = 'appointments-archive'
+CUTOFF_BLOB       = 'cutoff.json'
+UNKNOWN_MONTH     = 'unknown'
+
+_cutoff            : str | None = None
+_cutoff_loaded     = False
+_archived_row_keys : dict[str, set[str]] = {}
+
+
+def _encode_value(value: Any) -> Any:
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return {'$datetime': value.astimezone(timezone.utc).isoformat()}
+    return value
+
+
+def _decode_value(value: Any) -> Any:
+    if isinstance(value, dict) and '$datetime' in value:
+        return datetime.fromisoformat(value['$datetime'])
+    return value
+
+
+def month_of(entity: dict[str, Any]) -> str:
+    """Archive partition of an entity: the YYYY-MM of its appointmentTime."""
+    appointment_time = entity.get('appointmentTime')
+    if isinstance(appointment_time, str) and len(appointment_time) >= 7 and appointment_time[4] == '-':
+        return appointment_time[:7]
+    return UNKNOWN_MONTH
+
+
+def blob_name_for_month(month: str) -> str:
+    return f'{month}.jsonl.gz'
+
+
+def read_archive_month(month: str) -> dict[str, dict[str, Any]]:
+    """Entities archived for a month keyed by RowKey. Empty if the month has no archive yet."""
+    try:
+        data = get_blob_store().download_blob(ARCHIVE_CONTAINER, blob_name_for_month(month))
+    except ResourceNotFoundError:
+        return {}
+
+    entities: dict[str, dict[str, Any]] = {}
+    for line in gzip.decompress(data).splitlines():
+        if line:
+            entity = {key: _decode_value(value) for key, value in json.loads(line).items()}
+            entities[entity['RowKey']] = entity
+    return entities
+
+
+def write_archive_month(month: str, entities: dict[str, dict[str, Any]]) -> int:
+    """Replace the month blob with `entities`. Returns the compressed size in bytes."""
+    lines = (
+        json.dumps({key: _encode_value(value) for key, value in entity.items()}, separators=(',', ':'))
+        for entity in sorted(entities.values(), key=lambda e: (e.get('appointmentTime', ''), e['RowKey']))
+    )
+    data = gzip.compress('\n'.join(lines).encode(), compresslevel=9)
+    get_blob_store().upload_blob(ARCHIVE_CONTAINER, blob_name_for_month(month), data, overwrite=True)
+    return len(data)
+
+
+def read_archive_cutoff() -> str | None:
+    """The newest `appointmentTime` cutoff any archive run has used, or None if nothing was archived."""
+    try:
+        return json.loads(get_blob_store().download_blob(ARCHIVE_CONTAINER, CUTOFF_BLOB))['cutoff']
+    except ResourceNotFoundError:
+        return None
+
+
+def record_archive_cutoff(cutoff: str) -> None:
+    """Store `cutoff` unless an earlier run already archived past it."""
+    global _cutoff, _cutoff_loaded
+    stored = read_archive_cutoff()
+    if stored is None or cutoff > stored:
+        get_blob_store().upload_blob(ARCHIVE_CONTAINER, CUTOFF_BLOB, json.dumps({'cutoff': cutoff}), overwrite=True)
+        _cutoff, _cutoff_loaded = cutoff, True
+
+
+def is_archived(row_key: str, appointment_time: str) -> bool:
+    """
+    Whether the row was moved to the archive. Only appointments older than the
+    archive cutoff are looked up; each month blob is read once per process.
+    """
+    global _cutoff, _cutoff_loaded
+    if not _cutoff_loaded:
+        _cutoff, _cutoff_loaded = read_archive_cutoff(), True
+    if _cutoff is None or appointment_time >= _cutoff:
+        return False
+
+    month = month_of({'appointmentTime': appointment_time})
+    if month not in _archived_row_keys:
+        _archived_row_keys[month] = set(read_archive_month(month))
+    return row_key in _archived_row_keys[month]
+
+
+def list_archive_months() -> list[str]:
+    return [name.removesuffix('.jsonl.gz') for name in get_blob_store().list_blobs(ARCHIVE_CONTAINER) if name.endswith('.jsonl.gz')]
+
+
+def query_archive(filters: list[Filter] | None = None, months: list[str] | None = None) -> Iterator[dict[str, Any]]:
+    """Stream archived entities matching every filter, one month blob at a time."""
+    for month in months if months is not None else list_archive_months():
+        for entity in read_archive_month(month).values():
+            if matches_filters(entity, filters or []):
+                yield entity
+
+
+@ptmlog.procedure('cg_hope_scale_archive_appointments')
+def archive_appointments(max_age_days: int, dry_run: bool = False):
+    """
+    Move appointments older than `max_age_days` from the live table into monthly archive blobs.
+    """
+    logger = ptmlog.get_logger()
+    table_store = get_table_store('appointments')
+
+    cutoff = (datetime.now(EASTERN_TZ) - timedelta(days=max_age_days)).strftime(r'%Y-%m-%dT00:00')
+    logger.info('finding appointments to archive', cutoff=cutoff, max_age_days=max_age_days)
+
+    by_month: dict[str, list[dict[str, Any]]] = {}
+    for entity in table_store.query_entities([('appointmentTime', 'lt', cutoff)]):
+        entity.pop('Timestamp', None)
+        by_month.setdefault(month_of(entity), []).append(entity)
+
+    total_candidates = sum(len(entities) for entities in by_month.values())
+    logger.info('appointments to archive', total=total_candidates, months=sorted(by_month))
+
+    if dry_run:
+        return {'cutoff': cutoff, 'archived': 0, 'deleted': 0, 'candidates': total_candidates, 'months': len(by_month), 'errors': 0}
+
+    # Recorded before any row is deleted, so syncs refuse to re-create them from then on
+    record_archive_cutoff(cutoff)
+
+    archived_count = 0
+    deleted_count  = 0
+    error_count    = 0
+
+    for month, entities in sorted(by_month.items()):
+        try:
+            # Upload before deleting so a failure can only leave rows in both tiers, never in neither
+            archived = read_archive_month(month)
+            archived.update({entity['RowKey']: entity for entity in entities})
+            compressed_bytes = write_archive_month(month, archived)
+            archived_count += len(entities)
+            logger.info('archived month', month=month, rows=len(entities), month_total=len(archived), compressed_bytes=compressed_bytes)
+        except Exception as e:
+            logger.exception('error archiving month, leaving rows in table', month=month, error=str(e))
+            error_count += len(entities)
+            continue
+
+        for start in range(0, len(entities), MAX_BATCH_SIZE):
+            batch = entities[start:start + MAX_BATCH_SIZE]
+            try:
+                table_store.submit_batch([
+                    ('delete', {'PartitionKey': entity['PartitionKey'], 'RowKey': entity['RowKey']})
+                    for entity in batch
+                ])
+                deleted_count += len(batch)
+            except Exception as e:
+                # Rows stay in both tiers; the next run re-merges them into the same month blob
+                logger.exception('error deleting archived batch from table', month=month, batch_size=len(batch), error=str(e))
+                error_count += len(batch)
+
+    logger.info('archive complete', archived=archived_count, deleted=deleted_count, errors=error_count)
+
+    return {
+        'cutoff'    : cutoff,
+        'candidates': total_candidates,
+        'archived'  : archived_count,
+        'deleted'   : deleted_count,
+        'months'    : len(by_month),
+        'errors'    : error_count,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Archive old appointments out of the live table')
+    parser.add_argument('--max-age-days', type=int, default=int(os.getenv('ARCHIVE_MAX_AGE_DAYS', '180')), help='Archive appointments older than this many days')
+    parser.add_argument('--dry-run', action='store_true', help='Only count what would be archived')
+    args = parser.parse_args()
+    run_history.install()
+
+    if args.max_age_days < 1:
+        print('Error: --max-age-days must be at least 1.')
+        sys.exit(1)
+
+    result = archive_appointments(args.max_age_days, dry_run=args.dry_run)
+
+    print(f"\nArchive Results (appointments before {result['cutoff']}):")
+    print(f"  Candidates: {result['candidates']} across {result['months']} months")
+    if args.dry_run:
+        print('[DRY RUN] No changes were made.')
+        return
+    print(f"  Archived: {result['archived']}")
+    print(f"  Deleted from table: {result['deleted']}")
+    print(f"  Errors: {result['errors']}")
+
+
+if __name__ == '__main__':
+    main()
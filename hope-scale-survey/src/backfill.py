@@ -3,253 +3,404 @@ Backfill script to sync appointments for a range of dates.
 
 Usage:
     python src/backfill.py --start 2025-11-25 --end 2025-12-02
+    python src/backfill.py --start 2025-01-01 --end 2025-06-30 --chunk-days 7 --workers 3
+    python src/backfill.py --resume
 
 This script will:
-1. Retrieve appointments from Practice Fusion for each date in the range
-2. Store them in Azure Table Storage (skipping duplicates)
+1. Split the range into chunks and retrieve appointments from Practice Fusion
+   for each chunk, on parallel browser pages sharing one login
+2. Store them in Azure Table Storage as each chunk completes (skipping
+   duplicates, using a local cache of known row keys to avoid inserts that
+   would fail anyway)
 3. Send surveys to patients who haven't received one yet
+
+The status of each chunk is saved to BACKFILL_STATE_PATH, so a backfill that
+failed or was stopped carries on with `--resume`.
 """
 import os
 import sys
 import argparse
 import asyncio
-from datetime import datetime, date, timedelta, timezone
+from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
 
 from azure.core.exceptions import ResourceExistsError
 
+import deadlines
+import memory_profile
 import practice_fusion_utils
-import twilio_utils
+import run_lease
+import survey_sender
 import appointments_table_utils
+import run_history
+from backfill_plan import BackfillPlan, CHUNK_DAYS_DEFAULT, PENDING, FETCHED, SYNCED, SENT
+from deadlines import PhaseDeadlineExceeded
+from known_row_keys_utils import KnownRowKeys
+from models import PracticeFusionAppointment
 from shared import ptmlog
 
 EASTERN_TZ = ZoneInfo('America/New_York')
 
 
-def generate_date_range(start_date: date, end_date: date) -> list[date]:
-    """Generate a list of dates from start_date to end_date (inclusive)."""
-    dates = []
-    current = start_date
-    while current <= end_date:
-        dates.append(current)
-        current += timedelta(days=1)
-    return dates
+def filter_appointments(appointments: list[PracticeFusionAppointment]) -> list[PracticeFusionAppointment]:
+    return [
+        appointment
+        for appointment in appointments
+        if appointment.type == 'CLINICIAN'
+        and appointment.appointment_status == 'Seen'
+    ]
 
 
-@ptmlog.procedure('cg_hope_scale_backfill_sync')
-def backfill_sync_appointments(target_dates: list[date]):
+def write_appointments(appointments: list[PracticeFusionAppointment], known_row_keys: KnownRowKeys | None) -> dict[str, int]:
     """
-    Retrieve appointments from Practice Fusion for multiple dates and store them in Azure Table Storage.
+    Create table rows for `appointments`. When `known_row_keys` is given, appointments whose
+    row key is already known locally are skipped without a round trip to the table.
     """
     logger = ptmlog.get_logger()
-    
-    logger.info('starting backfill sync', 
-        start_date=str(target_dates[0]), 
-        end_date=str(target_dates[-1]),
-        total_dates=len(target_dates)
-    )
-    
-    # Get appointments for all dates in one browser session
-    logger.info('getting appointments from practice fusion for date range')
-    pf_appointments = asyncio.run(practice_fusion_utils.get_appointments(target_dates=target_dates))
-    
-    logger.info('retrieved appointments from practice fusion', total_appointments=len(pf_appointments))
-    
-    # Log detailed appointment data for diagnosis
-    for i, appointment in enumerate(pf_appointments):
-        if appointment:
-            logger.debug(f'appointment_{i}_details', 
-                patient_name=appointment.patient_name,
-                provider=appointment.provider,
-                type=appointment.type,
-                appointment_status=appointment.appointment_status,
-                appointment_time=str(appointment.appointment_time)
-            )
-    
-    # Filter appointments
-    filtered_appointments = [
-        appointment
-        for appointment in pf_appointments
-        if appointment.type == 'CLINICIAN'
-        and appointment.appointment_status == 'Seen'
-    ]
-    
-    logger.info('filter_results', 
-        total_retrieved=len(pf_appointments),
-        after_filtering=len(filtered_appointments)
-    )
-    
+
     # Track statistics
     created_count = 0
     duplicate_count = 0
+    skipped_known_count = 0
     error_count = 0
     
-    for appointment in filtered_appointments:
+    with ptmlog.span('table_writes'):
+        for appointment in appointments:
+            try:
+                row_key = appointments_table_utils.calculate_row_key(
+                    appointment.patient_dob,
+                    appointment.patient_name,
+                    appointment.patient_phone,
+                    appointment.appointment_time,
+                )
+                if known_row_keys is not None and row_key in known_row_keys:
+                    logger.debug('appointment already known locally, skipping insert', patient_name=appointment.patient_name)
+                    skipped_known_count += 1
+                    continue
+
+                logger.info('creating appointment in azure table', 
+                    patient_name=appointment.patient_name,
+                    appointment_time=str(appointment.appointment_time)
+                )
+                appointments_table_utils.create_new_appointment(
+                    patient_name       = appointment.patient_name,
+                    patient_dob        = appointment.patient_dob,
+                    patient_phone      = appointment.patient_phone,
+                    appointment_time   = appointment.appointment_time,
+                    appointment_status = appointment.appointment_status,
+                    provider           = appointment.provider,
+                    type               = appointment.type,
+                )
+                created_count += 1
+                if known_row_keys is not None:
+                    known_row_keys.add(row_key)
+            except ResourceExistsError:
+                logger.info('appointment already exists in azure table', patient_name=appointment.patient_name)
+                duplicate_count += 1
+                if known_row_keys is not None:
+                    known_row_keys.add(row_key)
+                continue
+            except Exception as e:
+                logger.exception('error creating appointment', patient_name=appointment.patient_name, error=str(e))
+                error_count += 1
+                continue
+    
+    if known_row_keys is not None:
         try:
-            logger.info('creating appointment in azure table', 
-                patient_name=appointment.patient_name,
-                appointment_time=str(appointment.appointment_time)
-            )
-            appointments_table_utils.create_new_appointment(
-                patient_name       = appointment.patient_name,
-                patient_dob        = appointment.patient_dob,
-                patient_phone      = appointment.patient_phone,
-                appointment_time   = appointment.appointment_time,
-                appointment_status = appointment.appointment_status,
-                provider           = appointment.provider,
-                type               = appointment.type,
-            )
-            created_count += 1
-        except ResourceExistsError:
-            logger.info('appointment already exists in azure table', patient_name=appointment.patient_name)
-            duplicate_count += 1
-            continue
+            known_row_keys.save()
         except Exception as e:
-            logger.exception('error creating appointment', patient_name=appointment.patient_name, error=str(e))
-            error_count += 1
-            continue
-    
-    logger.info('backfill sync complete',
-        created=created_count,
-        duplicates=duplicate_count,
-        errors=error_count
-    )
-    
+            logger.exception('error saving known row keys', error=str(e))
+
     return {
-        'total_retrieved': len(pf_appointments),
-        'after_filtering': len(filtered_appointments),
         'created': created_count,
         'duplicates': duplicate_count,
+        'skipped_known': skipped_known_count,
         'errors': error_count
     }
 
 
-@ptmlog.procedure('cg_hope_scale_backfill_send_surveys')
-def backfill_send_surveys():
+def print_progress(plan: BackfillPlan, chunk: dict, result: dict[str, int]) -> None:
+    progress = plan.progress()
+    eta = str(timedelta(seconds=progress['eta_s'])) if progress['eta_s'] is not None else 'unknown'
+    print(f"  [{progress['chunks_done']}/{progress['chunks_total']} chunks, {progress['dates_done']}/{progress['dates_total']} dates] "
+          f"{chunk['start']} to {chunk['end']}: {result['created']} created, {result['duplicates']} duplicates, {result['errors']} errors "
+          f"(elapsed {timedelta(seconds=progress['elapsed_s'])}, ETA {eta})")
+
+
+@ptmlog.procedure('cg_hope_scale_backfill_sync')
+def backfill_sync_appointments(plan: BackfillPlan, workers: int = 1, use_known_row_keys: bool = True):
     """
-    Send surveys to all patients who haven't received one yet.
+    Retrieve appointments from Practice Fusion for the chunks of `plan` that are not synced yet
+    and store them in Azure Table Storage, saving each chunk's status as it changes.
+    Pending chunks are scraped on `workers` browser pages that share one login; chunks fetched
+    by an interrupted run are written from the appointments saved in the plan. A chunk that
+    fails stays pending for `--resume` and the other chunks carry on.
+    When `use_known_row_keys` is set, appointments whose row key is already known locally are
+    skipped without a round trip to the table.
     """
     logger = ptmlog.get_logger()
     
-    logger.info('getting appointments that need surveys sent')
-    table_appointments = appointments_table_utils.get_appointments()
-    
-    logger.info('found appointments needing surveys', count=len(list(table_appointments)))
-    
-    # Re-query since we consumed the iterator
-    table_appointments = appointments_table_utils.get_appointments()
-    
-    sent_count = 0
-    error_count = 0
+    logger.info('starting backfill sync', 
+        start_date=str(plan.start), 
+        end_date=str(plan.end),
+        workers=workers,
+        **plan.counts()
+    )
     
-    for table_appointment in table_appointments:
-        logger.info('sending survey', patient_name=table_appointment.patient_name)
+    known_row_keys = None
+    if use_known_row_keys:
+        known_row_keys = KnownRowKeys.load()
         try:
-            message_sid = twilio_utils.send_survey(
-                id            = table_appointment.row_key,
-                patient_name  = table_appointment.patient_name,
-                patient_phone = table_appointment.patient_phone,
-            )
-            sent_count += 1
+            known_row_keys.refresh()
         except Exception as e:
-            logger.exception('error sending survey', patient_name=table_appointment.patient_name, error=str(e))
-            error_count += 1
-            continue
+            # A stale set is still safe to use, rows are never re-keyed
+            logger.exception('error refreshing known row keys, using local copy', error=str(e))
 
-        logger.info('updating table appointment', patient_name=table_appointment.patient_name)
-        try:
-            appointments_table_utils.update_appointment(
-                row_key       = table_appointment.row_key,
-                partition_key = table_appointment.partition_key,
-                sent_on       = datetime.now(timezone.utc),
-                message_sid   = message_sid,
+    totals = {'total_retrieved': 0, 'after_filtering': 0, 'created': 0, 'duplicates': 0, 'skipped_known': 0, 'errors': 0}
+
+    def release_date_leases(chunk: dict) -> None:
+        # Leases on a chunk's dates are held from its scrape until its rows are written
+        for target_date in plan.dates(chunk):
+            run_lease.release_all(f'date-{target_date}')
+
+    def sync_chunk(chunk: dict) -> None:
+        appointments = [PracticeFusionAppointment.model_validate(appointment) for appointment in chunk['appointments']]
+        result = write_appointments(appointments, known_row_keys)
+        plan.set_status(chunk, SYNCED, appointments=None, error=None, **result)
+        release_date_leases(chunk)
+        for name, count in result.items():
+            totals[name] += count
+        logger.info('backfill progress', chunk=chunk['index'], **plan.progress())
+        print_progress(plan, chunk, result)
+
+    # Chunks fetched by an interrupted run need no scraping
+    for chunk in plan.chunks_with(FETCHED):
+        totals['after_filtering'] += len(chunk['appointments'])
+        sync_chunk(chunk)
+
+    pending = {chunk['index']: plan.dates(chunk) for chunk in plan.chunks_with(PENDING)}
+    if pending:
+        # Parsing and table writes run in threads so the other workers' pages keep going
+        write_lock = asyncio.Lock()
+
+        async def on_chunk(index: int, schedule_pages: list[str]) -> None:
+            chunk = plan.chunks[index]
+            appointments = await asyncio.to_thread(practice_fusion_utils.parse_schedule_pages, schedule_pages)
+            filtered_appointments = filter_appointments(appointments)
+            totals['total_retrieved'] += len(appointments)
+            totals['after_filtering'] += len(filtered_appointments)
+            # Log detailed appointment data for diagnosis
+            for i, appointment in enumerate(appointments):
+                logger.debug(f'appointment_{i}_details', 
+                    patient_name=appointment.patient_name,
+                    provider=appointment.provider,
+                    type=appointment.type,
+                    appointment_status=appointment.appointment_status,
+                    appointment_time=str(appointment.appointment_time)
+                )
+            logger.info('filter_results', 
+                chunk=index,
+                total_retrieved=len(appointments),
+                after_filtering=len(filtered_appointments)
             )
-        except Exception as e:
-            logger.exception('error updating table appointment', patient_name=table_appointment.patient_name, error=str(e))
-            error_count += 1
-            continue
+            plan.set_status(chunk, FETCHED,
+                attempts     = chunk['attempts'] + 1,
+                retrieved    = len(appointments),
+                appointments = [appointment.model_dump(mode='json') for appointment in filtered_appointments],
+            )
+            async with write_lock:
+                await asyncio.to_thread(sync_chunk, chunk)
+
+        async def on_failure(index: int, error: str) -> None:
+            chunk = plan.chunks[index]
+            logger.warning('backfill chunk failed, leaving it pending', chunk=index, start=chunk['start'], end=chunk['end'], error=error)
+            plan.set_status(chunk, PENDING, attempts=chunk['attempts'] + 1, error=error)
+            await asyncio.to_thread(release_date_leases, chunk)
+
+        logger.info('getting appointments from practice fusion for date range', chunks=len(pending), workers=workers)
+        try:
+            asyncio.run(practice_fusion_utils.get_schedule_pages_chunked(pending, workers, on_chunk, on_failure))
+        finally:
+            run_lease.release_all('date-')
+    memory_profile.checkpoint('phase', 'table_writes')
+
+    logger.info('backfill sync complete', **totals, **plan.counts())
+    
+    return {
+        **totals,
+        'chunks_synced'   : len(plan.chunks_with(SYNCED, SENT)),
+        'chunks_remaining': len(plan.chunks_with(PENDING, FETCHED)),
+    }
+
+
+@ptmlog.procedure('cg_hope_scale_backfill_send_surveys')
+def backfill_send_surveys(lease_wait_s: float = 0):
+    """
+    Send surveys to all patients who haven't received one yet.
+    Returns None without sending if another run holds the `send` lease for longer than `lease_wait_s`.
+    """
+    logger = ptmlog.get_logger()
+    
+    # Held from reading the unsent rows to the last send, so two runs never text the same patients
+    with run_lease.hold('send', wait_s=lease_wait_s) as lease:
+        if lease is None:
+            logger.warning('another run is sending surveys, leaving them to it')
+            return None
+
+        logger.info('getting appointments that need surveys sent')
+        table_appointments = appointments_table_utils.get_appointments()
+        
+        logger.info('found appointments needing surveys', count=len(table_appointments))
+
+        result = survey_sender.send_surveys_concurrently(table_appointments, lease=lease)
+    memory_profile.checkpoint('phase', 'send')
     
     logger.info('backfill send surveys complete',
-        sent=sent_count,
-        errors=error_count
+        sent=result['sent'],
+        errors=result['errors']
     )
     
-    return {
-        'sent': sent_count,
-        'errors': error_count
-    }
+    return result
 
 
 def main():
     parser = argparse.ArgumentParser(description='Backfill appointments for a date range')
-    parser.add_argument('--start', type=str, required=True, help='Start date (YYYY-MM-DD)')
-    parser.add_argument('--end', type=str, required=True, help='End date (YYYY-MM-DD)')
+    parser.add_argument('--start', type=str, help='Start date (YYYY-MM-DD), required unless resuming')
+    parser.add_argument('--end', type=str, help='End date (YYYY-MM-DD), required unless resuming')
+    parser.add_argument('--resume', action='store_true', help='Carry on with the chunks an earlier backfill did not finish (BACKFILL_STATE_PATH)')
+    parser.add_argument('--chunk-days', type=int, default=int(os.getenv('BACKFILL_CHUNK_DAYS', str(CHUNK_DAYS_DEFAULT))), help='Dates per chunk (BACKFILL_CHUNK_DAYS)')
+    parser.add_argument('--workers', type=int, default=int(os.getenv('BACKFILL_WORKERS', '1')), help='Browser pages scraping chunks in parallel (BACKFILL_WORKERS)')
     parser.add_argument('--skip-surveys', action='store_true', help='Skip sending surveys after sync')
     parser.add_argument('--dry-run', action='store_true', help='Only show what would be done, do not sync')
+    parser.add_argument('--no-known-row-keys', action='store_true', help='Attempt every insert instead of skipping row keys already known locally')
+    parser.add_argument('--lease-wait', type=float, default=run_lease.get_wait_seconds(), help='Seconds to wait for another run that is sending surveys before skipping the send (RUN_LEASE_WAIT_SECONDS)')
+    parser.add_argument('--profile-memory', action='store_true', help='Trace memory at each date and phase and print a report (same as MEMORY_PROFILE=1)')
     
     args = parser.parse_args()
+    run_history.install()
+    if args.profile_memory:
+        os.environ['MEMORY_PROFILE'] = '1'
+    memory_profile.start()
     
     logger = ptmlog.get_logger()
     
     try:
-        start_date = datetime.strptime(args.start, '%Y-%m-%d').date()
-        end_date = datetime.strptime(args.end, '%Y-%m-%d').date()
+        start_date = datetime.strptime(args.start, '%Y-%m-%d').date() if args.start else None
+        end_date = datetime.strptime(args.end, '%Y-%m-%d').date() if args.end else None
     except ValueError as e:
         logger.error('invalid date format', error=str(e))
         print(f"Error: Invalid date format. Use YYYY-MM-DD. {e}")
         sys.exit(1)
     
-    if start_date > end_date:
-        logger.error('start date must be before or equal to end date')
-        print("Error: Start date must be before or equal to end date.")
-        sys.exit(1)
-    
-    target_dates = generate_date_range(start_date, end_date)
+    if args.resume:
+        plan = BackfillPlan.load()
+        if plan is None:
+            logger.error('no backfill plan to resume')
+            print("Error: No backfill to resume. Start one with --start and --end.")
+            sys.exit(1)
+        if (start_date or plan.start, end_date or plan.end) != (plan.start, plan.end):
+            logger.error('dates do not match the backfill plan', plan_start=str(plan.start), plan_end=str(plan.end))
+            print(f"Error: The backfill to resume covers {plan.start} to {plan.end}.")
+            sys.exit(1)
+    else:
+        if start_date is None or end_date is None:
+            print("Error: --start and --end are required unless resuming.")
+            sys.exit(1)
+        if start_date > end_date:
+            logger.error('start date must be before or equal to end date')
+            print("Error: Start date must be before or equal to end date.")
+            sys.exit(1)
+        previous_plan = BackfillPlan.load()
+        if previous_plan is not None and previous_plan.chunks_with(PENDING, FETCHED) and not args.dry_run:
+            logger.warning('replacing unfinished backfill plan', previous_plan=repr(previous_plan))
+            print(f"Warning: Replacing the unfinished backfill of {previous_plan.start} to {previous_plan.end}.")
+        plan = BackfillPlan.create(start_date, end_date, args.chunk_days)
     
     logger.info('backfill starting',
-        start_date=str(start_date),
-        end_date=str(end_date),
-        total_dates=len(target_dates),
+        start_date=str(plan.start),
+        end_date=str(plan.end),
+        total_dates=(plan.end - plan.start).days + 1,
+        chunks=len(plan.chunks),
+        workers=args.workers,
+        resume=args.resume,
         dry_run=args.dry_run,
         skip_surveys=args.skip_surveys
     )
     
-    print(f"Backfill: {start_date} to {end_date} ({len(target_dates)} days)")
-    print(f"Dates: {', '.join(str(d) for d in target_dates)}")
+    print(f"Backfill: {plan.start} to {plan.end} ({(plan.end - plan.start).days + 1} days, {len(plan.chunks)} chunks of {plan.chunk_days} days, {args.workers} workers)")
+    for chunk in plan.chunks:
+        print(f"  Chunk {chunk['index']}: {chunk['start']} to {chunk['end']} [{chunk['status']}]" + (f" last error: {chunk['error']}" if chunk.get('error') else ''))
     
     if args.dry_run:
-        print("\n[DRY RUN] Would sync appointments for the above dates.")
+        print("\n[DRY RUN] Would sync appointments for the above chunks.")
         print("[DRY RUN] No changes will be made.")
         return
+    plan.save()
     
     # Sync appointments
     try:
-        sync_result = backfill_sync_appointments(target_dates)
+        sync_result = backfill_sync_appointments(plan, workers=args.workers, use_known_row_keys=not args.no_known_row_keys)
         print(f"\nSync Results:")
         print(f"  Total retrieved: {sync_result['total_retrieved']}")
         print(f"  After filtering: {sync_result['after_filtering']}")
         print(f"  Created: {sync_result['created']}")
         print(f"  Duplicates: {sync_result['duplicates']}")
+        print(f"  Skipped (known locally, round trips avoided): {sync_result['skipped_known']}")
         print(f"  Errors: {sync_result['errors']}")
+        print(f"  Chunks synced: {sync_result['chunks_synced']}/{len(plan.chunks)}")
+    except PhaseDeadlineExceeded as e:
+        # Rows written by earlier runs can still be surveyed
+        logger.warning('backfill sync cancelled at deadline, continuing', phase=e.phase)
+        print(f"\nSync cancelled: {e}")
     except Exception as e:
+        # Chunks synced so far are saved in the plan; the rest stay pending for --resume
         logger.exception('error during backfill sync')
         print(f"\nError during sync: {e}")
+        print("Resume with: python src/backfill.py --resume")
         sys.exit(1)
     
     # Send surveys
     if not args.skip_surveys:
         try:
-            survey_result = backfill_send_surveys()
-            print(f"\nSurvey Results:")
-            print(f"  Sent: {survey_result['sent']}")
-            print(f"  Errors: {survey_result['errors']}")
+            survey_result = backfill_send_surveys(lease_wait_s=args.lease_wait)
         except Exception as e:
             logger.exception('error during backfill send surveys')
             print(f"\nError during survey send: {e}")
             sys.exit(1)
+        if survey_result is None:
+            print("\n[SKIPPED] Another run is sending surveys; they are left to it.")
+        else:
+            print(f"\nSurvey Results:")
+            print(f"  Sent: {survey_result['sent']}")
+            print(f"  Errors: {survey_result['errors']}")
+            print(f"  Uncertain (left for delivery reconciliation): {survey_result['uncertain_sends']}")
+            print(f"  Skipped phone numbers: {survey_result['invalid_phone']} invalid, {survey_result['known_bad_phone']} previously rejected")
+            print(f"  Skipped within cooldown: {survey_result['cooldown_skipped']}")
+            print(f"  Left for a later run: {survey_result['deferred']} scheduled, {survey_result['deadline_skipped']} past the send deadline")
+            print(f"  Wasted API calls: {survey_result['wasted_api_calls']} (failed send rate: {survey_result['failed_send_rate']:.1%})")
+            print(f"  Retries: {survey_result['retries']} (retryable: {survey_result['retryable_errors']}, throttled: {survey_result['throttled_errors']}, permanent: {survey_result['permanent_errors']})")
+            # Sending covers every unsent row, so synced chunks are done once nothing is left over
+            if survey_result['errors'] == 0 and survey_result['deferred'] == 0 and survey_result['deadline_skipped'] == 0:
+                for chunk in plan.chunks_with(SYNCED):
+                    plan.set_status(chunk, SENT)
     else:
         print("\n[SKIPPED] Survey sending skipped as requested.")
+
+    memory_result = memory_profile.log_report()
+    if memory_result is not None:
+        memory_profile.print_report(memory_result)
+
+    phases = deadlines.log_summary()
+    if phases:
+        print(f"\nDeadlines:")
+        for name, stats in phases.items():
+            print(f"  {name}: {stats['overruns']}/{stats['runs']} over budget ({stats['budget_s']:.0f}s), longest {stats['max_s']:.0f}s")
     
+    remaining = plan.chunks_with(PENDING, FETCHED)
+    if remaining:
+        print(f"\nBackfill incomplete: {len(remaining)} of {len(plan.chunks)} chunks not synced.")
+        print("Resume with: python src/backfill.py --resume")
+        sys.exit(1)
     print("\nBackfill complete!")
 
 
@@ -0,0 +1,137 @@
+"""
+Persisted plan of a chunked backfill, so an interrupted backfill can be resumed.
+
+`backfill.py` splits its date range into chunks of `chunk_days` dates. Each chunk
+moves through these statuses:
+
+- pending: nothing done yet, or the last attempt failed (`error` says why)
+- fetched: schedule pages scraped and parsed; the filtered appointments are kept
+  in the plan until they are written
+- synced: written to the appointments table
+- sent: the survey send that followed finished with nothing left over
+
+The plan is saved to BACKFILL_STATE_PATH after every change, and
+`backfill.py --resume` carries on with the chunks that are not done.
+"""
+from datetime import date, timedelta
+from pathlib import Path
+from typing import Any
+import json
+import os
+import threading
+import time
+
+from shared import ptmlog
+
+PENDING  = 'pending'
+FETCHED  = 'fetched'
+SYNCED   = 'synced'
+SENT     = 'sent'
+STATUSES = (PENDING, FETCHED, SYNCED, SENT)
+
+CHUNK_DAYS_DEFAULT = 7
+
+
+class BackfillPlan:
+    """Chunks of a backfill date range and the status of each, saved as JSON."""
+
+    def __init__(self, path: Path, start: date, end: date, chunk_days: int, chunks: list[dict[str, Any]]) -> None:
+        self.path       = path
+        self.start      = start
+        self.end        = end
+        self.chunk_days = chunk_days
+        self.chunks     = chunks
+        self.lock       = threading.RLock()
+        # For the ETA: chunks synced by this process and when it started on them
+        self.started    = time.monotonic()
+        self.synced_now = 0
+
+    @classmethod
+    def create(cls, start: date, end: date, chunk_days: int, path: Path | None = None) -> 'BackfillPlan':
+        path = path or Path(os.getenv('BACKFILL_STATE_PATH', 'backfill_state.json'))
+        chunks = []
+        chunk_start = start
+        while chunk_start <= end:
+            chunk_end = min(end, chunk_start + timedelta(days=chunk_days - 1))
+            chunks.append({
+                'index'   : len(chunks),
+                'start'   : chunk_start.isoformat(),
+                'end'     : chunk_end.isoformat(),
+                'status'  : PENDING,
+                'attempts': 0,
+                'error'   : None,
+            })
+            chunk_start = chunk_end + timedelta(days=1)
+        return cls(path, start, end, chunk_days, chunks)
+
+    @classmethod
+    def load(cls, path: Path | None = None) -> 'BackfillPlan | None':
+        logger = ptmlog.get_logger()
+        path = path or Path(os.getenv('BACKFILL_STATE_PATH', 'backfill_state.json'))
+
+        if not path.exists():
+            logger.debug('no backfill plan found', path=str(path))
+            return None
+
+        data = json.loads(path.read_text())
+        plan = cls(
+            path       = path,
+            start      = date.fromisoformat(data['start']),
+            end        = date.fromisoformat(data['end']),
+            chunk_days = data['chunk_days'],
+            chunks     = data['chunks'],
+        )
+        logger.debug('loaded backfill plan', path=str(path), **plan.counts())
+        return plan
+
+    def save(self) -> None:
+        with self.lock:
+            data = json.dumps({
+                'start'     : self.start.isoformat(),
+                'end'       : self.end.isoformat(),
+                'chunk_days': self.chunk_days,
+                'chunks'    : self.chunks,
+            })
+        # Written aside and renamed, so an interrupted save never leaves a truncated plan
+        temp_path = self.path.with_suffix(self.path.suffix + '.tmp')
+        temp_path.write_text(data)
+        temp_path.replace(self.path)
+
+    def set_status(self, chunk: dict[str, Any], status: str, **fields: Any) -> None:
+        """Move `chunk` to `status`, update its other `fields` and save the plan."""
+        with self.lock:
+            if status == SYNCED and chunk['status'] != SYNCED:
+                self.synced_now += 1
+            chunk.update(fields, status=status)
+            for name, value in fields.items():
+                if value is None:
+                    chunk.pop(name, None)
+        self.save()
+
+    def dates(self, chunk: dict[str, Any]) -> list[date]:
+        start = date.fromisoformat(chunk['start'])
+        end   = date.fromisoformat(chunk['end'])
+        return [start + timedelta(days=offset) for offset in range((end - start).days + 1)]
+
+    def chunks_with(self, *statuses: str) -> list[dict[str, Any]]:
+        return [chunk for chunk in self.chunks if chunk['status'] in statuses]
+
+    def counts(self) -> dict[str, int]:
+        return {status: len(self.chunks_with(status)) for status in STATUSES}
+
+    def progress(self) -> dict[str, Any]:
+        """Chunks done (synced or sent) and the estimated time to sync the rest, at this run's pace."""
+        done = len(self.chunks_with(SYNCED, SENT))
+        remaining = len(self.chunks) - done
+        elapsed = time.monotonic() - self.started
+        return {
+            'chunks_done' : done,
+            'chunks_total': len(self.chunks),
+            'dates_done'  : sum(len(self.dates(chunk)) for chunk in self.chunks_with(SYNCED, SENT)),
+            'dates_total' : (self.end - self.start).days + 1,
+            'elapsed_s'   : round(elapsed),
+            'eta_s'       : round(elapsed / self.synced_now * remaining) if self.synced_now else None,
+        }
+
+    def __repr__(self) -> str:
+        return f'BackfillPlan({self.start} to {self.end}, {self.chunk_days}-day chunks, {self.counts()})'
@@ -0,0 +1,117 @@
+"""
+Per-patient contact index used to cap how often a patient is surveyed.
+
+Appointment row keys include the appointment time, so every visit is its own
+row. The `surveyContacts` table is keyed by E.164 phone number (PartitionKey is
+the last digit, RowKey the number) and holds `lastSurveyedOn` and the row key
+of that survey (`lastRowKey`). A row whose undelivered survey was flagged for
+retry by `reconcile_delivery_status.py` is still that contact's `lastRowKey`,
+so its re-send is let through the cooldown it started.
+
+At the start of a send run the contacts surveyed within the cooldown are loaded
+into memory with one filtered query; after that every check is a dict lookup.
+`claim` reserves a phone under a lock, so two appointments of the same patient
+in one run cannot both be sent. The contact row itself is written with the
+send: the send journal's flusher upserts it (`upsert_contacts`) in the same
+commit that stores the message SID, so a run that dies before it finishes
+cannot leave a texted number out of the index.
+"""
+from datetime import datetime, timedelta, timezone
+import os
+import threading
+
+from shared import ptmlog
+from storage_backends import get_table_store
+
+TABLE_NAME            = 'surveyContacts'
+COOLDOWN_DAYS_DEFAULT = 7
+
+
+def get_cooldown() -> timedelta:
+    """Minimum time between two surveys to the same phone number; zero disables the cap."""
+    return timedelta(days=float(os.getenv('SURVEY_COOLDOWN_DAYS', str(COOLDOWN_DAYS_DEFAULT))))
+
+
+def contact_key(phone: str) -> tuple[str, str]:
+    return phone[-1], phone
+
+
+def upsert_contacts(sends: list[tuple[str, str, datetime]]) -> int:
+    """
+    Upsert `(phone, row_key, sent_on)` sends into the contact table, keeping the
+    latest send per phone. Returns the number of contacts written.
+    """
+    latest: dict[str, tuple[str, datetime]] = {}
+    for phone, row_key, sent_on in sends:
+        if phone not in latest or sent_on > latest[phone][1]:
+            latest[phone] = (row_key, sent_on)
+    if not latest:
+        return 0
+
+    operations = []
+    for phone, (last_row_key, sent_on) in latest.items():
+        partition_key, row_key = contact_key(phone)
+        operations.append(('upsert', dict(PartitionKey=partition_key, RowKey=row_key, lastSurveyedOn=sent_on, lastRowKey=last_row_key)))
+    get_table_store(TABLE_NAME).submit_batch(operations)
+    return len(operations)
+
+
+class ContactIndex:
+    """In-memory view of recently surveyed phone numbers, shared by the send workers of one run."""
+
+    def __init__(self, cooldown: timedelta, last_surveyed: dict[str, datetime], last_row_keys: dict[str, str] | None = None) -> None:
+        self.cooldown      = cooldown
+        self.last_surveyed = last_surveyed
+        self.last_row_keys = last_row_keys or {}
+        self.claimed       : set[str] = set()
+        self.lock          = threading.Lock()
+
+    @classmethod
+    def load(cls, cooldown: timedelta | None = None) -> 'ContactIndex':
+        """Load the contacts surveyed within the cooldown window."""
+        logger = ptmlog.get_logger()
+        cooldown = get_cooldown() if cooldown is None else cooldown
+        if cooldown <= timedelta(0):
+            return cls(cooldown, {})
+
+        since = datetime.now(timezone.utc) - cooldown
+        last_surveyed = {}
+        last_row_keys = {}
+        for entity in get_table_store(TABLE_NAME).query_entities(
+            [('lastSurveyedOn', 'ge', since)],
+            select = ['RowKey', 'lastSurveyedOn', 'lastRowKey'],
+        ):
+            last_surveyed[entity['RowKey']] = entity['lastSurveyedOn']
+            if entity.get('lastRowKey'):
+                last_row_keys[entity['RowKey']] = entity['lastRowKey']
+
+        logger.info('loaded contact index', contacts=len(last_surveyed), cooldown_days=cooldown.days)
+        return cls(cooldown, last_surveyed, last_row_keys)
+
+    def claim(self, phone: str, now: datetime, row_key: str | None = None) -> bool:
+        """
+        Reserve `phone` for a survey unless it was surveyed (or claimed) within the cooldown.
+        A re-send of the survey that started the cooldown (same `row_key`) is let through.
+        """
+        if self.cooldown <= timedelta(0):
+            return True
+        with self.lock:
+            if phone in self.claimed:
+                return False
+            last = self.last_surveyed.get(phone)
+            resend = row_key is not None and self.last_row_keys.get(phone) == row_key
+            if last is not None and now - last < self.cooldown and not resend:
+                return False
+            self.claimed.add(phone)
+            return True
+
+    def release(self, phone: str) -> None:
+        """Give back a claim whose send failed, so a later appointment of the patient may be sent."""
+        with self.lock:
+            self.claimed.discard(phone)
+
+    def record_sent(self, phone: str, row_key: str, sent_on: datetime) -> None:
+        """Note a send in the in-memory view; the table row is written with the send's journal commit."""
+        with self.lock:
+            self.last_surveyed[phone] = sent_on
+            self.last_row_keys[phone] = row_key
@@ -0,0 +1,150 @@
+"""
+Per-phase deadlines for the sync and send pipeline.
+
+The container job is killed at its replica timeout (`REPLICA_TIMEOUT`, 43200 s
+for the scheduled sync), so a Playwright step that hangs would otherwise hold
+the container and its browser until then. Each phase gets a time budget:
+
+- `login` (`DEADLINE_LOGIN_SECONDS`): session validation, credential login and MFA
+- `schedule_page` (`DEADLINE_SCHEDULE_PAGE_SECONDS`): one date's navigation and print view
+- `scrape` (`DEADLINE_SCRAPE_SECONDS`): the whole Playwright session of a sync
+- `send` (`DEADLINE_SEND_SECONDS`): dispatching survey sends
+
+Every budget is also capped by the time left in the run, which ends
+`DEADLINE_MARGIN_SECONDS` before the replica timeout so that state is saved and
+results are reported before the container is stopped. A budget of 0 means the
+phase is only bounded by the run.
+
+`phase()` is for async code: the phase is cancelled with `asyncio.timeout` and
+`PhaseDeadlineExceeded` is raised in its place. `watch()` is for the threaded
+send pipeline: it calls `on_expire` from a timer so the caller can stop handing
+out work and finish normally. Overruns are logged as `phase deadline exceeded`,
+counted in the run's `deadline_overruns` metric and summarized by
+`log_summary()`.
+"""
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, AsyncIterator, Callable, Iterator
+import asyncio
+import os
+import threading
+import time
+
+from shared import ptmlog
+
+REPLICA_TIMEOUT_DEFAULT = 43200
+MARGIN_SECONDS_DEFAULT  = 900
+
+BUDGET_DEFAULTS = {
+    'login'        : 900,
+    'schedule_page': 600,
+    'scrape'       : 14400,
+    'send'         : 0,
+}
+
+RUN_STARTED = time.monotonic()
+
+_stats: dict[str, dict[str, Any]] = {}
+_stats_lock = threading.Lock()
+
+
+class PhaseDeadlineExceeded(TimeoutError):
+    """Raised when a phase ran past its budget and was cancelled."""
+
+    def __init__(self, phase: str, budget_s: float) -> None:
+        super().__init__(f'{phase} exceeded its {budget_s:.0f}s deadline')
+        self.phase    = phase
+        self.budget_s = budget_s
+
+
+def run_remaining() -> float:
+    """Seconds left before the run has to wrap up."""
+    replica_timeout = float(os.getenv('REPLICA_TIMEOUT', str(REPLICA_TIMEOUT_DEFAULT)))
+    margin          = float(os.getenv('DEADLINE_MARGIN_SECONDS', str(MARGIN_SECONDS_DEFAULT)))
+    return max(0.0, replica_timeout - margin - (time.monotonic() - RUN_STARTED))
+
+
+def get_budget(phase: str) -> float:
+    """Budget for a phase starting now: its configured budget capped by the time left in the run."""
+    budget = float(os.getenv(f'DEADLINE_{phase.upper()}_SECONDS', str(BUDGET_DEFAULTS.get(phase, 0))))
+    remaining = run_remaining()
+    return min(budget, remaining) if budget > 0 else remaining
+
+
+def _record(phase: str, budget_s: float, elapsed_s: float, overrun: bool) -> None:
+    with _stats_lock:
+        stats = _stats.setdefault(phase, {'runs': 0, 'overruns': 0, 'max_s': 0.0})
+        stats['runs']     += 1
+        stats['budget_s']  = round(budget_s, 1)
+        stats['max_s']     = round(max(stats['max_s'], elapsed_s), 1)
+        stats['overruns'] += overrun
+
+
+def _overrun(phase: str, budget_s: float, **fields) -> None:
+    logger = ptmlog.get_logger()
+    logger.warning('phase deadline exceeded', phase=phase, budget_s=round(budget_s, 1), **fields)
+    ptmlog.increment_metric('deadline_overruns')
+
+
+@asynccontextmanager
+async def phase(name: str, **fields) -> AsyncIterator[float]:
+    """
+    Run the body of an async phase within its budget (yielded, in seconds).
+    On overrun the body is cancelled and PhaseDeadlineExceeded raised instead.
+    """
+    budget = get_budget(name)
+    started = time.monotonic()
+    overrun = False
+    try:
+        async with asyncio.timeout(budget) as timeout:
+            yield budget
+    except TimeoutError:
+        if not timeout.expired():
+            raise
+        overrun = True
+        _overrun(name, budget, **fields)
+        raise PhaseDeadlineExceeded(name, budget) from None
+    finally:
+        _record(name, budget, time.monotonic() - started, overrun)
+
+
+@contextmanager
+def watch(name: str, on_expire: Callable[[], None], **fields) -> Iterator[threading.Event]:
+    """
+    Call `on_expire` once if the body of a (threaded) phase is still running when its
+    budget is spent. Yields an event that is set on expiry; the body is expected to stop
+    handing out work and return normally.
+    """
+    budget = get_budget(name)
+    started = time.monotonic()
+    expired = threading.Event()
+
+    def expire() -> None:
+        expired.set()
+        _overrun(name, budget, **fields)
+        on_expire()
+
+    timer = threading.Timer(budget, ptmlog.in_context(expire))
+    timer.daemon = True
+    timer.start()
+    try:
+        yield expired
+    finally:
+        timer.cancel()
+        _record(name, budget, time.monotonic() - started, expired.is_set())
+
+
+def summary() -> dict[str, dict[str, Any]]:
+    """Per-phase runs, overruns, budget and longest duration so far in this process."""
+    with _stats_lock:
+        return {name: dict(stats) for name, stats in _stats.items()}
+
+
+def log_summary() -> dict[str, dict[str, Any]]:
+    logger = ptmlog.get_logger()
+    phases = summary()
+    overruns = sum(stats['overruns'] for stats in phases.values())
+    if overruns:
+        logger.warning('deadline summary', overruns=overruns, phases=phases, run_remaining_s=round(run_remaining()))
+    else:
+        logger.info('deadline summary', overruns=0, phases=phases, run_remaining_s=round(run_remaining()))
+    return phases
@@ -0,0 +1,114 @@
+"""
+Debug HTML snapshots of the Practice Fusion pages, recorded without slowing the scrape.
+
+With DEBUG_HTML=TRUE, `await snapshot(page, name)` reads the page HTML right
+there, so the snapshot shows the step it is named after, and starts a task that
+compresses it off the event loop into an in-memory ring buffer of at most
+`DEBUG_HTML_MAX_MB` (compressed; the oldest snapshots are dropped first). Nothing is written while the scrape runs: `flush()` writes the buffer
+at the end of the scrape, after a failure as well as a success, either as
+`<name>.html` files in ./screenshots (`DEBUG_HTML_TARGET=disk`, readable by
+`scripts/analyze_html_debug.py`) or as `<run time>/<name>.html.gz` blobs in the
+`debug-snapshots` container (`DEBUG_HTML_TARGET=blob`).
+
+Disabled, every method returns immediately, so call sites need no checks.
+"""
+from collections import deque
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any
+import asyncio
+import gzip
+import os
+
+from shared import ptmlog
+from storage_backends import get_blob_store
+
+CONTAINER_NAME     = 'debug-snapshots'
+DIRECTORY          = Path('./screenshots')
+MAX_MB_DEFAULT     = 20
+COMPRESS_LEVEL     = 6
+
+
+class DebugRecorder:
+    """Compressed, size-capped ring buffer of page snapshots for one scrape."""
+
+    def __init__(self, enabled: bool, max_bytes: int = MAX_MB_DEFAULT * 1_000_000, target: str = 'disk') -> None:
+        self.enabled   = enabled
+        self.max_bytes = max_bytes
+        self.target    = target
+        self.snapshots : deque[tuple[str, bytes]] = deque()
+        self.size      = 0
+        self.dropped   = 0
+        self.pending   : set[asyncio.Task] = set()
+
+    @classmethod
+    def from_env(cls) -> 'DebugRecorder':
+        return cls(
+            enabled   = os.getenv('DEBUG_HTML', 'FALSE') == 'TRUE',
+            max_bytes = int(float(os.getenv('DEBUG_HTML_MAX_MB', str(MAX_MB_DEFAULT))) * 1_000_000),
+            target    = os.getenv('DEBUG_HTML_TARGET', 'disk'),
+        )
+
+    async def snapshot(self, page: Any, name: str) -> None:
+        """Record the current HTML of `page` (a Playwright page) as `name`; only the read is awaited."""
+        if not self.enabled:
+            return
+        logger = ptmlog.get_logger()
+        try:
+            html = await page.content()
+        except Exception as e:
+            # e.g. the page was navigating; a missing snapshot must never fail the scrape
+            logger.warning('could not capture debug snapshot', name=name, error=str(e))
+            return
+        self.add(name, html)
+
+    def add(self, name: str, html: str) -> None:
+        """Record HTML that is already in hand as `name`, in the background."""
+        if not self.enabled:
+            return
+        self._track(ptmlog.create_task(self._store(name, html)))
+
+    def _track(self, task: asyncio.Task) -> None:
+        # The event loop only keeps weak references to tasks
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+
+    async def _store(self, name: str, html: str) -> None:
+        data = await asyncio.to_thread(gzip.compress, html.encode(), COMPRESS_LEVEL)
+        self.snapshots.append((name, data))
+        self.size += len(data)
+        while self.size > self.max_bytes and self.snapshots:
+            _, dropped = self.snapshots.popleft()
+            self.size -= len(dropped)
+            self.dropped += 1
+
+    def _write(self, snapshots: list[tuple[str, bytes]]) -> None:
+        if self.target == 'blob':
+            prefix = f'{datetime.now(timezone.utc):%Y%m%dT%H%M%SZ}'
+            blob_store = get_blob_store()
+            for name, data in snapshots:
+                blob_store.upload_blob(CONTAINER_NAME, f'{prefix}/{name}.html.gz', data, overwrite=True)
+            return
+        DIRECTORY.mkdir(parents=True, exist_ok=True)
+        for name, data in snapshots:
+            (DIRECTORY / f'{name}.html').write_bytes(gzip.decompress(data))
+
+    async def flush(self, reason: str) -> None:
+        """Wait for snapshots still being compressed, then write out and empty the buffer."""
+        if not self.enabled:
+            return
+        logger = ptmlog.get_logger()
+        if self.pending:
+            await asyncio.gather(*self.pending, return_exceptions=True)
+
+        snapshots = list(self.snapshots)
+        self.snapshots.clear()
+        self.size = 0
+        await asyncio.to_thread(self._write, snapshots)
+        logger.info('flushed debug snapshots',
+            reason  = reason,
+            count   = len(snapshots),
+            dropped = self.dropped,
+            bytes   = sum(len(data) for _, data in snapshots),
+            target  = self.target,
+        )
@@ -0,0 +1,190 @@
+"""
+Incremental columnar export of completed surveys for reporting.
+
+Usage:
+    python src/export_survey_results.py --output-dir exports/survey_results [--full]
+
+Each run pulls only appointments whose `surveyCompletedOn` is newer than the
+watermark left by the previous run and appends one zstd-compressed Parquet file
+per completion month:
+
+    exports/survey_results/month=2024-06/part-20250101T031500.parquet
+
+Responses are typed (answer label as a dictionary-encoded string plus a numeric
+`*_score` column for scored questions) so a year of results loads in one call:
+
+    pyarrow.dataset.dataset('exports/survey_results', partitioning='hive').to_table()
+
+Patient name, date of birth and phone number are never exported.
+"""
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any
+import argparse
+import json
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import appointments_table_utils
+import run_history
+import survey_fields
+from shared import ptmlog
+
+WATERMARK_FILE = '_watermark.json'
+
+APPOINTMENT_COLUMNS = [
+    pa.field('RowKey',            pa.string()),
+    pa.field('provider',          pa.dictionary(pa.int16(), pa.string())),
+    pa.field('type',              pa.dictionary(pa.int16(), pa.string())),
+    pa.field('appointmentStatus', pa.dictionary(pa.int16(), pa.string())),
+    pa.field('appointmentTime',   pa.timestamp('s')),
+    pa.field('sentOn',            pa.timestamp('us', tz='UTC')),
+    pa.field('surveyCompletedOn', pa.timestamp('us', tz='UTC')),
+]
+
+
+def build_schema() -> pa.Schema:
+    fields = list(APPOINTMENT_COLUMNS)
+    for name in survey_fields.SCORED_FIELDS:
+        fields.append(pa.field(name, pa.dictionary(pa.int16(), pa.string())))
+        fields.append(pa.field(f'{name}_score', pa.int8()))
+    for name in survey_fields.TEXT_FIELDS:
+        fields.append(pa.field(name, pa.string()))
+    # Any response property not known to survey_fields, as a JSON object, so new form fields are not lost
+    fields.append(pa.field('extra', pa.string()))
+    return pa.schema(fields)
+
+
+SCHEMA = build_schema()
+
+KNOWN_PROPERTIES = (
+    {field.name for field in APPOINTMENT_COLUMNS}
+    | set(survey_fields.SCORED_FIELDS)
+    | set(survey_fields.TEXT_FIELDS)
+    | set(survey_fields.PATIENT_IDENTIFYING_FIELDS)
+    | {'PartitionKey', 'Timestamp', 'message_sid', 'code'}
+)
+
+
+def to_record(entity: dict[str, Any]) -> dict[str, Any]:
+    appointment_time = entity.get('appointmentTime')
+    try:
+        appointment_time = datetime.strptime(appointment_time, r'%Y-%m-%dT%H:%M') if appointment_time else None
+    except (TypeError, ValueError):
+        appointment_time = None
+
+    record: dict[str, Any] = {
+        'RowKey'           : entity['RowKey'],
+        'provider'         : entity.get('provider'),
+        'type'             : entity.get('type'),
+        'appointmentStatus': entity.get('appointmentStatus'),
+        'appointmentTime'  : appointment_time,
+        'sentOn'           : survey_fields.parse_datetime(entity.get('sentOn')),
+        'surveyCompletedOn': survey_fields.parse_datetime(entity.get('surveyCompletedOn')),
+    }
+    for name in survey_fields.SCORED_FIELDS:
+        value = entity.get(name)
+        record[name] = value if isinstance(value, str) and value else None
+        record[f'{name}_score'] = survey_fields.score(name, value)
+    for name in survey_fields.TEXT_FIELDS:
+        value = entity.get(name)
+        record[name] = str(value) if value not in (None, '') else None
+
+    extra = {key: str(value) for key, value in entity.items() if key not in KNOWN_PROPERTIES and value not in (None, '')}
+    record['extra'] = json.dumps(extra, sort_keys=True) if extra else None
+    return record
+
+
+def read_watermark(output_dir: Path) -> datetime | None:
+    path = output_dir / WATERMARK_FILE
+    if not path.exists():
+        return None
+    return datetime.fromisoformat(json.loads(path.read_text())['surveyCompletedOn'])
+
+
+def write_watermark(output_dir: Path, watermark: datetime, exported_rows: int) -> None:
+    (output_dir / WATERMARK_FILE).write_text(json.dumps({
+        'surveyCompletedOn': watermark.isoformat(),
+        'exported_on'      : datetime.now(timezone.utc).isoformat(),
+        'exported_rows'    : exported_rows,
+    }))
+
+
+@ptmlog.procedure('cg_hope_scale_export_survey_results')
+def export_survey_results(output_dir: str, full: bool = False):
+    """
+    Export surveys completed since the last watermark into month-partitioned Parquet files.
+    """
+    logger = ptmlog.get_logger()
+    output_path = Path(output_dir)
+    output_path.mkdir(parents=True, exist_ok=True)
+
+    if full:
+        for part in output_path.glob('month=*/part-*.parquet'):
+            part.unlink()
+        watermark = None
+    else:
+        watermark = read_watermark(output_path)
+
+    settled_through = survey_fields.completions_settled_through()
+    logger.info('exporting completed surveys', output_dir=str(output_path), watermark=watermark, settled_through=settled_through, full=full)
+
+    # The first (or a full) export also reads archived rows; incremental runs only need the live table.
+    # Recent completions may still be waiting in the survey service's write buffer, so they are left for the next run
+    entities = appointments_table_utils.query_appointments(
+        [('surveyCompletedOn', 'gt', watermark or survey_fields.EPOCH), ('surveyCompletedOn', 'le', settled_through)],
+        include_archive = watermark is None,
+    )
+
+    by_month: dict[str, list[dict[str, Any]]] = {}
+    new_watermark = watermark
+    for entity in entities:
+        record = to_record(entity)
+        completed_on = record['surveyCompletedOn']
+        if completed_on is None:
+            continue
+        by_month.setdefault(completed_on.strftime(r'%Y-%m'), []).append(record)
+        if new_watermark is None or completed_on > new_watermark:
+            new_watermark = completed_on
+
+    run_stamp = datetime.now(timezone.utc).strftime(r'%Y%m%dT%H%M%S')
+    exported_rows = 0
+    for month, records in sorted(by_month.items()):
+        month_dir = output_path / f'month={month}'
+        month_dir.mkdir(exist_ok=True)
+        table = pa.Table.from_pylist(records, schema=SCHEMA)
+        pq.write_table(table, month_dir / f'part-{run_stamp}.parquet', compression='zstd')
+        exported_rows += len(records)
+        logger.info('wrote survey results partition', month=month, rows=len(records))
+
+    # Only advance the watermark once every partition is on disk
+    if new_watermark is not None and exported_rows:
+        write_watermark(output_path, new_watermark, exported_rows)
+
+    logger.info('survey results export complete', exported_rows=exported_rows, months=len(by_month), watermark=new_watermark)
+
+    return {
+        'exported_rows': exported_rows,
+        'months'       : len(by_month),
+        'watermark'    : new_watermark.isoformat() if new_watermark else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export completed surveys to month-partitioned Parquet files')
+    parser.add_argument('--output-dir', default='exports/survey_results', help='Dataset directory (holds the watermark too)')
+    parser.add_argument('--full', action='store_true', help='Ignore the watermark and re-export everything, replacing existing files')
+    args = parser.parse_args()
+    run_history.install()
+
+    result = export_survey_results(args.output_dir, full=args.full)
+
+    print(f"\nExport Results:")
+    print(f"  Rows exported: {result['exported_rows']}")
+    print(f"  Months written: {result['months']}")
+    print(f"  Watermark: {result['watermark']}")
+
+
+if __name__ == '__main__':
+    main()
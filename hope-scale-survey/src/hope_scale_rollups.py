@@ -0,0 +1,303 @@
+"""
+Per-provider, per-week Hope Scale rollups kept in the `hopeScaleRollups` table.
+
+Usage:
+    python src/hope_scale_rollups.py            # fold in surveys completed since the last update
+    python src/hope_scale_rollups.py --rebuild  # recompute everything in one streaming pass
+
+Each rollup row is keyed by provider (PartitionKey) and the Monday of the
+appointment week (RowKey) and holds, for every scored survey field, the response
+count, score sum and a score histogram (`<field>_count`, `<field>_sum`,
+`<field>_hist` as JSON). `RecommendCommonGroundToFriendInNeed_nps` is derived
+from its histogram (promoters answer 5, detractors 1-3).
+
+Every provider partition also holds a `_watermark` row with the newest
+`surveyCompletedOn` folded into it, written only after all of the provider's
+week rows (which Azure may split over several transactions), so it is never
+ahead of them. Each week row carries its own `foldedThrough`, the newest
+completion folded into that row, in the same entity as its counts: when an
+interrupted update left the watermark behind, the next update reads those
+surveys again and skips the ones a week row already holds, so no survey is
+counted twice.
+
+A `_global` partition holds one more `_watermark` row: the newest completion
+seen by the last update that wrote every provider. Updates read from it, so a
+provider that has no watermark yet (its first survey, or a provider only found
+in the archive) is never missed; with no global watermark the update reads
+everything, archive included.
+"""
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Any
+import argparse
+import json
+
+from azure.core.exceptions import ResourceNotFoundError
+
+import appointments_table_utils
+import run_history
+import survey_fields
+from shared import ptmlog
+from storage_backends import get_table_store
+
+TABLE_NAME       = 'hopeScaleRollups'
+WATERMARK_ROW    = '_watermark'
+GLOBAL_PARTITION = '_global'
+UNKNOWN_PROVIDER = 'UNKNOWN'
+NPS_FIELD        = 'RecommendCommonGroundToFriendInNeed'
+
+
+class WeekAggregate:
+    """Score histograms for every scored field of one provider-week."""
+
+    def __init__(self) -> None:
+        self.surveys = 0
+        self.histograms: dict[str, Counter[int]] = {field: Counter() for field in survey_fields.SCORED_FIELDS}
+        self.folded_through: datetime | None = None
+
+    def add_survey(self, entity: dict[str, Any], completed_on: datetime) -> None:
+        self.surveys += 1
+        if self.folded_through is None or completed_on > self.folded_through:
+            self.folded_through = completed_on
+        for field in survey_fields.SCORED_FIELDS:
+            score = survey_fields.score(field, entity.get(field))
+            if score is not None:
+                self.histograms[field][score] += 1
+
+    def merge(self, other: 'WeekAggregate') -> None:
+        self.surveys += other.surveys
+        if other.folded_through is not None and (self.folded_through is None or other.folded_through > self.folded_through):
+            self.folded_through = other.folded_through
+        for field, histogram in other.histograms.items():
+            self.histograms[field].update(histogram)
+
+    @classmethod
+    def from_entity(cls, entity: dict[str, Any]) -> 'WeekAggregate':
+        aggregate = cls()
+        aggregate.surveys = int(entity.get('surveys', 0))
+        aggregate.folded_through = survey_fields.parse_datetime(entity.get('foldedThrough'))
+        for field in survey_fields.SCORED_FIELDS:
+            raw = entity.get(f'{field}_hist')
+            if raw:
+                aggregate.histograms[field] = Counter({int(score): count for score, count in json.loads(raw).items()})
+        return aggregate
+
+    def to_entity(self, provider: str, week_start: str) -> dict[str, Any]:
+        entity: dict[str, Any] = {
+            'PartitionKey': provider,
+            'RowKey'      : week_start,
+            'surveys'     : self.surveys,
+        }
+        if self.folded_through is not None:
+            entity['foldedThrough'] = self.folded_through
+        for field, histogram in self.histograms.items():
+            entity[f'{field}_count'] = sum(histogram.values())
+            entity[f'{field}_sum']   = sum(score * count for score, count in histogram.items())
+            entity[f'{field}_hist']  = json.dumps({str(score): histogram[score] for score in sorted(histogram)})
+        nps_score = nps(self.histograms[NPS_FIELD])
+        if nps_score is not None:
+            entity[f'{NPS_FIELD}_nps'] = nps_score
+        return entity
+
+
+def nps(histogram: Counter[int]) -> float | None:
+    """Net promoter style score on a 1-5 scale: % answering 5 minus % answering 1-3."""
+    total = sum(histogram.values())
+    if not total:
+        return None
+    promoters  = histogram[5]
+    detractors = histogram[1] + histogram[2] + histogram[3]
+    return round(100 * (promoters - detractors) / total, 1)
+
+
+def provider_key(entity: dict[str, Any]) -> str:
+    provider = (entity.get('provider') or UNKNOWN_PROVIDER).strip() or UNKNOWN_PROVIDER
+    # Characters Table Storage does not allow in keys
+    for character in '/\\#?':
+        provider = provider.replace(character, '_')
+    return provider
+
+
+def week_key(entity: dict[str, Any], completed_on: datetime) -> str:
+    try:
+        day = datetime.strptime(entity['appointmentTime'], r'%Y-%m-%dT%H:%M').date()
+    except (KeyError, TypeError, ValueError):
+        day = completed_on.date()
+    return (day - timedelta(days=day.weekday())).isoformat()
+
+
+def read_watermarks() -> dict[str, datetime]:
+    table_store = get_table_store(TABLE_NAME)
+    return {
+        entity['PartitionKey']: survey_fields.parse_datetime(entity['surveyCompletedOn'])
+        for entity in table_store.query_entities([('RowKey', 'eq', WATERMARK_ROW)])
+        if entity['PartitionKey'] != GLOBAL_PARTITION
+    }
+
+
+def read_global_watermark() -> datetime | None:
+    """The newest completion seen by the last update that wrote every provider, or None before the first one."""
+    try:
+        entity = get_table_store(TABLE_NAME).get_entity(GLOBAL_PARTITION, WATERMARK_ROW)
+    except ResourceNotFoundError:
+        return None
+    return survey_fields.parse_datetime(entity['surveyCompletedOn'])
+
+
+def write_global_watermark(watermark: datetime) -> None:
+    get_table_store(TABLE_NAME).submit_batch([('upsert', {'PartitionKey': GLOBAL_PARTITION, 'RowKey': WATERMARK_ROW, 'surveyCompletedOn': watermark})])
+
+
+def read_folded_through() -> dict[tuple[str, str], datetime]:
+    """The newest completion folded into each week row, by provider and week."""
+    table_store = get_table_store(TABLE_NAME)
+    return {
+        (entity['PartitionKey'], entity['RowKey']): survey_fields.parse_datetime(entity['foldedThrough'])
+        for entity in table_store.query_entities(select=['PartitionKey', 'RowKey', 'foldedThrough'])
+        if entity['RowKey'] != WATERMARK_ROW and entity.get('foldedThrough')
+    }
+
+
+def write_provider(provider: str, weeks: dict[str, WeekAggregate], watermark: datetime) -> None:
+    """
+    Write a provider's week rows (one transaction per 100 rows in Azure), then its watermark
+    in a transaction of its own, so the watermark only moves once every week row is written.
+    """
+    table_store = get_table_store(TABLE_NAME)
+    table_store.submit_batch([('upsert', aggregate.to_entity(provider, week)) for week, aggregate in sorted(weeks.items())])
+    table_store.submit_batch([('upsert', {'PartitionKey': provider, 'RowKey': WATERMARK_ROW, 'surveyCompletedOn': watermark})])
+
+
+def aggregate_completed_surveys(
+    since          : datetime,
+    watermarks     : dict[str, datetime],
+    include_archive: bool,
+    folded_through : dict[tuple[str, str], datetime] | None = None,
+) -> tuple[dict[str, dict[str, WeekAggregate]], dict[str, datetime], int]:
+    """
+    Stream surveys completed after `since` (up to `survey_fields.completions_settled_through()`, so a
+    survey still being written is never passed by a watermark) and aggregate the ones newer than their
+    provider's watermark and their week row's `folded_through`.
+    Returns aggregates per provider and week, the new watermark per provider, and the number of surveys folded in.
+    """
+    folded_through = folded_through or {}
+    aggregates: dict[str, dict[str, WeekAggregate]] = {}
+    new_watermarks = dict(watermarks)
+    folded = 0
+
+    entities = appointments_table_utils.query_appointments(
+        [('surveyCompletedOn', 'gt', since), ('surveyCompletedOn', 'le', survey_fields.completions_settled_through())],
+        include_archive = include_archive,
+    )
+    for entity in entities:
+        completed_on = survey_fields.parse_datetime(entity.get('surveyCompletedOn'))
+        if completed_on is None:
+            continue
+        provider = provider_key(entity)
+        if provider in watermarks and completed_on <= watermarks[provider]:
+            continue
+
+        if provider not in new_watermarks or completed_on > new_watermarks[provider]:
+            new_watermarks[provider] = completed_on
+        week = week_key(entity, completed_on)
+        if (provider, week) in folded_through and completed_on <= folded_through[(provider, week)]:
+            # Written by an update that stopped before moving the watermark
+            continue
+        aggregates.setdefault(provider, {}).setdefault(week, WeekAggregate()).add_survey(entity, completed_on)
+        folded += 1
+
+    return aggregates, new_watermarks, folded
+
+
+@ptmlog.procedure('cg_hope_scale_update_rollups')
+def update_rollups():
+    """
+    Fold surveys completed since the last update into the rollup table.
+    """
+    logger = ptmlog.get_logger()
+    table_store = get_table_store(TABLE_NAME)
+
+    global_watermark = read_global_watermark()
+    watermarks = read_watermarks()
+    # Every survey up to the global watermark is in some provider's rows, whether or not that provider has a watermark
+    since = global_watermark or survey_fields.EPOCH
+    logger.info('updating hope scale rollups', since=since, providers_with_watermark=len(watermarks))
+
+    deltas, new_watermarks, folded = aggregate_completed_surveys(since, watermarks, include_archive=global_watermark is None, folded_through=read_folded_through())
+
+    rows_written = 0
+    # Providers whose only new surveys were already in their week rows just move their watermark
+    moved = [provider for provider, watermark in new_watermarks.items() if watermark != watermarks.get(provider)]
+    for provider in moved:
+        merged: dict[str, WeekAggregate] = {}
+        for week, delta in deltas.get(provider, {}).items():
+            try:
+                aggregate = WeekAggregate.from_entity(table_store.get_entity(provider, week))
+            except ResourceNotFoundError:
+                aggregate = WeekAggregate()
+            aggregate.merge(delta)
+            merged[week] = aggregate
+        write_provider(provider, merged, new_watermarks[provider])
+        rows_written += len(merged)
+    # Only once every provider is written, so a failed update is read again from the old global watermark
+    if new_watermarks:
+        write_global_watermark(max(new_watermarks.values()))
+
+    logger.info('hope scale rollups updated', surveys_folded=folded, providers=len(deltas), rows_written=rows_written)
+
+    return {
+        'surveys_folded': folded,
+        'providers'     : len(deltas),
+        'rows_written'  : rows_written,
+    }
+
+
+@ptmlog.procedure('cg_hope_scale_rebuild_rollups')
+def rebuild_rollups():
+    """
+    Recompute every rollup row from all completed surveys (live table and archive) in one streaming pass.
+    """
+    logger = ptmlog.get_logger()
+    table_store = get_table_store(TABLE_NAME)
+
+    aggregates, watermarks, folded = aggregate_completed_surveys(survey_fields.EPOCH, {}, include_archive=True)
+
+    stale = [
+        ('delete', {'PartitionKey': entity['PartitionKey'], 'RowKey': entity['RowKey']})
+        for entity in table_store.query_entities(select=['PartitionKey', 'RowKey'])
+    ]
+    table_store.submit_batch(stale)
+    logger.info('cleared hope scale rollups', rows_deleted=len(stale))
+
+    rows_written = 0
+    for provider, weeks in aggregates.items():
+        write_provider(provider, weeks, watermarks[provider])
+        rows_written += len(weeks)
+    if watermarks:
+        write_global_watermark(max(watermarks.values()))
+
+    logger.info('hope scale rollups rebuilt', surveys_folded=folded, providers=len(aggregates), rows_written=rows_written)
+
+    return {
+        'surveys_folded': folded,
+        'providers'     : len(aggregates),
+        'rows_written'  : rows_written,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Maintain per-provider, per-week Hope Scale rollups')
+    parser.add_argument('--rebuild', action='store_true', help='Recompute all rollups from scratch')
+    args = parser.parse_args()
+    run_history.install()
+
+    result = rebuild_rollups() if args.rebuild else update_rollups()
+
+    print(f"\nRollup Results:")
+    print(f"  Surveys folded in: {result['surveys_folded']}")
+    print(f"  Providers: {result['providers']}")
+    print(f"  Rows written: {result['rows_written']}")
+
+
+if __name__ == '__main__':
+    main()
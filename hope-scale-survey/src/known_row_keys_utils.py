@@ -0,0 +1,76 @@
+from pathlib import Path
+from datetime import datetime, timedelta, timezone
+import json
+import os
+
+import appointments_table_utils
+from shared import ptmlog
+
+# Rows written while a refresh is in flight can carry a Timestamp slightly older than the
+# watermark we record, so each incremental refresh re-reads a small overlap window.
+REFRESH_OVERLAP = timedelta(minutes=5)
+
+
+class KnownRowKeys:
+    """
+    Locally persisted set of appointment row keys that are known to exist in the table.
+
+    Used to skip `create_entity` calls that are guaranteed to fail with ResourceExistsError
+    when re-running a backfill over dates that were already synced. The set is exact rather
+    than probabilistic so a key is only ever skipped when it really has been written.
+    """
+
+    def __init__(self, path: Path, row_keys: set[str], refreshed_on: datetime | None) -> None:
+        self.path         = path
+        self.row_keys     = row_keys
+        self.refreshed_on = refreshed_on
+
+    @classmethod
+    def load(cls, path: Path | None = None) -> 'KnownRowKeys':
+        logger = ptmlog.get_logger()
+        path = path or Path(os.getenv('KNOWN_ROW_KEYS_PATH', 'known_row_keys.json'))
+
+        if not path.exists():
+            logger.debug('no known row keys file found', path=str(path))
+            return cls(path, set(), None)
+
+        data = json.loads(path.read_text())
+        refreshed_on = datetime.fromisoformat(data['refreshed_on']) if data.get('refreshed_on') else None
+        known_row_keys = cls(path, set(data.get('row_keys', [])), refreshed_on)
+        logger.debug('loaded known row keys', path=str(path), count=len(known_row_keys), refreshed_on=refreshed_on)
+        return known_row_keys
+
+    def refresh(self) -> int:
+        """
+        Pull row keys written since the last refresh from the table.
+        The first refresh reads every row key. Returns the number of newly learned keys.
+        """
+        logger = ptmlog.get_logger()
+
+        started_on = datetime.now(timezone.utc)
+        since = self.refreshed_on - REFRESH_OVERLAP if self.refreshed_on else None
+
+        before = len(self.row_keys)
+        self.row_keys.update(appointments_table_utils.get_row_keys_modified_since(since))
+        self.refreshed_on = started_on
+
+        added = len(self.row_keys) - before
+        logger.info('refreshed known row keys', since=since, added=added, total=len(self.row_keys))
+        return added
+
+    def add(self, row_key: str) -> None:
+        self.row_keys.add(row_key)
+
+    def save(self) -> None:
+        logger = ptmlog.get_logger()
+        self.path.write_text(json.dumps({
+            'refreshed_on': self.refreshed_on.isoformat() if self.refreshed_on else None,
+            'row_keys'    : sorted(self.row_keys),
+        }))
+        logger.debug('saved known row keys', path=str(self.path), count=len(self.row_keys))
+
+    def __contains__(self, row_key: str) -> bool:
+        return row_key in self.row_keys
+
+    def __len__(self) -> int:
+        return len(self.row_keys)
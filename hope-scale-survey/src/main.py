@@ -1,13 +1,17 @@
 import os
 import asyncio
-from datetime import datetime, timezone
+from datetime import datetime
 from zoneinfo import ZoneInfo
 
 from azure.core.exceptions import ResourceExistsError
 
+import deadlines
+import memory_profile
 import practice_fusion_utils
-import twilio_utils
+import run_lease
+import survey_sender
 import appointments_table_utils
+import run_history
 from shared import ptmlog
 
 EASTERN_TZ = ZoneInfo('America/New_York')
@@ -70,21 +74,35 @@ def sync_appointments():
         after_filtering=len(filtered_appointments)
     )
 
-    for appointment in filtered_appointments:
-        try:
-            logger.info('creating appointment in azure table', patient_name=appointment.patient_name)
-            appointments_table_utils.create_new_appointment(
-                patient_name       = appointment.patient_name,
-                patient_dob        = appointment.patient_dob,
-                patient_phone      = appointment.patient_phone,
-                appointment_time   = appointment.appointment_time,
-                appointment_status = appointment.appointment_status,
-                provider           = appointment.provider,
-                type               = appointment.type,
-            )
-        except ResourceExistsError:
-            logger.exception('appointment already exists in azure table', patient_name=appointment.patient_name)
-            continue  # This should not end the process
+    created_count = 0
+    duplicate_count = 0
+
+    with ptmlog.span('table_writes'):
+        for appointment in filtered_appointments:
+            try:
+                logger.info('creating appointment in azure table', patient_name=appointment.patient_name)
+                appointments_table_utils.create_new_appointment(
+                    patient_name       = appointment.patient_name,
+                    patient_dob        = appointment.patient_dob,
+                    patient_phone      = appointment.patient_phone,
+                    appointment_time   = appointment.appointment_time,
+                    appointment_status = appointment.appointment_status,
+                    provider           = appointment.provider,
+                    type               = appointment.type,
+                )
+                created_count += 1
+            except ResourceExistsError:
+                logger.exception('appointment already exists in azure table', patient_name=appointment.patient_name)
+                duplicate_count += 1
+                continue  # This should not end the process
+    memory_profile.checkpoint('phase', 'table_writes')
+
+    return {
+        'total_retrieved': len(pf_appointments),
+        'after_filtering': len(filtered_appointments),
+        'created': created_count,
+        'duplicates': duplicate_count,
+    }
 
 @ptmlog.procedure('cg_hope_scale_send_surveys')
 def send_surveys():
@@ -93,46 +111,38 @@ def send_surveys():
     """
     logger = ptmlog.get_logger()
 
-    logger.info('getting appointments that need surveys sent')
-    table_appointments = appointments_table_utils.get_appointments()
+    # Held from reading the unsent rows to the last send, so two runs never text the same patients
+    with run_lease.hold('send', wait_s=run_lease.get_wait_seconds()) as lease:
+        if lease is None:
+            logger.warning('another run is sending surveys, leaving them to it')
+            return None
 
-    for table_appointment in table_appointments:
-        logger.info('sending survey', patient_name=table_appointment.patient_name)
-        try:
-            message_sid = twilio_utils.send_survey(
-                id            = table_appointment.row_key,
-                patient_name  = table_appointment.patient_name,
-                patient_phone = table_appointment.patient_phone,
-            )
-        except:
-            logger.exception('error sending survey', patient_name=table_appointment.patient_name)
-            continue  # This should not end the process
+        logger.info('getting appointments that need surveys sent')
+        table_appointments = appointments_table_utils.get_appointments()
 
-        logger.info('updating table appointment', patient_name=table_appointment.patient_name)
-        try:
-            appointments_table_utils.update_appointment(
-                row_key       = table_appointment.row_key,
-                partition_key = table_appointment.partition_key,
-                sent_on       = datetime.now(timezone.utc),
-                message_sid   = message_sid,
-            )
-        except:
-            logger.exception('error updating table appointment', patient_name=table_appointment.patient_name)
-            continue  # This should not end the process
+        result = survey_sender.send_surveys_concurrently(table_appointments, lease=lease)
+    memory_profile.checkpoint('phase', 'send')
+    return result
 
 def main():
     logger = ptmlog.get_logger()
+    run_history.install()
+    memory_profile.start()
 
     try:
         sync_appointments()
     except:
         logger.exception('error syncing appointments')
+    # Leases on the scraped dates are held until their rows are written
+    run_lease.release_all('date-')
     
     try:
         send_surveys()
     except:
         logger.exception('error sending surveys')
-        
+
+    memory_profile.log_report()
+    deadlines.log_summary()
 
 
 
@@ -0,0 +1,137 @@
+"""
+Opt-in memory profiling for long syncs and backfills.
+
+With MEMORY_PROFILE=1 (or `backfill.py --profile-memory`), `start()` turns on
+tracemalloc (`MEMORY_PROFILE_FRAMES` frames per allocation) and every
+`checkpoint()` records the traced memory, the traced peak since the previous
+checkpoint and the process RSS. Checkpoints are taken after each scraped date
+and at the phase boundaries of a sync (`scrape`, `parsing`, `table_writes`,
+`send`) and logged as `memory checkpoint` events.
+
+`report()` summarizes the run: the traced growth per date (mean and largest),
+the peak of each phase, and the `MEMORY_PROFILE_TOP` allocation sites that grew
+most since `start()`, from tracemalloc snapshot diffs. With
+`MEMORY_BUDGET_PER_DATE_MB` set, a mean growth per date above it marks the
+report as over budget; `scripts/benchmark_memory.py` exits with status 1 then.
+
+Disabled, `checkpoint()` returns immediately.
+"""
+from typing import Any
+import os
+import resource
+import tracemalloc
+
+from shared import ptmlog
+
+FRAMES_DEFAULT = 1
+TOP_DEFAULT    = 10
+MB             = 1024 * 1024
+
+_checkpoints: list[dict[str, Any]] = []
+_baseline: tracemalloc.Snapshot | None = None
+
+
+def enabled() -> bool:
+    return os.getenv('MEMORY_PROFILE', '0') == '1'
+
+
+def rss_mb() -> float:
+    """Current resident set size, or the peak where /proc is not available."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / MB
+    except OSError:
+        # ru_maxrss is in kilobytes on Linux, bytes on macOS
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _snapshot() -> tracemalloc.Snapshot:
+    return tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+    ))
+
+
+def start() -> None:
+    """Start tracing if MEMORY_PROFILE=1; later checkpoints are measured from here."""
+    global _baseline
+    if not enabled() or tracemalloc.is_tracing():
+        return
+    tracemalloc.start(int(os.getenv('MEMORY_PROFILE_FRAMES', str(FRAMES_DEFAULT))))
+    _checkpoints.clear()
+    _baseline = _snapshot()
+    checkpoint('phase', 'start')
+
+
+def checkpoint(kind: str, label: str) -> None:
+    """Record memory at a `date` or `phase` boundary."""
+    if not tracemalloc.is_tracing():
+        return
+    logger = ptmlog.get_logger()
+
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    point = {
+        'kind'     : kind,
+        'label'    : label,
+        'traced_mb': round(current / MB, 2),
+        'peak_mb'  : round(peak / MB, 2),
+        'rss_mb'   : round(rss_mb(), 2),
+    }
+    if _checkpoints:
+        point['growth_mb'] = round(point['traced_mb'] - _checkpoints[-1]['traced_mb'], 2)
+    _checkpoints.append(point)
+    logger.info('memory checkpoint', **point)
+
+
+def top_sites(limit: int | None = None) -> list[str]:
+    """Allocation sites that grew most since `start()`."""
+    if _baseline is None or not tracemalloc.is_tracing():
+        return []
+    limit = limit or int(os.getenv('MEMORY_PROFILE_TOP', str(TOP_DEFAULT)))
+    return [str(stat) for stat in _snapshot().compare_to(_baseline, 'lineno')[:limit]]
+
+
+def report() -> dict[str, Any]:
+    """Growth per date, peak per phase, top allocation sites and the budget check."""
+    date_growth = [point['growth_mb'] for point in _checkpoints if point['kind'] == 'date' and 'growth_mb' in point]
+    budget = os.getenv('MEMORY_BUDGET_PER_DATE_MB')
+    mean_growth = round(sum(date_growth) / len(date_growth), 2) if date_growth else 0.0
+
+    return {
+        'dates'              : len(date_growth),
+        'growth_per_date_mb' : mean_growth,
+        'max_date_growth_mb' : max(date_growth, default=0.0),
+        'budget_per_date_mb' : float(budget) if budget else None,
+        'over_budget'        : bool(budget) and mean_growth > float(budget),
+        'peak_traced_mb'     : max((point['peak_mb'] for point in _checkpoints), default=0.0),
+        'peak_rss_mb'        : max((point['rss_mb'] for point in _checkpoints), default=0.0),
+        'phases'             : {point['label']: point for point in _checkpoints if point['kind'] == 'phase'},
+        'top_sites'          : top_sites(),
+    }
+
+
+def log_report() -> dict[str, Any] | None:
+    """Log the report, if profiling is on."""
+    if not tracemalloc.is_tracing():
+        return None
+    logger = ptmlog.get_logger()
+    result = report()
+    if result['over_budget']:
+        logger.warning('memory profile', **result)
+    else:
+        logger.info('memory profile', **result)
+    return result
+
+
+def print_report(result: dict[str, Any]) -> None:
+    print(f"\nMemory profile:")
+    print(f"  Growth per date: {result['growth_per_date_mb']:.2f} MB mean, {result['max_date_growth_mb']:.2f} MB max over {result['dates']} dates"
+          + (f" (budget {result['budget_per_date_mb']:.2f} MB{', OVER BUDGET' if result['over_budget'] else ''})" if result['budget_per_date_mb'] is not None else ''))
+    print(f"  Peak: {result['peak_traced_mb']:.1f} MB traced, {result['peak_rss_mb']:.1f} MB RSS")
+    for label, point in result['phases'].items():
+        print(f"  {label:<14} traced {point['traced_mb']:>8.1f} MB  peak {point['peak_mb']:>8.1f} MB  rss {point['rss_mb']:>8.1f} MB")
+    print(f"  Top allocation sites since start:")
+    for site in result['top_sites']:
+        print(f"    {site}")
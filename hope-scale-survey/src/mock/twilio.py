@@ -1,24 +1,307 @@
-from datetime import datetime, timezone
+"""
+Local stand-in for the Twilio Messages API, for benchmarking and soak-testing the send path offline.
+
+Usage (from src/):
+    python -m mock.twilio --port 8089 --latency exponential --latency-ms 150 \
+        --max-per-second 10 --error-rate 0.01 --burst-every-s 60 --burst-duration-s 5
+
+Then point the real client at it:
+    TWILIO_BASE_URL=http://127.0.0.1:8089 python src/main.py
+
+Implements the endpoints `twilio_utils` and `reconcile_delivery_status` use:
+
+    POST /2010-04-01/Accounts/{AccountSid}/Messages.json        create (201, or Twilio-shaped errors)
+    GET  /2010-04-01/Accounts/{AccountSid}/Messages.json        paged list (PageSize, Page, DateSent>)
+    GET  /2010-04-01/Accounts/{AccountSid}/Messages/{Sid}.json  fetch
+    GET  /_emulator/stats                                       request and outcome counts
+
+Every request waits for a latency drawn from the configured distribution.
+Creates over `--max-per-second` (a sliding one-second window) and all creates
+during a periodic 429 burst are rejected with 429 / error 20429 and a
+Retry-After header; `--error-rate` of the remaining creates fail with a 503.
+`To` numbers that are not E.164 are rejected with 400 / error 21211, like the
+real API. Accepted messages move from `queued` to `sent` to `delivered` (or
+`undelivered` with error 30003, at `--undelivered-rate`) as they age.
+"""
+from collections import Counter, deque
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlsplit
+import argparse
+import json
+import math
+import random
+import re
+import threading
+import time
 import uuid
+
+from pydantic import BaseModel
+
 from shared import ptmlog
 
-def process_messages(appointments):
+API_PREFIX         = '/2010-04-01/Accounts/'
+MESSAGES_PATH      = re.compile(r'^/2010-04-01/Accounts/(?P<account_sid>[^/]+)/Messages\.json$')
+MESSAGE_PATH       = re.compile(r'^/2010-04-01/Accounts/(?P<account_sid>[^/]+)/Messages/(?P<sid>[^/]+)\.json$')
+E164               = re.compile(r'^\+[1-9]\d{7,14}$')
+LATENCY_CHOICES    = ['constant', 'uniform', 'exponential', 'lognormal']
+DEFAULT_PAGE_SIZE  = 50
+MAX_PAGE_SIZE      = 1000
+
+
+class EmulatorConfig(BaseModel):
+    latency           : str   = 'lognormal'
+    latency_ms        : float = 150.0  # mean (constant, exponential) or median (lognormal) latency
+    latency_jitter_ms : float = 50.0   # half-width (uniform) or spread (lognormal sigma = jitter / latency)
+    max_per_second    : float = 0.0    # accepted creates per second; 0 disables the cap
+    burst_every_s     : float = 0.0    # start a 429 burst this often; 0 disables bursts
+    burst_duration_s  : float = 0.0
+    retry_after_s     : int   = 1
+    error_rate        : float = 0.0    # share of creates failing with 503
+    undelivered_rate  : float = 0.0
+    delivery_delay_s  : float = 2.0    # age at which a message reaches its final status
+    seed              : int | None = None
+
+
+class MessagesEmulator:
+    """In-memory message store plus the failure model. Safe to share between handler threads."""
+
+    def __init__(self, config: EmulatorConfig) -> None:
+        self.config      = config
+        self.random      = random.Random(config.seed)
+        self.lock        = threading.Lock()
+        self.messages    : dict[str, dict] = {}
+        self.undelivered : set[str] = set()
+        self.accepted_at : deque[float] = deque()
+        self.started     = time.monotonic()
+        self.stats       : Counter[str] = Counter()
+
+    def sample_latency(self) -> float:
+        config = self.config
+        with self.lock:
+            match config.latency:
+                case 'constant':
+                    ms = config.latency_ms
+                case 'uniform':
+                    ms = self.random.uniform(config.latency_ms - config.latency_jitter_ms, config.latency_ms + config.latency_jitter_ms)
+                case 'exponential':
+                    ms = self.random.expovariate(1 / config.latency_ms) if config.latency_ms > 0 else 0
+                case 'lognormal':
+                    sigma = config.latency_jitter_ms / config.latency_ms if config.latency_ms > 0 else 0
+                    ms = config.latency_ms * math.exp(self.random.gauss(0, sigma))
+        return max(0.0, ms) / 1000
+
+    def in_burst(self, now: float) -> bool:
+        config = self.config
+        if config.burst_every_s <= 0 or config.burst_duration_s <= 0:
+            return False
+        return (now - self.started) % config.burst_every_s >= config.burst_every_s - config.burst_duration_s
+
+    def admit(self) -> str | None:
+        """Apply the failure model to a create. Returns None if accepted, else 'throttled' or 'server_error'."""
+        config = self.config
+        now = time.monotonic()
+        with self.lock:
+            if self.in_burst(now):
+                return 'throttled'
+            while self.accepted_at and now - self.accepted_at[0] >= 1:
+                self.accepted_at.popleft()
+            if config.max_per_second and len(self.accepted_at) >= config.max_per_second:
+                return 'throttled'
+            if self.random.random() < config.error_rate:
+                return 'server_error'
+            self.accepted_at.append(now)
+            return None
+
+    def create(self, account_sid: str, form: dict[str, str]) -> dict:
+        now = datetime.now(timezone.utc)
+        sid = 'SM' + uuid.uuid4().hex
+        message = {
+            'account_sid'          : account_sid,
+            'api_version'          : '2010-04-01',
+            'body'                 : form.get('Body', ''),
+            'date_created'         : now,
+            'date_sent'            : now,
+            'date_updated'         : now,
+            'direction'            : 'outbound-api',
+            'error_code'           : None,
+            'error_message'        : None,
+            'from'                 : None,
+            'messaging_service_sid': form.get('MessagingServiceSid'),
+            'num_media'            : '0',
+            'num_segments'         : str(max(1, math.ceil(len(form.get('Body', '')) / 153))),
+            'price'                : None,
+            'price_unit'           : 'USD',
+            'sid'                  : sid,
+            'status'               : 'queued',
+            'to'                   : form.get('To'),
+            'uri'                  : f'{API_PREFIX}{account_sid}/Messages/{sid}.json',
+        }
+        with self.lock:
+            self.messages[sid] = message
+            if self.random.random() < self.config.undelivered_rate:
+                self.undelivered.add(sid)
+        return self.render(message)
+
+    def render(self, message: dict) -> dict:
+        """The message as the API returns it now, with its status advanced by age."""
+        age = (datetime.now(timezone.utc) - message['date_created']).total_seconds()
+        rendered = dict(message)
+        if age >= self.config.delivery_delay_s:
+            if message['sid'] in self.undelivered:
+                rendered.update(status='undelivered', error_code=30003, error_message='Unreachable destination handset')
+            else:
+                rendered['status'] = 'delivered'
+        elif age >= self.config.delivery_delay_s / 2:
+            rendered['status'] = 'sent'
+        for key in ('date_created', 'date_sent', 'date_updated'):
+            rendered[key] = format_datetime(rendered[key], usegmt=True)
+        return rendered
+
+    def list_page(self, account_sid: str, query: dict[str, str]) -> dict:
+        page_size = min(int(query.get('PageSize', DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+        page = int(query.get('Page', 0))
+        sent_after = datetime.fromisoformat(query['DateSent>'].replace('Z', '+00:00')) if query.get('DateSent>') else None
+        sent_before = datetime.fromisoformat(query['DateSent<'].replace('Z', '+00:00')) if query.get('DateSent<') else None
+
+        with self.lock:
+            # Newest first, like the real API
+            matching = [
+                message for message in reversed(self.messages.values())
+                if message['account_sid'] == account_sid
+                and (sent_after is None or message['date_sent'] >= sent_after)
+                and (sent_before is None or message['date_sent'] <= sent_before)
+            ]
+        rows = matching[page * page_size:(page + 1) * page_size]
+
+        base = f'{API_PREFIX}{account_sid}/Messages.json'
+        def page_uri(number: int) -> str:
+            return f'{base}?{urlencode({**query, "PageSize": page_size, "Page": number})}'
+
+        return {
+            'messages'         : [self.render(message) for message in rows],
+            'page'             : page,
+            'page_size'        : page_size,
+            'uri'              : page_uri(page),
+            'first_page_uri'   : page_uri(0),
+            'next_page_uri'    : page_uri(page + 1) if (page + 1) * page_size < len(matching) else None,
+            'previous_page_uri': page_uri(page - 1) if page > 0 else None,
+            'start'            : page * page_size,
+            'end'              : page * page_size + max(len(rows) - 1, 0),
+        }
+
+
+def twilio_error(status: int, code: int, message: str) -> dict:
+    return {'code': code, 'message': message, 'more_info': f'https://www.twilio.com/docs/errors/{code}', 'status': status}
+
+
+class Handler(BaseHTTPRequestHandler):
+    emulator: MessagesEmulator
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real API
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+    def send_json(self, status: int, payload: dict, headers: dict[str, str] | None = None) -> None:
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def respond(self, status: int, payload: dict, headers: dict[str, str] | None = None) -> None:
+        emulator = self.emulator
+        with emulator.lock:
+            emulator.stats['requests'] += 1
+            emulator.stats[f'status_{status}'] += 1
+        time.sleep(emulator.sample_latency())
+        self.send_json(status, payload, headers)
+
+    def do_GET(self) -> None:
+        url = urlsplit(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+
+        if url.path == '/_emulator/stats':
+            with self.emulator.lock:
+                stats = dict(self.emulator.stats, messages=len(self.emulator.messages))
+            self.send_json(200, stats)
+        elif self.headers.get('Authorization') is None:
+            self.respond(401, twilio_error(401, 20003, 'Authenticate'))
+        elif match := MESSAGES_PATH.match(url.path):
+            self.respond(200, self.emulator.list_page(match['account_sid'], query))
+        elif (match := MESSAGE_PATH.match(url.path)) and match['sid'] in self.emulator.messages:
+            self.respond(200, self.emulator.render(self.emulator.messages[match['sid']]))
+        else:
+            self.respond(404, twilio_error(404, 20404, 'The requested resource was not found'))
+
+    def do_POST(self) -> None:
+        url = urlsplit(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        form = {key: values[-1] for key, values in parse_qs(self.rfile.read(length).decode()).items()}
+
+        match = MESSAGES_PATH.match(url.path)
+        if match is None:
+            self.respond(404, twilio_error(404, 20404, 'The requested resource was not found'))
+            return
+        if self.headers.get('Authorization') is None:
+            self.respond(401, twilio_error(401, 20003, 'Authenticate'))
+            return
+        if not E164.match(form.get('To', '')):
+            self.respond(400, twilio_error(400, 21211, f"The 'To' number {form.get('To')} is not a valid phone number."))
+            return
+
+        match self.emulator.admit():
+            case 'throttled':
+                self.respond(429, twilio_error(429, 20429, 'Too Many Requests'), {'Retry-After': str(self.emulator.config.retry_after_s)})
+            case 'server_error':
+                self.respond(503, twilio_error(503, 20503, 'Service Unavailable'))
+            case _:
+                self.respond(201, self.emulator.create(match['account_sid'], form))
+
+
+def serve(config: EmulatorConfig, host: str = '127.0.0.1', port: int = 8089) -> ThreadingHTTPServer:
+    """Start the emulator on a background thread. Stop it with `server.shutdown()`."""
+    handler = type('EmulatorHandler', (Handler,), {'emulator': MessagesEmulator(config)})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='twilio-emulator', daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Emulate the Twilio Messages API locally')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--latency', choices=LATENCY_CHOICES, default='lognormal', help='Latency distribution')
+    parser.add_argument('--latency-ms', type=float, default=150, help='Mean (median for lognormal) response latency')
+    parser.add_argument('--latency-jitter-ms', type=float, default=50, help='Latency spread')
+    parser.add_argument('--max-per-second', type=float, default=0, help='Accepted creates per second before 429s (0 disables)')
+    parser.add_argument('--burst-every-s', type=float, default=0, help='Start a 429 burst this often (0 disables)')
+    parser.add_argument('--burst-duration-s', type=float, default=0, help='Length of each 429 burst')
+    parser.add_argument('--retry-after-s', type=int, default=1, help='Retry-After sent with 429s')
+    parser.add_argument('--error-rate', type=float, default=0, help='Share of creates failing with 503')
+    parser.add_argument('--undelivered-rate', type=float, default=0, help='Share of messages that end undelivered')
+    parser.add_argument('--delivery-delay-s', type=float, default=2, help='Seconds until a message reaches its final status')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
     logger = ptmlog.get_logger()
-    
-    for appointment in appointments:
-        # Simulate creating a survey link
-        link = f'https://mock-survey-link.com/?id={appointment["RowKey"]}'
-        
-        # Create message body
-        message_body = f'Hi {appointment["patientName"].title()}, thank you for visiting us! We hope your recent appointment was helpful. Please take a moment to share your feedback anonymously in our short survey. Your input helps us improve our services. Tap {link} to start. Thank you!'
-
-        # Simulate sending a message
-        mock_message_sid = str(uuid.uuid4())  # Generate a random UUID as a mock message SID
-        
-        logger.info('mock sms sent', sid=mock_message_sid, message_body=message_body, recipient=appointment["patientPhone"])
-
-        # Update appointment with mock data
-        appointment["sentOn"] = datetime.now(timezone.utc)
-        appointment["message_sid"] = mock_message_sid
-
-    return appointments
\ No newline at end of file
+    config = EmulatorConfig(**{key: value for key, value in vars(args).items() if key not in ('host', 'port')})
+    server = serve(config, args.host, args.port)
+    logger.info('twilio emulator listening', url=f'http://{args.host}:{args.port}', **config.model_dump())
+
+    try:
+        while True:
+            time.sleep(60)
+            logger.info('twilio emulator stats', **server.RequestHandlerClass.emulator.stats)
+    except KeyboardInterrupt:
+        server.shutdown()
+        logger.info('twilio emulator stopped', **server.RequestHandlerClass.emulator.stats)
+
+
+if __name__ == '__main__':
+    main()
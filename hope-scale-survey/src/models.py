@@ -11,7 +11,8 @@ class PracticeFusionAppointment(BaseModel):
     type               : str
 
 class TableAppointment(BaseModel): 
-    row_key       : str
-    partition_key : str
-    patient_name  : str
-    patient_phone : str
+    row_key          : str
+    partition_key    : str
+    patient_name     : str
+    patient_phone    : str
+    appointment_time : datetime | None = None  # Eastern wall-clock time, as written by sync
@@ -0,0 +1,147 @@
+"""
+Phone number normalization and the cache of numbers known to be unsendable.
+
+Practice Fusion phone numbers are stored as bare digits (they are part of the
+appointment row key, so the stored form never changes). Before sending, they
+are normalized to E.164 with North American Numbering Plan rules, and numbers
+that cannot exist are rejected without an API call. Numbers Twilio has
+rejected permanently (invalid, landline, opted out) are remembered across runs
+in the `bad-phone-numbers` blob container, next to the other state the container
+job keeps between runs, so they are not tried again.
+"""
+from datetime import datetime, timedelta, timezone
+import json
+import os
+import re
+import threading
+
+from azure.core.exceptions import ResourceNotFoundError
+
+from shared import ptmlog
+from storage_backends import get_blob_store
+
+# Twilio error codes that mean this number will never receive a survey
+BAD_NUMBER_ERROR_CODES = {
+    21211: 'invalid_number',      # Invalid 'To' phone number
+    21214: 'unreachable_number',  # 'To' phone number cannot be reached
+    21610: 'opted_out',           # Recipient replied STOP
+    21614: 'not_mobile',          # 'To' number is not a valid mobile number
+    30005: 'unknown_destination', # Unknown destination handset (delivery)
+    30006: 'landline',            # Landline or unreachable carrier (delivery)
+}
+
+BAD_NUMBER_TTL_DAYS_DEFAULT = 180
+
+CONTAINER_NAME = 'bad-phone-numbers'
+BLOB_NAME      = 'bad_phone_numbers.json'
+
+
+class InvalidPhoneNumber(ValueError):
+    def __init__(self, reason: str, phone: str) -> None:
+        super().__init__(f'{reason}: {phone!r}')
+        self.reason = reason
+
+
+def normalize_phone(phone: str) -> str:
+    """
+    E.164 form of a US/Canada number given as digits with or without the leading 1.
+    Raises InvalidPhoneNumber when the number cannot be a real NANP number.
+    """
+    digits = re.sub(r'\D', '', phone or '')
+    if not digits:
+        raise InvalidPhoneNumber('empty', phone)
+    if len(digits) == 11 and digits[0] == '1':
+        digits = digits[1:]
+    if len(digits) != 10:
+        raise InvalidPhoneNumber('wrong_length', phone)
+
+    area_code, exchange, line = digits[:3], digits[3:6], digits[6:]
+    if area_code[0] in '01' or area_code[1:] == '11':
+        raise InvalidPhoneNumber('invalid_area_code', phone)
+    if exchange[0] in '01' or exchange[1:] == '11':
+        raise InvalidPhoneNumber('invalid_exchange', phone)
+    if exchange == '555' and line.startswith('01'):
+        raise InvalidPhoneNumber('fictional_number', phone)
+
+    return f'+1{digits}'
+
+
+def _download_numbers(ttl: timedelta) -> dict[str, dict]:
+    """The cached numbers recorded within `ttl`; empty if there is no cache yet."""
+    try:
+        numbers = json.loads(get_blob_store().download_blob(CONTAINER_NAME, BLOB_NAME))
+    except ResourceNotFoundError:
+        return {}
+    cutoff = datetime.now(timezone.utc) - ttl
+    return {
+        number: entry
+        for number, entry in numbers.items()
+        if datetime.fromisoformat(entry['recorded_on']) >= cutoff
+    }
+
+
+class BadPhoneNumbers:
+    """
+    E.164 numbers that Twilio rejected permanently, with the reason, kept in blob storage.
+    Entries expire after `BAD_PHONE_NUMBERS_TTL_DAYS`, since numbers are reassigned
+    and patients can opt back in. Safe to update from several send workers.
+    """
+
+    def __init__(self, numbers: dict[str, dict], ttl: timedelta) -> None:
+        self.numbers = numbers
+        self.ttl     = ttl
+        self.added   : dict[str, dict] = {}
+        self.lock    = threading.Lock()
+
+    @classmethod
+    def load(cls) -> 'BadPhoneNumbers':
+        logger = ptmlog.get_logger()
+        ttl = timedelta(days=int(os.getenv('BAD_PHONE_NUMBERS_TTL_DAYS', str(BAD_NUMBER_TTL_DAYS_DEFAULT))))
+        try:
+            numbers = _download_numbers(ttl)
+        except Exception as e:
+            # Sending still works without the cache; known-bad numbers just cost an API call
+            logger.warning('error loading bad phone numbers, starting empty', error=str(e))
+            numbers = {}
+        logger.debug('loaded bad phone numbers', count=len(numbers))
+        return cls(numbers, ttl)
+
+    def add(self, phone: str, reason: str, error_code: int | None = None) -> None:
+        with self.lock:
+            self.numbers[phone] = self.added[phone] = {
+                'reason'     : reason,
+                'error_code' : error_code,
+                'recorded_on': datetime.now(timezone.utc).isoformat(),
+            }
+
+    def reason(self, phone: str) -> str | None:
+        entry = self.numbers.get(phone)
+        return entry['reason'] if entry else None
+
+    def save(self) -> None:
+        """Write the numbers added by this run, merged into the stored cache so other runs' additions are kept."""
+        logger = ptmlog.get_logger()
+        with self.lock:
+            added = dict(self.added)
+            self.added.clear()
+        if not added:
+            return
+        try:
+            numbers = {**_download_numbers(self.ttl), **added}
+            get_blob_store().upload_blob(
+                container = CONTAINER_NAME,
+                name      = BLOB_NAME,
+                data      = json.dumps(numbers, indent=1, sort_keys=True),
+                overwrite = True,
+            )
+        except Exception:
+            with self.lock:
+                self.added = {**added, **self.added}
+            raise
+        logger.info('saved bad phone numbers', added=len(added), count=len(numbers))
+
+    def __contains__(self, phone: str) -> bool:
+        return phone in self.numbers
+
+    def __len__(self) -> int:
+        return len(self.numbers)
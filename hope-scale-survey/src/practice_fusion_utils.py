@@ -2,16 +2,24 @@ import asyncio
 import re
 import os
 from datetime import datetime, date
+from typing import Awaitable, Callable
 from zoneinfo import ZoneInfo
 
 from bs4 import BeautifulSoup
 from playwright.async_api import (
     async_playwright,
+    BrowserContext,
     Page,
     TimeoutError as PlaywrightTimeoutError,
 )
 
 import callharbor_utils
+import deadlines
+import memory_profile
+import run_lease
+import step_timeouts
+from deadlines import PhaseDeadlineExceeded
+from debug_recorder import DebugRecorder
 from models import PracticeFusionAppointment
 from shared import ptmlog
 from storage_state_persistence_utils import save_playwright_storage_state, get_playwright_storage_state, delete_playwright_storage_state
@@ -24,6 +32,9 @@ SECURITY_CHECK_URL = 'https://static.practicefusion.com/apps/ehr/index.html#/log
 MAIN_PAGE_URL      = 'https://static.practicefusion.com/apps/ehr/index.html#/PF/home/main'
 SCHEDULE_URL       = 'https://static.practicefusion.com/apps/ehr/index.html#/PF/schedule/scheduler/agenda'
 
+# Time allowed for saving a screenshot, HTML or session state after a failure or deadline
+ARTIFACT_TIMEOUT_SECONDS = 30
+
 
 class SessionExpiredError(Exception):
     """Raised when the cached session is expired or invalid."""
@@ -42,7 +53,8 @@ async def validate_session(page: Page) -> bool:
     
     try:
         # Try to navigate to the main page
-        await page.goto(MAIN_PAGE_URL, wait_until="domcontentloaded", timeout=30000)
+        await step_timeouts.run_step('session_page', 30000,
+            lambda timeout_ms: page.goto(MAIN_PAGE_URL, wait_until="domcontentloaded", timeout=timeout_ms))
         await page.wait_for_timeout(2000)  # Give the SPA time to redirect if needed
         
         current_url = page.url
@@ -83,6 +95,7 @@ async def validate_session(page: Page) -> bool:
         return False
 
 
+@ptmlog.span('mfa')
 async def handle_mfa(page: Page):
     await page.locator('#sendCallButton').click()
     await page.wait_for_timeout(30_000)  # Wait for the MFA code to be sent
@@ -91,29 +104,20 @@ async def handle_mfa(page: Page):
     await page.click('#sendCodeButton')
 
 
-async def perform_credential_login(page: Page) -> None:
+async def perform_credential_login(page: Page, recorder: DebugRecorder) -> None:
     """
     Perform a fresh login using credentials and handle MFA if required.
     This is called when session validation fails or force_fresh_login is True.
     """
     logger = ptmlog.get_logger()
-    DEBUG_HTML: bool = os.getenv('DEBUG_HTML', 'FALSE') == 'TRUE'
-    
+
     PRACTICEFUSION_USERNAME = os.environ['PRACTICEFUSION_USERNAME']
     PRACTICEFUSION_PASSWORD = os.environ['PRACTICEFUSION_PASSWORD']
 
     logger.info('performing credential login to practice fusion')
     await page.goto(LOGIN_URL, wait_until="domcontentloaded")
     
-    # Save HTML at initial login page load
-    if DEBUG_HTML:
-        try:
-            html_content = await page.content()
-            with open('./screenshots/00_initial_login_page.html', 'w') as f:
-                f.write(html_content)
-            logger.info('saved initial login page HTML')
-        except:
-            logger.warning('failed to save initial login page HTML')
+    await recorder.snapshot(page, '00_initial_login_page')
 
     # Fill out credentials and click login button
     await page.locator('#inputUsername').fill(PRACTICEFUSION_USERNAME)
@@ -123,61 +127,29 @@ async def perform_credential_login(page: Page) -> None:
     # Wait for the URL to change to the main page or the MFA page
     await page.wait_for_url(re.compile(r'(#\/login\/securitycheck|#\/PF\/home\/main)$'))
     
-    # Save HTML after login attempt
-    if DEBUG_HTML:
-        try:
-            html_content = await page.content()
-            with open('./screenshots/00_after_login_click.html', 'w') as f:
-                f.write(html_content)
-            logger.info('saved HTML after login click')
-        except:
-            logger.warning('failed to save HTML after login click')
-    
+    await recorder.snapshot(page, '00_after_login_click')
+
     if page.url.endswith('#/login/securitycheck'):
         logger.info('practice fusion mfa page detected, handling mfa')
+        ptmlog.increment_metric('mfa_prompts')
         
-        # Save HTML at MFA page
-        if DEBUG_HTML:
-            try:
-                html_content = await page.content()
-                with open('./screenshots/00_mfa_page.html', 'w') as f:
-                    f.write(html_content)
-                logger.info('saved MFA page HTML')
-            except:
-                logger.warning('failed to save MFA page HTML')
-        
+        await recorder.snapshot(page, '00_mfa_page')
         await handle_mfa(page)
-        
-        # Save HTML after MFA
-        if DEBUG_HTML:
-            try:
-                html_content = await page.content()
-                with open('./screenshots/00_after_mfa.html', 'w') as f:
-                    f.write(html_content)
-                logger.info('saved HTML after MFA')
-            except:
-                logger.warning('failed to save HTML after MFA')
+        await recorder.snapshot(page, '00_after_mfa')
 
     # If we are still not on the main page, something has gone wrong
     try:
         await page.wait_for_url(MAIN_PAGE_URL)
     except PlaywrightTimeoutError:
         logger.exception('timed out waiting for main page after login', actual_url=page.url)
-        # Save HTML on error
-        if DEBUG_HTML:
-            try:
-                html_content = await page.content()
-                with open('./screenshots/00_login_error.html', 'w') as f:
-                    f.write(html_content)
-                logger.info('saved HTML on login error')
-            except:
-                pass
+        await recorder.snapshot(page, '00_login_error')
         raise
 
     logger.info('credential login successful')
 
 
-async def login(page: Page, skip_session_validation: bool = False) -> None:
+@ptmlog.span('login')
+async def login(page: Page, recorder: DebugRecorder, skip_session_validation: bool = False) -> None:
     """
     Login to Practice Fusion, using cached session if valid.
     
@@ -186,32 +158,52 @@ async def login(page: Page, skip_session_validation: bool = False) -> None:
     
     Args:
         page: Playwright page object
+        recorder: Debug snapshot recorder of the scrape
         skip_session_validation: If True, skip validation and go straight to credential login
     """
     logger = ptmlog.get_logger()
-    DEBUG_HTML: bool = os.getenv('DEBUG_HTML', 'FALSE') == 'TRUE'
     logger.info('logging into practice fusion')
 
-    if skip_session_validation:
-        logger.info('skipping session validation, performing fresh credential login')
-        await perform_credential_login(page)
-        return
+    # One run logs in at a time; another waits (within the login deadline) and reuses its session
+    async with deadlines.phase('login'), run_lease.hold_async('sync', wait_s=None):
+        if skip_session_validation:
+            logger.info('skipping session validation, performing fresh credential login')
+            ptmlog.record_metric('session_reused', False)
+            await perform_credential_login(page, recorder)
+        else:
+            await load_shared_session(page)
 
-    # First, validate if the cached session is still valid
-    session_valid = await validate_session(page)
-    
-    if session_valid:
-        logger.info('cached session is valid, skipping credential login')
-        # Navigate to main page to ensure we're in a good state
-        await page.goto(MAIN_PAGE_URL, wait_until="domcontentloaded")
-    else:
-        logger.warning('cached session is invalid or expired, performing fresh credential login')
-        await perform_credential_login(page)
+            # First, validate if the cached session is still valid
+            session_valid = await validate_session(page)
+            ptmlog.record_metric('session_reused', session_valid)
+
+            if session_valid:
+                logger.info('cached session is valid, skipping credential login')
+                # Navigate to main page to ensure we're in a good state
+                await page.goto(MAIN_PAGE_URL, wait_until="domcontentloaded")
+            else:
+                logger.warning('cached session is invalid or expired, performing fresh credential login')
+                await perform_credential_login(page, recorder)
+
+        # Saved while the lease is held, so the next run to log in finds this session
+        try:
+            async with asyncio.timeout(ARTIFACT_TIMEOUT_SECONDS):
+                save_playwright_storage_state('practicefusion', await page.context.storage_state())
+        except Exception as e:
+            logger.warning('failed to save session state after login', error=str(e))
 
     logger.info('successfully logged in to practice fusion')
 
 
-async def set_schedule_page_to_date(page: Page, target_date: date) -> None:
+async def load_shared_session(page: Page) -> None:
+    """Add the cookies of the saved session, which another run may have logged in since `page` was opened."""
+    storage_state = get_playwright_storage_state('practicefusion')
+    if storage_state and storage_state.get('cookies'):
+        await page.context.add_cookies(storage_state['cookies'])
+
+
+@ptmlog.span('date_navigation')
+async def set_schedule_page_to_date(page: Page, target_date: date, recorder: DebugRecorder) -> None:
     """
     Set the schedule page to the specified date by going back the calculated number of days.
     Expects a playwright page that has already logged into Practice Fusion.
@@ -222,20 +214,12 @@ async def set_schedule_page_to_date(page: Page, target_date: date) -> None:
     logger.info('setting schedule page to default state')
     await page.goto(SCHEDULE_URL, wait_until="domcontentloaded")
     
-    # Save HTML after navigating to schedule URL
-    DEBUG_HTML: bool = os.getenv('DEBUG_HTML', 'FALSE') == 'TRUE'
-    if DEBUG_HTML:
-        try:
-            html_content = await page.content()
-            with open('./screenshots/02_schedule_url_loaded.html', 'w') as f:
-                f.write(html_content)
-            logger.info('saved HTML after schedule URL load')
-        except:
-            logger.warning('failed to save HTML after schedule URL load')
+    await recorder.snapshot(page, f'02_schedule_url_loaded_{target_date}')
 
     # Ensure we actually landed on the schedule page; if not, try UI navigation fallback
     try:
-        await page.wait_for_url(re.compile(r'.*#/PF/schedule/scheduler/agenda.*'), timeout=15000)
+        await step_timeouts.run_step('schedule_url', 15000,
+            lambda timeout_ms: page.wait_for_url(re.compile(r'.*#/PF/schedule/scheduler/agenda.*'), timeout=timeout_ms))
     except PlaywrightTimeoutError:
         logger.warning('schedule URL not loaded via direct route; attempting UI navigation to schedule')
         navigation_succeeded = False
@@ -249,15 +233,18 @@ async def set_schedule_page_to_date(page: Page, target_date: date) -> None:
                     await page.get_by_role('link', name=re.compile('schedule', re.IGNORECASE)).first.click()
 
                 await page.wait_for_load_state('domcontentloaded')
-                await page.wait_for_url(re.compile(r'.*#/PF/schedule/scheduler/agenda.*'), timeout=20000)
+                async with step_timeouts.step('schedule_url_fallback', 20000) as timeout_ms:
+                    await page.wait_for_url(re.compile(r'.*#/PF/schedule/scheduler/agenda.*'), timeout=timeout_ms)
                 navigation_succeeded = True
                 break
             except PlaywrightTimeoutError:
                 logger.warning(f'attempt {attempt + 1} to navigate to schedule via UI failed; retrying')
-                await page.wait_for_timeout(3000)
+                ptmlog.increment_metric('navigation_retries')
+                await page.wait_for_timeout(step_timeouts.get_retry_delay('schedule_url_fallback', 3000))
             except Exception:
                 logger.warning(f'unexpected error during schedule UI navigation attempt {attempt + 1}; retrying')
-                await page.wait_for_timeout(3000)
+                ptmlog.increment_metric('navigation_retries')
+                await page.wait_for_timeout(step_timeouts.get_retry_delay('schedule_url_fallback', 3000))
 
         if not navigation_succeeded:
             logger.error('failed to navigate to schedule page via UI fallback')
@@ -265,7 +252,8 @@ async def set_schedule_page_to_date(page: Page, target_date: date) -> None:
 
     # Wait for the schedule page to fully load
     try:
-        await page.wait_for_selector('#date-picker-button', timeout=15000)
+        await step_timeouts.run_step('date_picker', 15000,
+            lambda timeout_ms: page.wait_for_selector('#date-picker-button', timeout=timeout_ms))
         await page.wait_for_timeout(2000)  # Allow SPA to settle
     except PlaywrightTimeoutError:
         logger.warning('date picker button not found, continuing anyway')
@@ -300,11 +288,13 @@ async def set_schedule_page_to_date(page: Page, target_date: date) -> None:
             
             if days_difference > 0:
                 logger.info(f'going back {days_difference} days from current date to reach {target_date}')
-                await page.wait_for_selector('button.rotate-180', timeout=30000)
+                await step_timeouts.run_step('back_button', 30000,
+                    lambda timeout_ms: page.wait_for_selector('button.rotate-180', timeout=timeout_ms))
                 
                 for i in range(days_difference):
                     # Use JavaScript click to ensure the event fires
                     await page.evaluate('document.querySelector("button.rotate-180").click()')
+                    ptmlog.increment_metric('back_clicks')
                     await page.wait_for_timeout(1500)
                     logger.debug(f'clicked back button {i+1}/{days_difference}')
         
@@ -319,16 +309,8 @@ async def set_schedule_page_to_date(page: Page, target_date: date) -> None:
                 logger.info('current date header', date_text=date_text, target_date=str(target_date))
         except Exception as e:
             logger.debug('could not read date header', error=str(e))
-        
-        # Save HTML after date navigation
-        if DEBUG_HTML:
-            try:
-                html_content = await page.content()
-                with open(f'./screenshots/02_after_date_navigation_{target_date}.html', 'w') as f:
-                    f.write(html_content)
-                logger.info('saved HTML after date navigation', target_date=target_date)
-            except:
-                logger.warning('failed to save HTML after date navigation')
+
+        await recorder.snapshot(page, f'02_after_date_navigation_{target_date}')
     except PlaywrightTimeoutError:
         logger.error("Timeout during date navigation")
         raise
@@ -337,25 +319,20 @@ async def set_schedule_page_to_date(page: Page, target_date: date) -> None:
         raise
 
 
-async def get_schedule_page(page: Page, target_date: date) -> str:
+@ptmlog.span('schedule_page')
+async def get_schedule_page(page: Page, target_date: date, recorder: DebugRecorder) -> str:
     logger = ptmlog.get_logger()
-    DEBUG_HTML: bool = os.getenv('DEBUG_HTML', 'FALSE') == 'TRUE'
     logger.info('getting schedule page content', target_date=target_date)
 
     # Set the schedule page to the target date
-    await set_schedule_page_to_date(page, target_date)
+    await set_schedule_page_to_date(page, target_date, recorder)
     
     try:
         # Wait for a specific element that indicates the schedule is loaded
-        await page.wait_for_selector('div[data-element="appointments-table"]', state='visible', timeout=45000)
+        await step_timeouts.run_step('appointments_table', 45000,
+            lambda timeout_ms: page.wait_for_selector('div[data-element="appointments-table"]', state='visible', timeout=timeout_ms))
         logger.info('appointments table loaded')
-        
-        # Save HTML after navigating to the date
-        if DEBUG_HTML:
-            logger.info('saving HTML after date navigation', target_date=target_date)
-            html_content = await page.content()
-            with open(f'./screenshots/02_after_date_navigation_{target_date}.html', 'w') as f:
-                f.write(html_content)
+        await recorder.snapshot(page, f'02_appointments_table_loaded_{target_date}')
 
         # Check the "All" checkbox to ensure all users' appointments are shown
         try:
@@ -372,26 +349,29 @@ async def get_schedule_page(page: Page, target_date: date) -> str:
         except Exception as e:
             logger.warning('could not check All users checkbox', error=str(e))
 
-        # Open the print view with retries and explicit wait for visibility
-        for attempt in range(3):
-            try:
-                print_button = page.get_by_text('Print')
-                await print_button.wait_for(state='visible', timeout=10000)
-                await print_button.click()
-                logger.info('successfully clicked print button')
+        with ptmlog.span('print_rendering'):
+            # Open the print view with retries and explicit wait for visibility
+            for attempt in range(3):
+                try:
+                    print_button = page.get_by_text('Print')
+                    async with step_timeouts.step('print_button', 10000) as timeout_ms:
+                        await print_button.wait_for(state='visible', timeout=timeout_ms)
+                    await print_button.click()
+                    logger.info('successfully clicked print button')
                 
-                # Wait for the print table to be populated with the current date's data
-                await page.wait_for_timeout(3000)
-                break
-            except PlaywrightTimeoutError:
-                logger.warning(f'attempt {attempt + 1} to click print button failed. Retrying...')
-                await page.wait_for_timeout(5000)
-        else:
-            logger.error('failed to click print button after multiple attempts.')
-            raise Exception('failed to click print button after multiple attempts')
+                    # Wait for the print table to be populated with the current date's data
+                    await page.wait_for_timeout(3000)
+                    break
+                except PlaywrightTimeoutError:
+                    logger.warning(f'attempt {attempt + 1} to click print button failed. Retrying...')
+                    ptmlog.increment_metric('print_retries')
+                    await page.wait_for_timeout(step_timeouts.get_retry_delay('print_button', 5000))
+            else:
+                logger.error('failed to click print button after multiple attempts.')
+                raise Exception('failed to click print button after multiple attempts')
             
-        content = await page.content()
-        logger.info('successfully retrieved schedule page content', target_date=target_date)
+            content = await page.content()
+            logger.info('successfully retrieved schedule page content', target_date=target_date)
 
     except PlaywrightTimeoutError:
         logger.error(f"Timeout waiting for schedule page elements. Current URL: {page.url}, Title: {await page.title()}")
@@ -400,10 +380,59 @@ async def get_schedule_page(page: Page, target_date: date) -> str:
     return content
 
 
+async def save_error_artifacts(page: Page, prefix: str) -> None:
+    """Save a screenshot and the HTML of `page` under ./screenshots, bounded in time in case the browser is stuck."""
+    logger = ptmlog.get_logger()
+    try:
+        async with asyncio.timeout(ARTIFACT_TIMEOUT_SECONDS):
+            await page.screenshot(path=f'./screenshots/{prefix}_screenshot.png')
+            logger.error('saving error HTML', prefix=prefix)
+            html_content = await page.content()
+            with open(f'./screenshots/{prefix}_page.html', 'w') as f:
+                f.write(html_content)
+    except Exception:
+        logger.warning('failed to save error screenshot/HTML', prefix=prefix)
+
+
+async def collect_schedule_pages(page: Page, target_dates: list[date], schedule_pages: list[str], recorder: DebugRecorder) -> None:
+    """
+    Append the schedule page of each date to `schedule_pages`. A date that runs past its
+    deadline is skipped (after saving diagnostics) and the next date is tried. A date whose
+    lease another run holds is skipped too; the leases of collected dates stay held.
+    """
+    logger = ptmlog.get_logger()
+
+    for target_date in target_dates:
+        # Held until the caller has written the date's rows (run_lease.release_all)
+        if await run_lease.acquire_async(f'date-{target_date}') is None:
+            logger.warning('skipping date leased by another run', target_date=target_date)
+            ptmlog.increment_metric('dates_leased_elsewhere')
+            memory_profile.checkpoint('date', str(target_date))
+            continue
+        try:
+            async with deadlines.phase('schedule_page', target_date=str(target_date)):
+                schedule_page = await get_schedule_page(page, target_date, recorder)
+        except PhaseDeadlineExceeded:
+            logger.warning('skipping date after schedule page deadline', target_date=target_date)
+            ptmlog.increment_metric('dates_timed_out')
+            await save_error_artifacts(page, f'deadline_schedule_page_{target_date}')
+            await asyncio.to_thread(run_lease.release_all, f'date-{target_date}')
+            memory_profile.checkpoint('date', str(target_date))
+            continue
+        schedule_pages.append(schedule_page)
+        recorder.add(f'03_schedule_page_{target_date}', schedule_page)
+        memory_profile.checkpoint('date', str(target_date))
+
+
 async def get_schedule_pages(target_dates: list[date]) -> list[str]:
+    """
+    Log in and collect the schedule page of each date in one browser session.
+    If the scrape deadline passes, the pages collected so far are returned; a login
+    that runs past its deadline raises PhaseDeadlineExceeded.
+    """
     HEADLESS: bool = os.getenv('HEADLESS', 'TRUE') == 'TRUE'
-    DEBUG_HTML: bool = os.getenv('DEBUG_HTML', 'FALSE') == 'TRUE'
     logger = ptmlog.get_logger()
+    recorder = DebugRecorder.from_env()
     
     schedule_pages: list[str] = []
     async with async_playwright() as pw:
@@ -418,68 +447,179 @@ async def get_schedule_pages(target_dates: list[date]) -> list[str]:
         
         context = await browser.new_context(storage_state=storage_state)
         page = await context.new_page()
+        outcome = 'completed'
         
         try:
-            await login(page)
-            
-            # Save HTML after login for debugging
-            if DEBUG_HTML:
-                logger.info('saving post-login HTML')
-                html_content = await page.content()
+            async with deadlines.phase('scrape', dates=len(target_dates)):
                 try:
-                    with open('./screenshots/01_after_login.html', 'w') as f:
-                        f.write(html_content)
-                except:
-                    logger.warning('failed to save HTML to local file')
-            
-            for i, target_date in enumerate(target_dates):
-                schedule_page = await get_schedule_page(page, target_date)
-                schedule_pages.append(schedule_page)
-                
-                # Save the schedule page HTML for debugging
-                if DEBUG_HTML:
-                    logger.info('saving schedule page HTML', target_date=target_date)
-                    with open(f'./screenshots/03_schedule_page_{target_date}.html', 'w') as f:
-                        f.write(schedule_page)
-                        
-        except SessionExpiredError:
-            # Session expired during operation - clear cached state and retry with fresh login
-            logger.warning('session expired during operation, clearing cached state and retrying')
-            await context.close()
-            delete_playwright_storage_state('practicefusion')
-            
-            # Create new context without cached state
-            context = await browser.new_context()
-            page = await context.new_page()
-            
-            # Perform fresh login (skip session validation since we know it's invalid)
-            await login(page, skip_session_validation=True)
-            
-            # Retry getting schedule pages
-            for i, target_date in enumerate(target_dates):
-                schedule_page = await get_schedule_page(page, target_date)
-                schedule_pages.append(schedule_page)
-                
+                    await login(page, recorder)
+                    await recorder.snapshot(page, '01_after_login')
+                    memory_profile.checkpoint('phase', 'login')
+                    await collect_schedule_pages(page, target_dates, schedule_pages, recorder)
+
+                except SessionExpiredError:
+                    # Session expired during operation - clear cached state and retry with fresh login
+                    logger.warning('session expired during operation, clearing cached state and retrying')
+                    await context.close()
+                    delete_playwright_storage_state('practicefusion')
+
+                    # Create new context without cached state
+                    context = await browser.new_context()
+                    page = await context.new_page()
+
+                    # Perform fresh login (skip session validation since we know it's invalid)
+                    await login(page, recorder, skip_session_validation=True)
+                    memory_profile.checkpoint('phase', 'login')
+
+                    # Retry getting schedule pages
+                    await collect_schedule_pages(page, target_dates, schedule_pages, recorder)
+
+        except PhaseDeadlineExceeded as e:
+            outcome = f'deadline_{e.phase}'
+            await save_error_artifacts(page, outcome)
+            if e.phase != 'scrape':
+                raise
+            logger.warning('scrape deadline exceeded, keeping the schedule pages collected so far',
+                collected = len(schedule_pages),
+                dates     = len(target_dates),
+            )
         except Exception:
-            try:
-                await page.screenshot(path='./screenshots/error_screenshot.png')
-                # Always save HTML on error
-                logger.error('saving error HTML')
-                html_content = await page.content()
-                with open('./screenshots/error_page.html', 'w') as f:
-                    f.write(html_content)
-            except:
-                logger.warning('failed to save error screenshot/HTML')
+            # Always save HTML on error
+            outcome = 'error'
+            await save_error_artifacts(page, outcome)
             raise
         finally:
-            # Always save the current session state for future runs
+            await finish_scrape(context, recorder, outcome)
+    
+    return schedule_pages
+
+
+async def get_schedule_pages_chunked(
+    chunks: dict[int, list[date]],
+    workers: int,
+    on_chunk: Callable[[int, list[str]], Awaitable[None]],
+    on_failure: Callable[[int, str], Awaitable[None]],
+) -> None:
+    """
+    Log in once, then collect the schedule pages of each chunk of dates on `workers` pages
+    that share the session. `on_chunk(key, schedule_pages)` is awaited as each chunk completes.
+    A chunk that fails, or misses a date to the schedule page deadline, is reported with
+    `on_failure(key, error)` and its worker logs in again before taking the next chunk; a
+    worker whose login fails stops, and the chunks no worker took are left alone.
+    If the scrape deadline passes, the chunks not finished by then are left alone; a login
+    that runs past its deadline raises PhaseDeadlineExceeded.
+    """
+    HEADLESS: bool = os.getenv('HEADLESS', 'TRUE') == 'TRUE'
+    logger = ptmlog.get_logger()
+    recorder = DebugRecorder.from_env()
+
+    queue: asyncio.Queue[int] = asyncio.Queue()
+    for key in chunks:
+        queue.put_nowait(key)
+
+    async with async_playwright() as pw:
+        browser = await pw.chromium.launch(headless=HEADLESS)
+
+        storage_state = get_playwright_storage_state('practicefusion')
+        context = await browser.new_context(storage_state=storage_state)
+        page = await context.new_page()
+        outcome = 'completed'
+        # Workers open their pages from the latest logged-in state; one of them logs in again at a time
+        session = {'storage_state': None}
+        session_lock = asyncio.Lock()
+
+        async def worker() -> None:
+            worker_context = await browser.new_context(storage_state=session['storage_state'])
+            worker_page = await worker_context.new_page()
             try:
+                while not queue.empty():
+                    key = queue.get_nowait()
+                    schedule_pages: list[str] = []
+                    try:
+                        await collect_schedule_pages(worker_page, chunks[key], schedule_pages, recorder)
+                    except PhaseDeadlineExceeded:
+                        raise
+                    except Exception as e:
+                        logger.exception('error collecting chunk', chunk=key, error=str(e))
+                        await save_error_artifacts(worker_page, f'error_chunk_{key}')
+                        error = str(e) or type(e).__name__
+                    else:
+                        if len(schedule_pages) == len(chunks[key]):
+                            await on_chunk(key, schedule_pages)
+                            continue
+                        error = f'{len(chunks[key]) - len(schedule_pages)} dates past the schedule page deadline or leased by another run'
+
+                    try:
+                        async with session_lock:
+                            await worker_context.close()
+                            worker_context = await browser.new_context(storage_state=session['storage_state'])
+                            worker_page = await worker_context.new_page()
+                            await login(worker_page, recorder)
+                            session['storage_state'] = await worker_context.storage_state()
+                    except PhaseDeadlineExceeded:
+                        await on_failure(key, error)
+                        raise
+                    except Exception as e:
+                        # Only this worker stops; the others carry on and what is left stays pending
+                        logger.exception('error logging in again after a failed chunk, stopping worker', chunk=key, error=str(e))
+                        await on_failure(key, f'{error}; logging in again failed: {str(e) or type(e).__name__}')
+                        return
+                    await on_failure(key, error)
+            finally:
+                await worker_context.close()
+
+        try:
+            async with deadlines.phase('scrape', dates=sum(len(dates) for dates in chunks.values())):
+                await login(page, recorder)
+                await recorder.snapshot(page, '01_after_login')
+                memory_profile.checkpoint('phase', 'login')
+                session['storage_state'] = await context.storage_state()
+
+                tasks = [ptmlog.create_task(worker(), worker=number) for number in range(min(workers, len(chunks)))]
+                try:
+                    await asyncio.gather(*tasks)
+                finally:
+                    for task in tasks:
+                        task.cancel()
+                    await asyncio.gather(*tasks, return_exceptions=True)
+
+        except PhaseDeadlineExceeded as e:
+            outcome = f'deadline_{e.phase}'
+            await save_error_artifacts(page, outcome)
+            if e.phase != 'scrape':
+                raise
+            logger.warning('scrape deadline exceeded, leaving the remaining chunks for a later run', unfinished=queue.qsize())
+        except Exception:
+            outcome = 'error'
+            await save_error_artifacts(page, outcome)
+            raise
+        finally:
+            await finish_scrape(context, recorder, outcome)
+
+
+async def finish_scrape(context: BrowserContext, recorder: DebugRecorder, outcome: str) -> None:
+    """Write out the debug snapshots, and save the session state and step latencies for future runs."""
+    logger = ptmlog.get_logger()
+    # Debug snapshots are only written out now, so recording them never slows the scrape
+    try:
+        async with asyncio.timeout(ARTIFACT_TIMEOUT_SECONDS):
+            await recorder.flush(outcome)
+    except Exception as e:
+        logger.warning('failed to flush debug snapshots', error=str(e))
+    # Always save the current session state for future runs, unless another run is logging in
+    try:
+        async with asyncio.timeout(ARTIFACT_TIMEOUT_SECONDS), run_lease.hold_async('sync') as lease:
+            if lease is None:
+                logger.info('another run is logging in, leaving the session state to it')
+            else:
                 save_playwright_storage_state('practicefusion', await context.storage_state())
                 logger.info('saved session state for future runs')
-            except:
-                logger.warning('failed to save session state')
-    
-    return schedule_pages
+    except Exception:
+        logger.warning('failed to save session state')
+    try:
+        step_timeouts.save()
+    except Exception as e:
+        logger.warning('failed to save step latencies', error=str(e))
     
 
 def parse_schedule_page(schedule_page: str) -> list[PracticeFusionAppointment]:
@@ -751,6 +891,7 @@ def parse_schedule_page_legacy(schedule_page: str) -> list[PracticeFusionAppoint
     return appointments
 
 
+@ptmlog.span('parsing')
 def parse_schedule_pages(schedule_pages: list[str]) -> list[PracticeFusionAppointment]:
     appointments: list[PracticeFusionAppointment] = []
     for page_content in schedule_pages:
@@ -761,7 +902,9 @@ def parse_schedule_pages(schedule_pages: list[str]) -> list[PracticeFusionAppoin
 
 async def get_appointments(target_dates: list[date]) -> list[PracticeFusionAppointment]:
     schedule_pages = await get_schedule_pages(target_dates)
+    memory_profile.checkpoint('phase', 'scrape')
     appointments = parse_schedule_pages(schedule_pages)
+    memory_profile.checkpoint('phase', 'parsing')
     
     return appointments
 
@@ -0,0 +1,98 @@
+import random
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket. `acquire()` blocks until a token is available.
+
+    Tokens refill continuously at `rate` per second up to `capacity`. Each caller
+    reserves its slot under the lock and sleeps outside it, so waiting callers are
+    released in order at the configured rate without holding the lock.
+    """
+
+    def __init__(self, rate: float, capacity: float | None = None) -> None:
+        if rate <= 0:
+            raise ValueError('rate must be positive')
+        self.rate     = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens   = self.capacity
+        self.updated  = time.monotonic()
+        self.lock     = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self.tokens  = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self) -> float:
+        """Take one token, waiting if needed. Returns the seconds spent waiting."""
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= 1
+            wait = 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def set_rate(self, rate: float) -> None:
+        """Change the refill rate, e.g. to back off when the API signals throttling."""
+        with self.lock:
+            self._refill(time.monotonic())
+            self.rate = max(rate, 0.01)
+
+
+class AdaptiveConcurrencyLimit:
+    """
+    Concurrency limit that adapts to throttling (additive increase, multiplicative decrease).
+
+    Callers `acquire()` a slot before a request and `release(throttled)` it after.
+    A throttled response halves the limit (at most once per `decrease_interval`
+    seconds, so one burst of 429s counts once); every `increase_after` successes
+    in a row raise it by one, back up to `max_limit`.
+    """
+
+    def __init__(self, max_limit: int, min_limit: int = 1, increase_after: int = 20, decrease_interval: float = 1.0) -> None:
+        self.max_limit         = max_limit
+        self.min_limit         = min_limit
+        self.limit             = max_limit
+        self.increase_after    = increase_after
+        self.decrease_interval = decrease_interval
+        self.in_flight         = 0
+        self.successes         = 0
+        self.last_decrease     = float('-inf')
+        self.condition         = threading.Condition()
+
+    def acquire(self) -> None:
+        with self.condition:
+            while self.in_flight >= self.limit:
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, throttled: bool = False) -> None:
+        with self.condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if throttled:
+                self.successes = 0
+                if now - self.last_decrease >= self.decrease_interval:
+                    self.limit = max(self.min_limit, self.limit // 2)
+                    self.last_decrease = now
+            else:
+                self.successes += 1
+                if self.successes >= self.increase_after and self.limit < self.max_limit:
+                    self.limit += 1
+                    self.successes = 0
+            self.condition.notify_all()
+
+
+def backoff_delay(attempt: int, base: float = 1.0, cap: float = 30.0, retry_after: float | None = None) -> float:
+    """
+    Seconds to wait before retry number `attempt` (1-based): full-jitter exponential
+    backoff, but never less than a server-provided Retry-After.
+    """
+    delay = random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
@@ -0,0 +1,253 @@
+"""
+Reconcile SMS delivery status for recently sent surveys.
+
+Usage:
+    python src/reconcile_delivery_status.py [--days 7] [--dry-run]
+
+Lists the messages sent by the survey messaging service with Twilio's paged
+Messages API (one request per page of 1000, however many surveys were sent),
+joins them to appointment rows by `message_sid` in memory, and batch-writes
+`deliveryStatus`, `deliveryErrorCode` and `deliveryCheckedOn` back to the table.
+
+Messages that ended `undelivered` or `failed` with an error that may clear up
+on its own (carrier queue overflow, unreachable handset, unknown carrier error)
+are flagged for retry: `sentOn` and `message_sid` are cleared so the next send
+run picks the appointment up again, the old SID and status are kept in
+`previousMessageSid`/`previousDeliveryStatus` and `deliveryAttempts` is
+incremented, up to `DELIVERY_MAX_ATTEMPTS` sends. Numbers that failed as
+landlines or unknown handsets are added to the local bad phone number cache.
+
+Sends whose outcome was unknown (`surveySkippedReason = "send_uncertain"`, no
+SID) are resolved by looking for a survey message to the same number created
+within UNCERTAIN_MATCH_MINUTES of the attempt. A match gets its SID and status
+like any other send; with no match once UNCERTAIN_SETTLE_MINUTES have passed,
+the message was never created and `sentOn` is cleared so the next send run
+sends it.
+"""
+from datetime import datetime, timedelta, timezone
+from typing import Any
+import argparse
+import os
+import sys
+
+import appointments_table_utils
+import phone_utils
+import survey_fields
+import twilio_utils
+import run_history
+from send_journal import SEND_UNCERTAIN
+from phone_utils import BAD_NUMBER_ERROR_CODES, BadPhoneNumbers, InvalidPhoneNumber
+from shared import ptmlog
+
+# Twilio statuses after which a message never changes again
+FINAL_STATUSES       = {'delivered', 'undelivered', 'failed', 'read', 'canceled'}
+UNDELIVERED_STATUSES = {'undelivered', 'failed'}
+
+# 30001 queue overflow, 30003 unreachable destination handset, 30008 unknown error
+RETRYABLE_ERROR_CODES = {30001, 30003, 30008}
+
+PAGE_SIZE = 1000
+
+# How far a message's creation may be from the recorded attempt of an uncertain send,
+# and how long after the attempt a missing message is taken as never created
+UNCERTAIN_MATCH_MINUTES  = 10
+UNCERTAIN_SETTLE_MINUTES = 30
+
+
+def get_max_attempts() -> int:
+    return max(1, int(os.getenv('DELIVERY_MAX_ATTEMPTS', '2')))
+
+
+def fetch_message_statuses(sent_after: datetime) -> tuple[dict[str, tuple[str, int | None]], dict[str, list[tuple[datetime, str]]]]:
+    """
+    Status and error code of every survey message sent after `sent_after`, keyed by SID,
+    and the creation time and SID of those messages by destination number.
+    """
+    logger = ptmlog.get_logger()
+    campaign_sid = twilio_utils.get_settings().campaign_sid
+
+    statuses: dict[str, tuple[str, int | None]] = {}
+    sent_to: dict[str, list[tuple[datetime, str]]] = {}
+    listed = 0
+    # The list API cannot filter by messaging service, so other traffic on the account is dropped here
+    for message in twilio_utils.get_client().messages.stream(date_sent_after=sent_after, page_size=PAGE_SIZE):
+        listed += 1
+        if message.messaging_service_sid == campaign_sid:
+            statuses[message.sid] = (message.status, message.error_code)
+            sent_to.setdefault(message.to, []).append((message.date_created or message.date_sent, message.sid))
+
+    logger.info('listed twilio messages', sent_after=sent_after, listed=listed, survey_messages=len(statuses))
+    return statuses, sent_to
+
+
+def find_uncertain_message(entity: dict[str, Any], sent_to: dict[str, list[tuple[datetime, str]]]) -> str | None:
+    """SID of the survey message an uncertain send created, if Twilio has one to the same number near the attempt."""
+    try:
+        phone = phone_utils.normalize_phone(entity.get('patientPhone', ''))
+    except InvalidPhoneNumber:
+        return None
+    attempted_on = survey_fields.parse_datetime(entity['sentOn'])
+    candidates = [
+        (abs(created_on - attempted_on), sid)
+        for created_on, sid in sent_to.get(phone, [])
+        if created_on is not None and abs(created_on - attempted_on) <= timedelta(minutes=UNCERTAIN_MATCH_MINUTES)
+    ]
+    return min(candidates)[1] if candidates else None
+
+
+def delivery_update(entity: dict[str, Any], status: str, error_code: int | None, checked_on: datetime, max_attempts: int) -> tuple[dict[str, Any], bool]:
+    """The partial entity to merge for a message's status, and whether it flags the appointment for retry."""
+    update: dict[str, Any] = dict(
+        PartitionKey      = entity['PartitionKey'],
+        RowKey            = entity['RowKey'],
+        deliveryStatus    = status,
+        deliveryErrorCode = error_code or 0,
+        deliveryCheckedOn = checked_on,
+    )
+    attempts = int(entity.get('deliveryAttempts') or 1)
+    retry = status in UNDELIVERED_STATUSES and error_code in RETRYABLE_ERROR_CODES and attempts < max_attempts
+    if retry:
+        update.update(
+            sentOn                 = '',
+            message_sid            = '',
+            deliveryStatus         = '',
+            previousMessageSid     = entity['message_sid'],
+            previousDeliveryStatus = status,
+            deliveryAttempts       = attempts + 1,
+        )
+    return update, retry
+
+
+@ptmlog.procedure('cg_hope_scale_reconcile_delivery_status')
+def reconcile_delivery_status(days: int, dry_run: bool = False):
+    """
+    Record the Twilio delivery status of surveys sent in the last `days` days and flag retryable failures.
+    """
+    logger = ptmlog.get_logger()
+    checked_on   = datetime.now(timezone.utc)
+    max_attempts = get_max_attempts()
+
+    entities = list(appointments_table_utils.query_appointments(
+        [('sentOn', 'ge', checked_on - timedelta(days=days))],
+        select = ['PartitionKey', 'RowKey', 'sentOn', 'message_sid', 'deliveryStatus', 'deliveryAttempts', 'patientPhone', 'surveySkippedReason'],
+    ))
+    # Rows whose message may still change status; the rest were settled by an earlier run
+    pending = [
+        entity
+        for entity in entities
+        if entity.get('message_sid') and entity.get('deliveryStatus') not in FINAL_STATUSES
+    ]
+    # Sends that may or may not have reached Twilio
+    uncertain = [entity for entity in entities if entity.get('surveySkippedReason') == SEND_UNCERTAIN]
+    logger.info('appointments awaiting delivery status', count=len(pending), uncertain=len(uncertain), days=days)
+    if not pending and not uncertain:
+        return {'checked': 0, 'updated': 0, 'delivered': 0, 'undelivered': 0, 'flagged_for_retry': 0, 'not_found': 0, 'uncertain_found': 0, 'uncertain_resent': 0}
+
+    # Only page through Twilio back to the oldest message that still needs a status
+    oldest = min(survey_fields.parse_datetime(entity['sentOn']) for entity in pending + uncertain)
+    statuses, sent_to = fetch_message_statuses(oldest - timedelta(minutes=UNCERTAIN_MATCH_MINUTES))
+
+    bad_numbers = BadPhoneNumbers.load()
+    updates: list[dict[str, Any]] = []
+    delivered_count   = 0
+    undelivered_count = 0
+    retry_count       = 0
+    not_found_count   = 0
+    uncertain_found   = 0
+    uncertain_resent  = 0
+    for entity in uncertain:
+        message_sid = find_uncertain_message(entity, sent_to)
+        if message_sid is not None:
+            # It went out: from here on it is an ordinary send awaiting its status
+            logger.info('uncertain survey send found in twilio', row_key=entity['RowKey'], message_sid=message_sid)
+            uncertain_found += 1
+            pending.append({**entity, 'message_sid': message_sid})
+        elif checked_on - survey_fields.parse_datetime(entity['sentOn']) >= timedelta(minutes=UNCERTAIN_SETTLE_MINUTES):
+            logger.info('uncertain survey send never reached twilio, releasing it for the next send run', row_key=entity['RowKey'])
+            uncertain_resent += 1
+            updates.append(dict(
+                PartitionKey        = entity['PartitionKey'],
+                RowKey              = entity['RowKey'],
+                sentOn              = '',
+                message_sid         = '',
+                surveySkippedReason = '',
+            ))
+
+    for entity in pending:
+        if entity['message_sid'] not in statuses:
+            not_found_count += 1
+            continue
+        status, error_code = statuses[entity['message_sid']]
+        if status == entity.get('deliveryStatus'):
+            continue
+
+        update, retry = delivery_update(entity, status, error_code, checked_on, max_attempts)
+        if entity.get('surveySkippedReason') == SEND_UNCERTAIN:
+            # Matched by number and time: keep the SID the send never got back
+            update.setdefault('message_sid', entity['message_sid'])
+            update['surveySkippedReason'] = ''
+        updates.append(update)
+        delivered_count   += status in ('delivered', 'read')
+        undelivered_count += status in UNDELIVERED_STATUSES
+        retry_count       += retry
+        if retry:
+            logger.info('flagging undelivered survey for retry', row_key=entity['RowKey'], status=status, error_code=error_code)
+        if status in UNDELIVERED_STATUSES and error_code in BAD_NUMBER_ERROR_CODES:
+            # Landlines and dead numbers fail the same way every time; skip them before the next send
+            try:
+                bad_numbers.add(phone_utils.normalize_phone(entity.get('patientPhone', '')), BAD_NUMBER_ERROR_CODES[error_code], error_code)
+            except InvalidPhoneNumber:
+                pass
+
+    logger.info('delivery status reconciled',
+        checked          = len(pending),
+        updated          = len(updates),
+        delivered        = delivered_count,
+        undelivered      = undelivered_count,
+        retry            = retry_count,
+        not_found        = not_found_count,
+        uncertain_found  = uncertain_found,
+        uncertain_resent = uncertain_resent,
+        dry_run          = dry_run,
+    )
+    if not dry_run:
+        appointments_table_utils.update_appointments(updates)
+        bad_numbers.save()
+
+    return {
+        'checked'          : len(pending),
+        'updated'          : len(updates),
+        'delivered'        : delivered_count,
+        'undelivered'      : undelivered_count,
+        'flagged_for_retry': retry_count,
+        'not_found'        : not_found_count,
+        'uncertain_found'  : uncertain_found,
+        'uncertain_resent' : uncertain_resent,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Record Twilio delivery status for recently sent surveys')
+    parser.add_argument('--days', type=int, default=7, help='Reconcile surveys sent in the last this many days')
+    parser.add_argument('--dry-run', action='store_true', help='Report what would change without writing to the table')
+    args = parser.parse_args()
+    run_history.install()
+
+    if args.days < 1:
+        print('Error: --days must be at least 1.')
+        sys.exit(1)
+
+    result = reconcile_delivery_status(args.days, dry_run=args.dry_run)
+
+    print(f"\nDelivery Status Results:")
+    print(f"  Awaiting status: {result['checked']}")
+    print(f"  Updated: {result['updated']} (delivered: {result['delivered']}, undelivered: {result['undelivered']})")
+    print(f"  Flagged for retry: {result['flagged_for_retry']}")
+    print(f"  Not found in Twilio: {result['not_found']}")
+    print(f"  Uncertain sends: {result['uncertain_found']} found in Twilio, {result['uncertain_resent']} released to be sent again")
+    if args.dry_run:
+        print('[DRY RUN] No changes were made.')
+
+
+if __name__ == '__main__':
+    main()
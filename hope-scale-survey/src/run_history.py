@@ -0,0 +1,209 @@
+"""
+Run history: a compact record of every procedure run, and regression checks against recent runs.
+
+Usage:
+    python src/run_history.py list --procedure cg_hope_scale_sync_appointments
+    python src/run_history.py compare --procedure cg_hope_scale_sync_appointments
+
+`install()` registers a ptmlog run listener that writes one row per run to the
+`runHistory` table (PartitionKey the procedure id, RowKey the start time and run
+id) with the run's status and duration, per-phase totals in milliseconds
+(`phases`, JSON), every metric recorded with `ptmlog.record_metric` /
+`increment_metric` plus the numeric fields of the return value (`metrics`,
+JSON), and columns for the headline numbers: rowsFetched, rowsWritten, smsSent,
+retries and sessionReused. Set RUN_HISTORY=0 to stop recording. With
+STORAGE_BACKEND=sqlite the history is kept in a local file for testing.
+
+`compare` checks a run (the latest by default) against the median of the
+previous `--baseline-runs` succeeded runs of the same procedure. It flags phases
+and total durations that grew by more than `--tolerance` (and at least
+MIN_SLOWDOWN_SECONDS), counters where more is worse (errors, retries,
+back-clicks) that grew by more than `--tolerance`, and a lost session reuse.
+Each regression is logged as a `performance regression` warning and the
+command exits with status 1, so it can gate or alert after a scheduled run.
+"""
+from statistics import median
+from typing import Any
+import argparse
+import json
+import os
+import sys
+
+from shared import ptmlog
+from storage_backends import get_table_store
+
+TABLE_NAME            = 'runHistory'
+BASELINE_RUNS_DEFAULT = 10
+MIN_BASELINE_RUNS     = 3
+TOLERANCE_DEFAULT     = 0.5
+MIN_SLOWDOWN_SECONDS  = 5.0
+
+# Headline column -> return value fields it is taken from (first present wins)
+HEADLINE_FIELDS = {
+    'rowsFetched': ('total_retrieved',),
+    'rowsWritten': ('created', 'rows_written'),
+    'smsSent'    : ('sent',),
+    'retries'    : ('retries',),
+}
+
+# Counters where an increase is a regression
+HIGHER_IS_WORSE = {
+    'errors',
+    'retries',
+    'retries_exhausted',
+    'throttled_errors',
+    'permanent_errors',
+    'wasted_api_calls',
+    'uncommitted',
+    'back_clicks',
+    'print_retries',
+    'navigation_retries',
+    'deadline_overruns',
+    'dates_timed_out',
+    'deadline_skipped',
+    'step_timeouts',
+    'step_timeout_fallbacks',
+    'leases_lost',
+}
+
+
+def run_metrics(run: dict[str, Any]) -> dict[str, Any]:
+    """Numeric top-level fields of the return value, overridden by metrics recorded during the run."""
+    metrics: dict[str, Any] = {}
+    if isinstance(run['return_value'], dict):
+        metrics = {
+            name: value
+            for name, value in run['return_value'].items()
+            if isinstance(value, (bool, int, float))
+        }
+    metrics.update(run['metrics'])
+    return metrics
+
+
+def record_run(run: dict[str, Any]) -> None:
+    """ptmlog run listener: write the run's history row."""
+    logger = ptmlog.get_logger()
+
+    metrics = run_metrics(run)
+    entity = dict(
+        PartitionKey = run['procedure_id'],
+        RowKey       = f"{run['started_on']:%Y%m%dT%H%M%S%f}_{run['run_id']}",
+        runId        = run['run_id'],
+        runStatus    = run['run_status'],
+        startedOn    = run['started_on'],
+        durationS    = round(run['duration_s'], 3),
+        phases       = json.dumps({name: phase['total_ms'] for name, phase in run['phases'].items()}),
+        metrics      = json.dumps(metrics, default=str),
+    )
+    for column, fields in HEADLINE_FIELDS.items():
+        value = next((metrics[field] for field in fields if field in metrics), None)
+        if value is not None:
+            entity[column] = value
+    if 'session_reused' in metrics:
+        entity['sessionReused'] = bool(metrics['session_reused'])
+
+    get_table_store(TABLE_NAME).upsert_entity(entity)
+    logger.debug('recorded run history', run_status=run['run_status'], duration_s=entity['durationS'])
+
+
+def install() -> None:
+    """Record every procedure run of this process, unless RUN_HISTORY=0."""
+    if os.getenv('RUN_HISTORY', '1') == '1':
+        ptmlog.add_run_listener(record_run)
+
+
+def load_runs(procedure_id: str) -> list[dict[str, Any]]:
+    """History rows of `procedure_id`, oldest first, with `phases` and `metrics` decoded."""
+    runs = []
+    for entity in get_table_store(TABLE_NAME).query_entities([('PartitionKey', 'eq', procedure_id)]):
+        entity['phases']  = json.loads(entity.get('phases') or '{}')
+        entity['metrics'] = json.loads(entity.get('metrics') or '{}')
+        runs.append(entity)
+    return sorted(runs, key=lambda entity: entity['RowKey'])
+
+
+def find_regressions(run: dict[str, Any], baseline: list[dict[str, Any]], tolerance: float) -> list[dict[str, Any]]:
+    """Regressions of `run` against the medians of `baseline` (both history rows)."""
+    regressions = []
+
+    def check_duration(name: str, value_s: float | None, baseline_s: list[float]) -> None:
+        if value_s is None or not baseline_s:
+            return
+        typical = median(baseline_s)
+        if value_s > typical * (1 + tolerance) and value_s - typical >= MIN_SLOWDOWN_SECONDS:
+            regressions.append(dict(name=name, value=round(value_s, 1), baseline=round(typical, 1), unit='s'))
+
+    check_duration('duration', run['durationS'], [entity['durationS'] for entity in baseline])
+    for phase, total_ms in run['phases'].items():
+        check_duration(f'phase:{phase}', total_ms / 1000, [entity['phases'][phase] / 1000 for entity in baseline if phase in entity['phases']])
+
+    for name in sorted(HIGHER_IS_WORSE & run['metrics'].keys()):
+        value = run['metrics'][name]
+        typical = median([entity['metrics'].get(name, 0) for entity in baseline])
+        if value > typical * (1 + tolerance) and value - typical >= 1:
+            regressions.append(dict(name=name, value=value, baseline=typical, unit='count'))
+
+    reused = [entity['sessionReused'] for entity in baseline if 'sessionReused' in entity]
+    if run.get('sessionReused') is False and reused and sum(reused) / len(reused) >= 0.5:
+        regressions.append(dict(name='session_reused', value=False, baseline=f'{sum(reused)}/{len(reused)} runs', unit='flag'))
+
+    return regressions
+
+
+def compare(procedure_id: str, run_id: str | None, baseline_runs: int, tolerance: float) -> list[dict[str, Any]] | None:
+    """
+    Regressions of run `run_id` (default the latest) against the preceding succeeded runs.
+    Returns None when there is no such run or not enough history to compare against.
+    """
+    logger = ptmlog.get_logger()
+
+    runs = load_runs(procedure_id)
+    index = next((i for i, entity in enumerate(runs) if entity['runId'] == run_id), None) if run_id else len(runs) - 1
+    if index is None or index < 0:
+        print(f'No run found for {procedure_id}' + (f' with run id {run_id}' if run_id else ''))
+        return None
+    run = runs[index]
+
+    baseline = [entity for entity in runs[:index] if entity['runStatus'] == 'succeeded'][-baseline_runs:]
+    print(f"Run {run['runId']} ({run['runStatus']}, {run['startedOn']:%Y-%m-%d %H:%M}, {run['durationS']:.1f}s) vs {len(baseline)} previous runs")
+    if len(baseline) < MIN_BASELINE_RUNS:
+        print(f'  Not enough history to compare (need {MIN_BASELINE_RUNS} succeeded runs)')
+        return None
+
+    regressions = find_regressions(run, baseline, tolerance)
+    for regression in regressions:
+        logger.warning('performance regression', compared_run_id=run['runId'], compared_procedure_id=procedure_id, **regression)
+        print(f"  REGRESSION {regression['name']}: {regression['value']} (baseline {regression['baseline']}) [{regression['unit']}]")
+    if not regressions:
+        print('  No regressions')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Show procedure run history and check runs for regressions')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    list_parser = subparsers.add_parser('list', help='List recent runs')
+    list_parser.add_argument('--procedure', default='cg_hope_scale_sync_appointments', help='Procedure id')
+    list_parser.add_argument('--limit', type=int, default=20, help='Runs to show')
+
+    compare_parser = subparsers.add_parser('compare', help='Compare a run against the rolling baseline')
+    compare_parser.add_argument('--procedure', default='cg_hope_scale_sync_appointments', help='Procedure id')
+    compare_parser.add_argument('--run-id', help='Run to check (default: the latest)')
+    compare_parser.add_argument('--baseline-runs', type=int, default=BASELINE_RUNS_DEFAULT, help='Previous succeeded runs in the baseline')
+    compare_parser.add_argument('--tolerance', type=float, default=TOLERANCE_DEFAULT, help='Allowed relative increase before flagging (0.5 = +50%%)')
+    args = parser.parse_args()
+
+    if args.command == 'list':
+        for entity in load_runs(args.procedure)[-args.limit:]:
+            phases = ', '.join(f'{name} {total_ms / 1000:.1f}s' for name, total_ms in list(entity['phases'].items())[:4])
+            headline = ' '.join(f'{column}={entity[column]}' for column in (*HEADLINE_FIELDS, 'sessionReused') if column in entity)
+            print(f"{entity['startedOn']:%Y-%m-%d %H:%M}  {entity['runStatus']:<9} {entity['durationS']:>8.1f}s  {headline}  [{phases}]")
+        return
+
+    regressions = compare(args.procedure, args.run_id, args.baseline_runs, args.tolerance)
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,228 @@
+"""
+Run coordination with renewable blob leases, so overlapping runs don't duplicate work.
+
+A manual `backfill.py`, the scheduled job and a second replica of it can run at
+the same time. Each piece of work they could both do takes a lease on a blob in
+the `run-leases` container first:
+
+- `sync`: the Practice Fusion login (with its MFA prompt) and the write of the
+  shared `practicefusion` storage state. Waited for: the second run logs in
+  after the first and reuses its session.
+- `date-YYYY-MM-DD`: scraping and writing one date. Skipped: a date leased by
+  another run is left to it.
+- `send`: reading the unsent rows and texting them. Skipped by default
+  (`RUN_LEASE_WAIT_SECONDS`); a lost send lease stops handing out sends.
+
+Leases last LEASE_SECONDS and are renewed every RENEW_SECONDS by a background
+thread while held, so a crashed run frees its scopes within a minute. A scope
+already held by this process is shared (re-entrant). STORAGE_BACKEND=memory
+gives an in-process stand-in for tests; `sqlite` coordinates processes on one
+machine. Set RUN_LEASES=0 to turn coordination off.
+
+    with run_lease.hold('send') as lease:
+        if lease is None:
+            return  # another run is sending
+"""
+from contextlib import asynccontextmanager, contextmanager
+from typing import AsyncIterator, Callable, Iterator
+import asyncio
+import atexit
+import os
+import threading
+import time
+
+from storage_backends import LeaseHeldError, LeaseLostError, get_blob_store
+from shared import ptmlog
+
+CONTAINER_NAME = 'run-leases'
+LEASE_SECONDS  = 60  # the longest finite lease Azure allows
+RENEW_SECONDS  = 20
+POLL_SECONDS   = 5
+
+_held: dict[str, 'RunLease'] = {}
+_held_lock = threading.Lock()
+_renewer: threading.Thread | None = None
+
+
+def enabled() -> bool:
+    return os.getenv('RUN_LEASES', '1') == '1'
+
+
+def get_wait_seconds() -> float:
+    """How long a skippable scope (`send`) waits for another run's lease before skipping."""
+    return float(os.getenv('RUN_LEASE_WAIT_SECONDS', '0'))
+
+
+class RunLease:
+    """A lease held by this process on one scope, renewed in the background until released."""
+
+    def __init__(self, scope: str, lease_id: str | None) -> None:
+        self.scope     = scope
+        self.lease_id  = lease_id
+        self.holders   = 1
+        self.lost      = threading.Event()
+        self.callbacks : list[Callable[[], None]] = []
+        # The renewer thread reports a loss in the context of the run that took the lease
+        self.report_lost = ptmlog.in_context(self._report_lost)
+
+    def on_lost(self, callback: Callable[[], None]) -> None:
+        """Call `callback` (from the renewer thread) if the lease is lost while held."""
+        self.callbacks.append(callback)
+        if self.lost.is_set():
+            callback()
+
+    def release(self) -> None:
+        release(self)
+
+    def _report_lost(self) -> None:
+        ptmlog.get_logger().error('run lease lost', scope=self.scope)
+        ptmlog.increment_metric('leases_lost')
+        self.lost.set()
+        for callback in self.callbacks:
+            callback()
+
+
+def try_acquire(scope: str) -> RunLease | None:
+    """Lease `scope`, or return None at once if another run holds it."""
+    logger = ptmlog.get_logger()
+    with _held_lock:
+        lease = _held.get(scope)
+        if lease is not None:
+            lease.holders += 1
+            return lease
+
+    if not enabled():
+        lease_id = None
+    else:
+        try:
+            lease_id = get_blob_store().acquire_lease(CONTAINER_NAME, scope, LEASE_SECONDS)
+        except LeaseHeldError:
+            logger.debug('run lease held by another run', scope=scope)
+            return None
+
+    with _held_lock:
+        lease = _held[scope] = RunLease(scope, lease_id)
+    if lease_id is not None:
+        logger.info('acquired run lease', scope=scope)
+        _start_renewer()
+    return lease
+
+
+def acquire(scope: str, wait_s: float | None = 0) -> RunLease | None:
+    """Lease `scope`, polling for up to `wait_s` seconds (None: until acquired); None if it stays held."""
+    logger = ptmlog.get_logger()
+    started = None
+    while (lease := try_acquire(scope)) is None:
+        if started is None:
+            started = time.monotonic()
+            if wait_s != 0:
+                logger.info('waiting for run lease', scope=scope, wait_s=wait_s)
+        waited = time.monotonic() - started
+        if wait_s is not None and waited >= wait_s:
+            logger.warning('run lease held by another run, skipping', scope=scope, waited_s=round(waited))
+            ptmlog.increment_metric('lease_contended')
+            return None
+        time.sleep(POLL_SECONDS if wait_s is None else min(POLL_SECONDS, wait_s - waited))
+    return lease
+
+
+async def acquire_async(scope: str, wait_s: float | None = 0) -> RunLease | None:
+    """`acquire` for async code: the storage calls run in a thread and polling does not block the loop."""
+    logger = ptmlog.get_logger()
+    started = None
+    while (lease := await asyncio.to_thread(try_acquire, scope)) is None:
+        if started is None:
+            started = time.monotonic()
+            if wait_s != 0:
+                logger.info('waiting for run lease', scope=scope, wait_s=wait_s)
+        waited = time.monotonic() - started
+        if wait_s is not None and waited >= wait_s:
+            logger.warning('run lease held by another run, skipping', scope=scope, waited_s=round(waited))
+            ptmlog.increment_metric('lease_contended')
+            return None
+        await asyncio.sleep(POLL_SECONDS if wait_s is None else min(POLL_SECONDS, wait_s - waited))
+    return lease
+
+
+def release(lease: RunLease) -> None:
+    """Give up one hold on `lease`; the blob lease ends with the last one."""
+    logger = ptmlog.get_logger()
+    with _held_lock:
+        lease.holders -= 1
+        if lease.holders > 0:
+            return
+        if _held.get(lease.scope) is lease:
+            del _held[lease.scope]
+    if lease.lease_id is None or lease.lost.is_set():
+        return
+    try:
+        get_blob_store().release_lease(CONTAINER_NAME, lease.scope, lease.lease_id)
+        logger.info('released run lease', scope=lease.scope)
+    except Exception as e:
+        # It expires on its own within LEASE_SECONDS
+        logger.warning('failed to release run lease', scope=lease.scope, error=str(e))
+
+
+def release_all(prefix: str = '') -> None:
+    """Release every lease of this process whose scope starts with `prefix`, whatever its hold count."""
+    with _held_lock:
+        leases = [lease for scope, lease in _held.items() if scope.startswith(prefix)]
+    for lease in leases:
+        lease.holders = 1
+        release(lease)
+
+
+@contextmanager
+def hold(scope: str, wait_s: float | None = 0) -> Iterator[RunLease | None]:
+    """Hold `scope` for the body; yields None if another run held it for longer than `wait_s`."""
+    lease = acquire(scope, wait_s)
+    try:
+        yield lease
+    finally:
+        if lease is not None:
+            release(lease)
+
+
+@asynccontextmanager
+async def hold_async(scope: str, wait_s: float | None = 0) -> AsyncIterator[RunLease | None]:
+    lease = await acquire_async(scope, wait_s)
+    try:
+        yield lease
+    finally:
+        if lease is not None:
+            await asyncio.to_thread(release, lease)
+
+
+def _renew_held() -> None:
+    logger = ptmlog.get_logger()
+    with _held_lock:
+        leases = [lease for lease in _held.values() if lease.lease_id is not None]
+    for lease in leases:
+        try:
+            get_blob_store().renew_lease(CONTAINER_NAME, lease.scope, lease.lease_id)
+        except LeaseLostError:
+            with _held_lock:
+                if _held.get(lease.scope) is lease:
+                    del _held[lease.scope]
+            lease.report_lost()
+        except Exception as e:
+            # Transient; the lease survives until LEASE_SECONDS after the last renewal
+            logger.warning('failed to renew run lease', scope=lease.scope, error=str(e))
+
+
+def _start_renewer() -> None:
+    global _renewer
+    with _held_lock:
+        if _renewer is not None:
+            return
+
+        def renew_forever() -> None:
+            while True:
+                time.sleep(RENEW_SECONDS)
+                _renew_held()
+
+        _renewer = threading.Thread(target=renew_forever, name='run-lease-renewer', daemon=True)
+        _renewer.start()
+
+
+atexit.register(release_all)
@@ -0,0 +1,257 @@
+"""
+Local append-only journal of sent surveys.
+
+Every message SID is appended (and fsynced) as soon as Twilio accepts the
+message, before the appointment row is touched. A background flusher commits
+journaled sends to the table in batches and appends a commit record for them.
+On startup the journal is replayed: sends without a commit record are committed
+first, and every journaled row key is skipped by the sender, so a crash or a
+failed table update can never text a patient twice.
+
+Each entry also carries the patient's phone number, and the commit upserts the
+number's `surveyContacts` row before it stores the SID, so the contact index is
+written exactly when the send is and survives a crash the same way.
+
+A send whose outcome is unknown (a read timeout or a connection dropped after
+the request went out) is journaled the same way with no SID and `uncertain`.
+It is committed with `surveySkippedReason = "send_uncertain"`, which keeps it
+out of later send runs until `reconcile_delivery_status.py` finds the message
+in Twilio or establishes that it was never created.
+
+Journal lines (JSON):
+    {"event": "sent", "row_key": ..., "partition_key": ..., "phone": ..., "message_sid": ..., "sent_on": ...}
+    {"event": "sent", "row_key": ..., "partition_key": ..., "phone": ..., "message_sid": "", "sent_on": ..., "uncertain": true}
+    {"event": "committed", "row_keys": [...]}
+
+The journal only protects against double sends if it outlives the container:
+in the Container Apps job `SEND_JOURNAL_PATH` must point into the Azure Files
+volume mounted at `/mnt/state`, and `open` logs an error when it is not on a
+mounted volume.
+"""
+from datetime import datetime
+from pathlib import Path
+import json
+import os
+import threading
+
+from azure.core.exceptions import ResourceNotFoundError
+
+import appointments_table_utils
+import contact_index
+from shared import ptmlog
+
+FLUSH_INTERVAL_SECONDS_DEFAULT = 2.0
+FLUSH_BATCH_SIZE               = 100
+
+SEND_UNCERTAIN = 'send_uncertain'
+
+
+def on_mounted_volume(path: Path) -> bool:
+    """Whether `path` lives under a mount point other than the root filesystem."""
+    for directory in path.resolve().parents:
+        if directory != Path(directory.anchor) and os.path.ismount(directory):
+            return True
+    return False
+
+
+class SendJournal:
+    """
+    Durable record of sent surveys whose SIDs may not be in the table yet.
+    All methods are safe to call from several send workers at once.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path        = path
+        self.pending     : dict[str, dict[str, str]] = {}
+        self.committed   : set[str] = set()
+        self.write_lock  = threading.Lock()
+        self.commit_lock = threading.Lock()
+        self.flush_now   = threading.Event()
+        self.stopping    = threading.Event()
+        self.flusher     : threading.Thread | None = None
+        self.file        = None
+
+    @classmethod
+    def open(cls, path: Path | None = None) -> 'SendJournal':
+        """Open the journal for appending, replaying any entries left by earlier runs."""
+        logger = ptmlog.get_logger()
+        journal = cls(path or Path(os.getenv('SEND_JOURNAL_PATH', 'send_journal.jsonl')))
+
+        if not on_mounted_volume(journal.path):
+            # On the container's own filesystem the journal is gone after the run, and with it the double-send guard
+            logger.error('send journal is not on a mounted volume and will not survive a container restart',
+                path = str(journal.path.resolve()),
+                hint = 'set SEND_JOURNAL_PATH to a file on the Azure Files volume (see docs/deployment/docker.md)',
+            )
+
+        if journal.path.exists():
+            with journal.path.open() as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A torn last line from a crash mid-write; the send it described never completed
+                        logger.warning('skipping unreadable send journal line', path=str(journal.path))
+                        continue
+                    journal._apply(entry)
+            logger.info('replayed send journal', path=str(journal.path), pending=len(journal.pending), committed=len(journal.committed))
+
+        journal.file = journal.path.open('a')
+        return journal
+
+    def _apply(self, entry: dict) -> None:
+        if entry['event'] == 'sent':
+            self.pending[entry['row_key']] = entry
+        elif entry['event'] == 'committed':
+            for row_key in entry['row_keys']:
+                self.pending.pop(row_key, None)
+                self.committed.add(row_key)
+
+    def _append(self, entry: dict) -> None:
+        with self.write_lock:
+            self.file.write(json.dumps(entry) + '\n')
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self._apply(entry)
+
+    def record_sent(self, row_key: str, partition_key: str, phone: str, message_sid: str, sent_on: datetime) -> None:
+        """Durably record an accepted message. Returns once the entry is on disk."""
+        self._append({
+            'event'        : 'sent',
+            'row_key'      : row_key,
+            'partition_key': partition_key,
+            'phone'        : phone,
+            'message_sid'  : message_sid,
+            'sent_on'      : sent_on.isoformat(),
+        })
+        if len(self.pending) >= FLUSH_BATCH_SIZE:
+            self.flush_now.set()
+
+    def record_uncertain(self, row_key: str, partition_key: str, phone: str, sent_on: datetime) -> None:
+        """Durably record a send that may or may not have reached Twilio, for reconciliation."""
+        self._append({
+            'event'        : 'sent',
+            'row_key'      : row_key,
+            'partition_key': partition_key,
+            'phone'        : phone,
+            'message_sid'  : '',
+            'sent_on'      : sent_on.isoformat(),
+            'uncertain'    : True,
+        })
+        if len(self.pending) >= FLUSH_BATCH_SIZE:
+            self.flush_now.set()
+
+    def __contains__(self, row_key: str) -> bool:
+        return row_key in self.pending or row_key in self.committed
+
+    def commit_pending(self) -> tuple[int, int]:
+        """
+        Write every pending send to the table in batches, upserting the contact
+        rows first. Rows that fail stay pending for the next flush. Returns
+        (committed, failed).
+        """
+        logger = ptmlog.get_logger()
+
+        with self.commit_lock:
+            with self.write_lock:
+                entries = list(self.pending.values())
+            if not entries:
+                return 0, 0
+
+            try:
+                contact_index.upsert_contacts([
+                    (entry['phone'], entry['row_key'], datetime.fromisoformat(entry['sent_on']))
+                    for entry in entries
+                    if entry.get('phone')
+                ])
+            except Exception as e:
+                # Without the contact rows a later run could text these patients again inside the cooldown
+                logger.exception('error writing contact index, leaving sends pending', count=len(entries), error=str(e))
+                return 0, len(entries)
+
+            updates = [
+                dict(
+                    PartitionKey = entry['partition_key'],
+                    RowKey       = entry['row_key'],
+                    sentOn       = datetime.fromisoformat(entry['sent_on']),
+                    message_sid  = entry['message_sid'],
+                    **({'surveySkippedReason': SEND_UNCERTAIN} if entry.get('uncertain') else {}),
+                )
+                for entry in entries
+            ]
+            try:
+                appointments_table_utils.update_appointments(updates)
+                committed = [entry['row_key'] for entry in entries]
+            except Exception as e:
+                # A transaction fails as a whole; find the offending rows one by one
+                logger.warning('batch commit of send journal failed, committing rows individually', count=len(entries), error=str(e))
+                committed = []
+                for entry in entries:
+                    try:
+                        appointments_table_utils.update_appointment(
+                            row_key        = entry['row_key'],
+                            partition_key  = entry['partition_key'],
+                            sent_on        = datetime.fromisoformat(entry['sent_on']),
+                            message_sid    = entry['message_sid'],
+                            skipped_reason = SEND_UNCERTAIN if entry.get('uncertain') else None,
+                        )
+                        committed.append(entry['row_key'])
+                    except ResourceNotFoundError:
+                        logger.warning('journaled appointment no longer in table, dropping', row_key=entry['row_key'])
+                        committed.append(entry['row_key'])
+                    except Exception as e:
+                        logger.exception('error committing journaled send', row_key=entry['row_key'], error=str(e))
+
+            if committed:
+                self._append({'event': 'committed', 'row_keys': committed})
+            logger.info('committed send journal', committed=len(committed), failed=len(entries) - len(committed))
+            return len(committed), len(entries) - len(committed)
+
+    def _flush_loop(self, interval: float) -> None:
+        logger = ptmlog.get_logger()
+        while not self.stopping.is_set():
+            self.flush_now.wait(interval)
+            self.flush_now.clear()
+            try:
+                self.commit_pending()
+            except Exception as e:
+                logger.exception('error flushing send journal', error=str(e))
+
+    def start_flusher(self, interval: float | None = None) -> None:
+        """Commit pending sends in the background every `interval` seconds (or sooner when a batch fills)."""
+        interval = interval or float(os.getenv('SEND_JOURNAL_FLUSH_SECONDS', str(FLUSH_INTERVAL_SECONDS_DEFAULT)))
+        self.stopping.clear()
+        # Run in a copy of the caller's context so flusher logs keep the procedure's run_id
+        self.flusher = threading.Thread(
+            target = ptmlog.in_context(self._flush_loop),
+            args   = (interval,),
+            name   = 'send-journal-flusher',
+            daemon = True,
+        )
+        self.flusher.start()
+
+    def close(self) -> tuple[int, int]:
+        """
+        Stop the flusher, commit what is still pending and compact the journal
+        down to the sends that could not be committed. Returns (committed, failed)
+        for the final flush.
+        """
+        if self.flusher is not None:
+            self.stopping.set()
+            self.flush_now.set()
+            self.flusher.join()
+            self.flusher = None
+
+        result = self.commit_pending()
+
+        with self.write_lock:
+            self.file.close()
+            compacted = self.path.with_suffix(self.path.suffix + '.tmp')
+            with compacted.open('w') as file:
+                for entry in self.pending.values():
+                    file.write(json.dumps(entry) + '\n')
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(compacted, self.path)
+            self.committed.clear()
+        return result
@@ -0,0 +1,145 @@
+"""
+Send slot scheduling for surveys.
+
+`assign_slots` gives every pending appointment a send time:
+
+- no earlier than its appointment time plus `SEND_AFTER_APPOINTMENT_MINUTES`,
+- inside the daily send window `SEND_WINDOW` (e.g. "09:00-20:00", Eastern time;
+  unset means any time), moving to the next window opening otherwise,
+- at least 60 / `SEND_MESSAGES_PER_MINUTE` seconds after the previous slot, so
+  texts trickle out instead of leaving in one burst.
+
+`Dispatcher` then hands appointments to the send pool as their slots come due.
+It waits on an Event until the next slot, so no send worker sits idle sleeping
+for the schedule, and `stop()` ends a wait early. Slots more than
+`SEND_MAX_WAIT_MINUTES` away are not dispatched; those appointments stay
+pending for a later run.
+"""
+from concurrent.futures import Future
+from datetime import datetime, time, timedelta
+from typing import Callable
+import heapq
+import itertools
+import os
+import threading
+from zoneinfo import ZoneInfo
+
+from pydantic import BaseModel
+
+from models import TableAppointment
+from shared import ptmlog
+
+EASTERN_TZ = ZoneInfo('America/New_York')
+
+# Under the container's 12 hour replica timeout, so a run waiting for the morning window still finishes
+MAX_WAIT_MINUTES_DEFAULT = 660
+
+
+class SendSchedule(BaseModel):
+    window_start              : time | None = None
+    window_end                : time | None = None
+    messages_per_minute       : float | None = None
+    after_appointment_minutes : int = 0
+    max_wait_minutes          : int = MAX_WAIT_MINUTES_DEFAULT
+
+    @classmethod
+    def from_env(cls) -> 'SendSchedule | None':
+        """The configured schedule, or None when neither a window nor a pace is set (send everything now)."""
+        window              = os.getenv('SEND_WINDOW')
+        messages_per_minute = os.getenv('SEND_MESSAGES_PER_MINUTE')
+        if not window and not messages_per_minute:
+            return None
+
+        window_start = window_end = None
+        if window:
+            start, end = window.split('-')
+            window_start = time.fromisoformat(start.strip())
+            window_end   = time.fromisoformat(end.strip())
+
+        return cls(
+            window_start              = window_start,
+            window_end                = window_end,
+            messages_per_minute       = float(messages_per_minute) if messages_per_minute else None,
+            after_appointment_minutes = int(os.getenv('SEND_AFTER_APPOINTMENT_MINUTES', '0')),
+            max_wait_minutes          = int(os.getenv('SEND_MAX_WAIT_MINUTES', str(MAX_WAIT_MINUTES_DEFAULT))),
+        )
+
+    def in_window(self, moment: datetime) -> bool:
+        if self.window_start is None or self.window_end is None:
+            return True
+        local = moment.astimezone(EASTERN_TZ).time()
+        if self.window_start <= self.window_end:
+            return self.window_start <= local < self.window_end
+        # Window spanning midnight, e.g. 20:00-02:00
+        return local >= self.window_start or local < self.window_end
+
+    def next_allowed(self, moment: datetime) -> datetime:
+        """`moment` if it is inside the send window, otherwise the next time the window opens."""
+        if self.in_window(moment):
+            return moment
+        local = moment.astimezone(EASTERN_TZ)
+        opening = datetime.combine(local.date(), self.window_start, tzinfo=EASTERN_TZ)
+        if opening <= local:
+            opening = datetime.combine(local.date() + timedelta(days=1), self.window_start, tzinfo=EASTERN_TZ)
+        return opening
+
+
+def assign_slots(table_appointments: list[TableAppointment], schedule: SendSchedule, now: datetime) -> list[tuple[datetime, TableAppointment]]:
+    """Send time for every appointment, in send order (earliest eligible appointment first)."""
+    spacing = timedelta(minutes=1 / schedule.messages_per_minute) if schedule.messages_per_minute else timedelta(0)
+    after = timedelta(minutes=schedule.after_appointment_minutes)
+
+    def earliest(table_appointment: TableAppointment) -> datetime:
+        if table_appointment.appointment_time is None:
+            return now
+        return max(now, table_appointment.appointment_time.replace(tzinfo=EASTERN_TZ) + after)
+
+    slots: list[tuple[datetime, TableAppointment]] = []
+    previous: datetime | None = None
+    for table_appointment in sorted(table_appointments, key=earliest):
+        slot = earliest(table_appointment)
+        if previous is not None:
+            slot = max(slot, previous + spacing)
+        slot = schedule.next_allowed(slot)
+        slots.append((slot, table_appointment))
+        previous = slot
+    return slots
+
+
+class Dispatcher:
+    """Releases scheduled appointments to `submit` as their slots come due."""
+
+    def __init__(self) -> None:
+        self.heap     : list[tuple[datetime, int, TableAppointment]] = []
+        self.sequence = itertools.count()
+        self.stopping = threading.Event()
+
+    def add(self, slot: datetime, table_appointment: TableAppointment) -> None:
+        heapq.heappush(self.heap, (slot, next(self.sequence), table_appointment))
+
+    def stop(self) -> None:
+        """End the current wait and stop dispatching; undispatched appointments stay pending."""
+        self.stopping.set()
+
+    def run(self, submit: Callable[[TableAppointment], Future], until: datetime) -> tuple[list[Future], int]:
+        """
+        Dispatch every appointment whose slot is at or before `until`, waiting for each slot.
+        Returns the submitted futures and the number of appointments left undispatched.
+        """
+        logger = ptmlog.get_logger()
+        futures: list[Future] = []
+
+        while self.heap and not self.stopping.is_set():
+            slot, _, table_appointment = self.heap[0]
+            if slot > until:
+                break
+            wait = (slot - datetime.now(EASTERN_TZ)).total_seconds()
+            if wait > 0:
+                if wait > 60:
+                    logger.info('waiting for next send slot', slot=slot, wait_s=round(wait), remaining=len(self.heap))
+                self.stopping.wait(wait)
+                continue
+            heapq.heappop(self.heap)
+            futures.append(submit(table_appointment))
+
+        return futures, len(self.heap)
@@ -1,13 +1,100 @@
+import asyncio
+import atexit
+import contextvars
+import json
 import logging
+import queue
 import structlog
 import os
+import sys
+import threading
+import time
 import uuid
+from contextvars import ContextVar
+from datetime import datetime, timezone
 from functools import wraps
 import inspect
 from structlog.stdlib import BoundLogger
-from typing import Any, Callable
+from typing import Any, Callable, Coroutine
 
 PTM_LOG_CONSOLE = os.getenv('PTMLOG_CONSOLE', '0')
+PTM_LOG_SPANS = os.getenv('PTMLOG_SPANS', '1') == '1'
+PTM_LOG_QUEUE = os.getenv('PTMLOG_QUEUE', '1') == '1'
+PTM_LOG_MAX_VALUE_CHARS = int(os.getenv('PTMLOG_MAX_VALUE_CHARS', '2000'))
+
+# Events below this level are dropped before any processor runs
+PTM_LOG_LEVEL = logging.getLevelNamesMapping().get(os.getenv('PTMLOG_LEVEL', 'INFO').upper(), logging.INFO)
+
+# Most lines the background writer joins into one write
+WRITE_BATCH_SIZE = 500
+
+
+class LogWriter:
+    """
+    Writes rendered log lines to stdout from a background thread, joining whatever
+    has queued up into one write. `flush()` blocks until everything queued so far is
+    written; it runs at the end of every procedure and at interpreter exit.
+    """
+
+    def __init__(self) -> None:
+        self.lines  : queue.SimpleQueue = queue.SimpleQueue()
+        self.thread : threading.Thread | None = None
+        self.lock   = threading.Lock()
+
+    def put(self, line: str) -> None:
+        if self.thread is None:
+            self.start()
+        self.lines.put(line)
+
+    def start(self) -> None:
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='ptmlog-writer', daemon=True)
+                self.thread.start()
+
+    def run(self) -> None:
+        while True:
+            batch = [self.lines.get()]
+            while len(batch) < WRITE_BATCH_SIZE:
+                try:
+                    batch.append(self.lines.get_nowait())
+                except queue.Empty:
+                    break
+            lines = [line for line in batch if isinstance(line, str)]
+            if lines:
+                try:
+                    sys.stdout.write('\n'.join(lines) + '\n')
+                    sys.stdout.flush()
+                except Exception:
+                    pass
+            for marker in batch:
+                if isinstance(marker, threading.Event):
+                    marker.set()
+
+    def flush(self, timeout: float = 5.0) -> None:
+        if self.thread is None:
+            return
+        done = threading.Event()
+        self.lines.put(done)
+        done.wait(timeout)
+
+
+_writer = LogWriter()
+atexit.register(_writer.flush)
+
+
+class QueuedPrintLogger:
+    """structlog logger that hands each rendered line to the background writer."""
+
+    def msg(self, message: str) -> None:
+        _writer.put(message)
+
+    log = debug = info = warn = warning = error = critical = exception = fatal = failure = err = msg
+
+
+def _queued_logger_factory(*args: Any) -> QueuedPrintLogger:
+    return QueuedPrintLogger()
+
 
 if PTM_LOG_CONSOLE == '1':
     structlog.configure(
@@ -17,8 +104,9 @@ if PTM_LOG_CONSOLE == '1':
             structlog.processors.TimeStamper(fmt="%H:%M:%S.%f"),
             structlog.dev.ConsoleRenderer(colors=True),
         ],
-        wrapper_class=structlog.make_filtering_bound_logger(logging.NOTSET),
-        logger_factory=structlog.PrintLoggerFactory(),
+        wrapper_class=structlog.make_filtering_bound_logger(PTM_LOG_LEVEL),
+        logger_factory=_queued_logger_factory if PTM_LOG_QUEUE else structlog.PrintLoggerFactory(),
+        cache_logger_on_first_use=True,
     )
 else:
     structlog.configure(
@@ -29,41 +117,297 @@ else:
             structlog.processors.TimeStamper(fmt="iso"),
             structlog.processors.JSONRenderer(),
         ],
-        wrapper_class=structlog.make_filtering_bound_logger(logging.NOTSET),
-        logger_factory=structlog.PrintLoggerFactory(),
+        wrapper_class=structlog.make_filtering_bound_logger(PTM_LOG_LEVEL),
+        logger_factory=_queued_logger_factory if PTM_LOG_QUEUE else structlog.PrintLoggerFactory(),
+        cache_logger_on_first_use=True,
     )
 
 
+def flush() -> None:
+    """Wait until every event logged so far has been written."""
+    _writer.flush()
+
+
+def capped(value: Any) -> Any:
+    """`value` itself if its JSON form fits in PTMLOG_MAX_VALUE_CHARS, otherwise that form truncated."""
+    if PTM_LOG_MAX_VALUE_CHARS <= 0:
+        return value
+    try:
+        text = json.dumps(value, default=str)
+    except (TypeError, ValueError):
+        text = repr(value)
+    if len(text) <= PTM_LOG_MAX_VALUE_CHARS:
+        return value
+    return f'{text[:PTM_LOG_MAX_VALUE_CHARS]}... [truncated, {len(text)} chars]'
+
+
 def get_logger() -> BoundLogger:
     return structlog.get_logger()
 
+
+class PhaseTimings:
+    """Span count and total duration per span name for one run; shared by the run's threads and tasks."""
+
+    def __init__(self) -> None:
+        self.totals: dict[str, list[float]] = {}
+        self.lock = threading.Lock()
+
+    def add(self, name: str, duration: float) -> None:
+        with self.lock:
+            total = self.totals.setdefault(name, [0, 0.0])
+            total[0] += 1
+            total[1] += duration
+
+    def summary(self) -> dict[str, dict[str, float]]:
+        with self.lock:
+            ordered = sorted(self.totals.items(), key=lambda item: item[1][1], reverse=True)
+            return {name: {'count': count, 'total_ms': round(total * 1000, 1)} for name, (count, total) in ordered}
+
+
+class RunMetrics:
+    """Named values recorded during one run (flags and counters); shared by the run's threads and tasks."""
+
+    def __init__(self) -> None:
+        self.values: dict[str, Any] = {}
+        self.lock = threading.Lock()
+
+    def set(self, name: str, value: Any) -> None:
+        with self.lock:
+            self.values[name] = value
+
+    def increment(self, name: str, amount: int | float = 1) -> None:
+        with self.lock:
+            self.values[name] = self.values.get(name, 0) + amount
+
+    def snapshot(self) -> dict[str, Any]:
+        with self.lock:
+            return dict(self.values)
+
+
+_run_phases: ContextVar[PhaseTimings | None] = ContextVar('ptmlog_run_phases', default=None)
+_run_metrics: ContextVar[RunMetrics | None] = ContextVar('ptmlog_run_metrics', default=None)
+_current_span: ContextVar['span | None'] = ContextVar('ptmlog_current_span', default=None)
+
+# Called with a summary of every finished procedure run, see add_run_listener
+_run_listeners: list[Callable[[dict[str, Any]], None]] = []
+
+
+def record_metric(name: str, value: Any) -> None:
+    """Record `value` under `name` for the current procedure run (e.g. `session_reused`); no-op outside a run."""
+    metrics = _run_metrics.get()
+    if metrics is not None:
+        metrics.set(name, value)
+
+
+def increment_metric(name: str, amount: int | float = 1) -> None:
+    """Add `amount` to the counter `name` of the current procedure run (e.g. `back_clicks`); no-op outside a run."""
+    metrics = _run_metrics.get()
+    if metrics is not None:
+        metrics.increment(name, amount)
+
+
+def add_run_listener(listener: Callable[[dict[str, Any]], None]) -> None:
+    """
+    Call `listener` after every procedure run with procedure_id, run_id, run_status,
+    started_on, duration_s, phases, metrics and return_value. It runs in the run's
+    context; exceptions are logged and otherwise ignored.
+    """
+    if listener not in _run_listeners:
+        _run_listeners.append(listener)
+
+
+class span:
+    """
+    Time a phase of a run, as `with ptmlog.span('login'):` or `@ptmlog.span('login')` on a
+    function or coroutine function. Spans nest through contextvars: each gets a `span_id`,
+    bound to every event logged inside it, and records its parent's. On exit a `span finished`
+    event is logged with the duration, which is also added to the `run_phases` summary of the
+    enclosing procedure. Nested spans overlap their parents in that summary.
+
+    With PTMLOG_SPANS=0 the decorator returns the function unchanged and the context manager does nothing.
+    """
+    __slots__ = ('name', 'fields', 'span_id', 'parent_span_id', 'started', 'span_token', 'context_tokens')
+
+    def __init__(self, name: str, **fields: Any) -> None:
+        self.name   = name
+        self.fields = fields
+
+    def __enter__(self) -> 'span':
+        if not PTM_LOG_SPANS:
+            return self
+        parent = _current_span.get()
+        self.span_id        = uuid.uuid4().hex[:16]
+        self.parent_span_id = parent.span_id if parent is not None else None
+        self.span_token     = _current_span.set(self)
+        self.context_tokens = structlog.contextvars.bind_contextvars(span_id=self.span_id)
+        self.started        = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback) -> None:
+        if not PTM_LOG_SPANS:
+            return
+        duration = time.perf_counter() - self.started
+        structlog.contextvars.reset_contextvars(**self.context_tokens)
+        _current_span.reset(self.span_token)
+
+        phases = _run_phases.get()
+        if phases is not None:
+            phases.add(self.name, duration)
+        get_logger().info('span finished',
+            span_name      = self.name,
+            span_id        = self.span_id,
+            parent_span_id = self.parent_span_id,
+            span_status    = 'failed' if exc_type is not None else 'succeeded',
+            duration_ms    = round(duration * 1000, 1),
+            **self.fields,
+        )
+
+    def __call__(self, func: Callable[..., Any]) -> Callable[..., Any]:
+        if not PTM_LOG_SPANS:
+            return func
+        name, fields = self.name, self.fields
+
+        if inspect.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(*args: Any, **kwargs: Any) -> Any:
+                with span(name, **fields):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            with span(name, **fields):
+                return func(*args, **kwargs)
+        return wrapper
+
+
 class procedure:
+    """
+    Log the start and outcome of each run of a function or coroutine function with a
+    `procedure_id` and a fresh `run_id`. The ids are bound for the run only and the
+    previous values are restored afterwards, so concurrent tasks and nested procedures
+    keep their own. Tasks started inside the run (`asyncio.gather`, `TaskGroup`,
+    `asyncio.to_thread`) inherit the ids; for thread pools and threads use `in_context`.
+    """
     def __init__(self, procedure_id: str) -> None:
         self.procedure_id = procedure_id
     
     def __call__(self, func: Callable[..., Any]) -> Callable[..., Any]:
+        signature = inspect.signature(func)
+
+        if inspect.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(*args: Any, **kwargs: Any) -> Any:
+                run = _ProcedureRun(self.procedure_id, signature.bind(*args, **kwargs).arguments)
+                try:
+                    return run.succeeded(await func(*args, **kwargs))
+                except Exception:
+                    run.failed()
+                    raise
+                finally:
+                    run.close()
+            return async_wrapper
+
         @wraps(func)
-        def wrapper(*args: tuple[Any], **kwargs: dict[str, Any]) -> Any:
-            run_id = str(uuid.uuid4())
-            run_arguments = inspect.signature(func).bind(*args, **kwargs).arguments
-            structlog.contextvars.clear_contextvars()
-            structlog.contextvars.bind_contextvars(
-                procedure_id     = self.procedure_id,
-                run_id           = run_id,
-            )
-            logger = get_logger()
-            logger.info('procedure started', run_status='started', run_arguments=run_arguments)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            run = _ProcedureRun(self.procedure_id, signature.bind(*args, **kwargs).arguments)
             try:
-                return_value = func(*args, **kwargs)
-            except Exception as e:
-                logger.exception('procedure failed', run_status='failed', run_arguments=run_arguments)
-                raise e
-            else:
-                logger.info('procedure succeeded', run_status='succeeded', run_arguments=run_arguments, run_return_value=return_value)
-                return return_value
+                return run.succeeded(func(*args, **kwargs))
+            except Exception:
+                run.failed()
+                raise
             finally:
-                structlog.contextvars.unbind_contextvars(
-                    'procedure_id',
-                    'run_id',
-                )
+                run.close()
         return wrapper
+
+
+class _ProcedureRun:
+    """Context and events of one procedure run; created and closed in the same task or thread."""
+
+    def __init__(self, procedure_id: str, run_arguments: dict[str, Any]) -> None:
+        self.procedure_id   = procedure_id
+        self.run_id         = str(uuid.uuid4())
+        self.run_arguments  = {name: capped(value) for name, value in run_arguments.items()}
+        self.run_status     = 'started'
+        self.return_value   = None
+        self.context_tokens = structlog.contextvars.bind_contextvars(
+            procedure_id     = procedure_id,
+            run_id           = self.run_id,
+        )
+        self.phases         = PhaseTimings() if PTM_LOG_SPANS else None
+        self.phases_token   = _run_phases.set(self.phases)
+        self.metrics        = RunMetrics()
+        self.metrics_token  = _run_metrics.set(self.metrics)
+        self.started_on     = datetime.now(timezone.utc)
+        self.started        = time.perf_counter()
+        self.logger         = get_logger()
+        self.logger.info('procedure started', run_status='started', run_arguments=self.run_arguments)
+
+    def succeeded(self, return_value: Any) -> Any:
+        self.run_status   = 'succeeded'
+        self.return_value = return_value
+        self.logger.info('procedure succeeded', run_status='succeeded', run_arguments=self.run_arguments, run_return_value=capped(return_value), **self.summary())
+        return return_value
+
+    def failed(self) -> None:
+        self.run_status = 'failed'
+        self.logger.exception('procedure failed', run_status='failed', run_arguments=self.run_arguments, **self.summary())
+
+    def summary(self) -> dict[str, Any]:
+        metrics = self.metrics.snapshot()
+        return {**phase_summary(self.phases), **({'run_metrics': metrics} if metrics else {})}
+
+    def notify_listeners(self) -> None:
+        run = dict(
+            procedure_id = self.procedure_id,
+            run_id       = self.run_id,
+            # Neither succeeded nor failed: cancelled or interrupted (BaseException)
+            run_status   = self.run_status if self.run_status != 'started' else 'cancelled',
+            started_on   = self.started_on,
+            duration_s   = time.perf_counter() - self.started,
+            phases       = self.phases.summary() if self.phases is not None else {},
+            metrics      = self.metrics.snapshot(),
+            return_value = self.return_value,
+        )
+        for listener in _run_listeners:
+            try:
+                listener(run)
+            except Exception as e:
+                self.logger.warning('run listener failed', listener=getattr(listener, '__qualname__', repr(listener)), error=str(e))
+
+    def close(self) -> None:
+        self.notify_listeners()
+        _run_metrics.reset(self.metrics_token)
+        _run_phases.reset(self.phases_token)
+        structlog.contextvars.reset_contextvars(**self.context_tokens)
+        # Keeps a run's events ahead of anything the caller prints next
+        flush()
+
+
+def in_context(func: Callable[..., Any]) -> Callable[..., Any]:
+    """
+    `func` wrapped to run in a copy of the caller's context (procedure_id, run_id, current span).
+    Thread pools, threads and `loop.run_in_executor` do not carry contextvars over on their own.
+    The wrapper may be called from several threads at once.
+    """
+    context = contextvars.copy_context()
+
+    @wraps(func)
+    def wrapper(*args: Any, **kwargs: Any) -> Any:
+        return context.copy().run(func, *args, **kwargs)
+    return wrapper
+
+
+def create_task(coro: Coroutine[Any, Any, Any], **context_values: Any) -> asyncio.Task:
+    """
+    `asyncio.create_task` with `context_values` bound for that task only, e.g. the
+    `target_date` of one of several pages scraped concurrently. The task also inherits
+    the caller's procedure_id and run_id, as every asyncio task does.
+    """
+    context = contextvars.copy_context()
+    context.run(structlog.contextvars.bind_contextvars, **context_values)
+    return asyncio.create_task(coro, context=context)
+
+
+def phase_summary(phases: PhaseTimings | None) -> dict[str, Any]:
+    return {'run_phases': phases.summary()} if phases is not None else {}
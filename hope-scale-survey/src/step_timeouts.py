@@ -0,0 +1,184 @@
+"""
+Adaptive Playwright step timeouts learned from observed latencies.
+
+Each named step (a selector wait, a navigation) records how long it took when
+it succeeded. Once a step has MIN_SAMPLES samples, its timeout is the
+`STEP_TIMEOUT_PERCENTILE` percentile of the last `STEP_TIMEOUT_WINDOW` samples
+times `STEP_TIMEOUT_HEADROOM`, kept between MIN_TIMEOUT_MS and MAX_FACTOR times
+the step's hand-picked default. Each consecutive timeout of a step doubles its
+timeout (up to the same ceiling) until it succeeds again, so a slow day widens
+the waits instead of burning retries, and a fast day fails fast. Retry sleeps
+follow the step's median latency, never longer than their default.
+
+Learned timeouts only pay off where a timeout is followed by another attempt.
+`step` is for waits inside a retry loop; a wait with no retry of its own goes
+through `run_step`, which tries again once at the default before failing, so a
+slow day never fails a step that the default would have let through.
+
+Latencies are kept per process and saved to blob storage (`save()`) next to the
+Playwright session state, so the container job learns across runs. Set
+STEP_TIMEOUTS=0 to use the defaults.
+
+    async with step_timeouts.step('print_button', 10000) as timeout_ms:
+        await print_button.wait_for(state='visible', timeout=timeout_ms)
+
+    await step_timeouts.run_step('appointments_table', 45000,
+        lambda timeout_ms: page.wait_for_selector(selector, timeout=timeout_ms))
+"""
+from contextlib import asynccontextmanager
+from math import ceil
+from statistics import median
+from typing import Any, AsyncIterator, Awaitable, Callable, TypeVar
+import json
+import os
+import time
+
+from azure.core.exceptions import ResourceNotFoundError
+from playwright.async_api import TimeoutError as PlaywrightTimeoutError
+
+from shared import ptmlog
+from storage_backends import get_blob_store
+
+CONTAINER_NAME     = 'playwright-step-latencies'
+BLOB_NAME          = 'practicefusion.json'
+MIN_SAMPLES        = 5
+MIN_TIMEOUT_MS     = 2000
+MIN_RETRY_DELAY_MS = 500
+MAX_FACTOR         = 2.0
+
+PERCENTILE_DEFAULT = 95
+HEADROOM_DEFAULT   = 1.5
+WINDOW_DEFAULT     = 50
+
+_steps: dict[str, dict[str, Any]] | None = None
+
+T = TypeVar('T')
+
+
+def enabled() -> bool:
+    return os.getenv('STEP_TIMEOUTS', '1') == '1'
+
+
+def _load() -> dict[str, dict[str, Any]]:
+    global _steps
+    if _steps is None:
+        logger = ptmlog.get_logger()
+        try:
+            _steps = json.loads(get_blob_store().download_blob(CONTAINER_NAME, BLOB_NAME))['steps']
+            logger.debug('loaded step latencies', steps=len(_steps))
+        except ResourceNotFoundError:
+            _steps = {}
+        except Exception as e:
+            logger.warning('error loading step latencies, using default timeouts', error=str(e))
+            _steps = {}
+    return _steps
+
+
+def get_timeout(name: str, default_ms: float) -> float:
+    """Timeout for the next attempt of step `name`, in milliseconds."""
+    if not enabled():
+        return default_ms
+    state = _load().get(name, {'samples': [], 'failures': 0})
+    samples = sorted(state['samples'])
+    ceiling = default_ms * MAX_FACTOR
+
+    if len(samples) < MIN_SAMPLES:
+        timeout = default_ms
+    else:
+        percentile = float(os.getenv('STEP_TIMEOUT_PERCENTILE', str(PERCENTILE_DEFAULT)))
+        headroom   = float(os.getenv('STEP_TIMEOUT_HEADROOM', str(HEADROOM_DEFAULT)))
+        observed   = samples[max(0, ceil(percentile / 100 * len(samples)) - 1)]
+        timeout    = max(MIN_TIMEOUT_MS, observed * headroom)
+
+    return round(min(ceiling, timeout * 2 ** state['failures']))
+
+
+def get_retry_delay(name: str, default_ms: float) -> float:
+    """Sleep before retrying step `name`: its median latency, between MIN_RETRY_DELAY_MS and `default_ms`."""
+    if not enabled():
+        return default_ms
+    samples = _load().get(name, {}).get('samples', [])
+    if len(samples) < MIN_SAMPLES:
+        return default_ms
+    return round(min(default_ms, max(MIN_RETRY_DELAY_MS, median(samples))))
+
+
+def record(name: str, latency_ms: float | None) -> None:
+    """Record a successful attempt's latency, or a timeout when `latency_ms` is None."""
+    if not enabled():
+        return
+    state = _load().setdefault(name, {'samples': [], 'failures': 0})
+    if latency_ms is None:
+        state['failures'] += 1
+        ptmlog.increment_metric('step_timeouts')
+        return
+    window = int(os.getenv('STEP_TIMEOUT_WINDOW', str(WINDOW_DEFAULT)))
+    state['samples'] = [*state['samples'], round(latency_ms)][-window:]
+    state['failures'] = 0
+
+
+@asynccontextmanager
+async def step(name: str, default_ms: float) -> AsyncIterator[float]:
+    """Yield the step's timeout (ms) and record how the attempt in the body went."""
+    logger = ptmlog.get_logger()
+    timeout_ms = get_timeout(name, default_ms)
+    started = time.perf_counter()
+    try:
+        yield timeout_ms
+    except PlaywrightTimeoutError:
+        logger.warning('step timed out', step=name, timeout_ms=timeout_ms, default_ms=default_ms)
+        record(name, None)
+        raise
+    record(name, (time.perf_counter() - started) * 1000)
+
+
+async def run_step(name: str, default_ms: float, action: Callable[[float], Awaitable[T]]) -> T:
+    """
+    Await `action(timeout_ms)` for a step with no retry of its own. If the learned timeout
+    is shorter than `default_ms` and expires, the action is tried once more at `default_ms`.
+    """
+    logger = ptmlog.get_logger()
+    try:
+        async with step(name, default_ms) as timeout_ms:
+            return await action(timeout_ms)
+    except PlaywrightTimeoutError:
+        if timeout_ms >= default_ms:
+            raise
+        logger.info('retrying step at its default timeout', step=name, default_ms=default_ms)
+        ptmlog.increment_metric('step_timeout_fallbacks')
+
+    started = time.perf_counter()
+    try:
+        result = await action(default_ms)
+    except PlaywrightTimeoutError:
+        logger.warning('step timed out', step=name, timeout_ms=default_ms, default_ms=default_ms)
+        record(name, None)
+        raise
+    record(name, (time.perf_counter() - started) * 1000)
+    return result
+
+
+def summary() -> dict[str, dict[str, Any]]:
+    """Per step: samples held, consecutive timeouts and the median latency."""
+    return {
+        name: {
+            'samples'  : len(state['samples']),
+            'failures' : state['failures'],
+            'median_ms': round(median(state['samples'])) if state['samples'] else None,
+        }
+        for name, state in _load().items()
+    }
+
+
+def save() -> None:
+    """Write this process's step latencies to blob storage for the next run."""
+    if not enabled() or _steps is None:
+        return
+    logger = ptmlog.get_logger()
+    get_blob_store().upload_blob(
+        container = CONTAINER_NAME,
+        name      = BLOB_NAME,
+        data      = json.dumps({'steps': _steps}),
+        overwrite = True,
+    )
+    logger.info('saved step latencies', steps=summary())
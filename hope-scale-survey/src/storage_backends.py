@@ -0,0 +1,791 @@
+"""
+Pluggable storage backends for tables and blobs.
+
+Every storage call in the project goes through a `TableStore` or a `BlobStore`
+obtained from `get_table_store()` / `get_blob_store()`. The backend is picked by
+the `STORAGE_BACKEND` environment variable:
+
+- `azure`  (default): Azure Table Storage / Blob Storage via `STORAGE_ACCOUNT_CONNECTION_STRING`
+- `memory`: process-local dictionaries, useful for tests and quick benchmarks
+- `sqlite`: a single SQLite file at `STORAGE_SQLITE_PATH`, useful for offline load tests
+
+All backends behave the same for inserts (ResourceExistsError on duplicates),
+point reads (ResourceNotFoundError), merge updates, filtered queries and batches.
+Blob stores also hold expiring leases on blobs (LeaseHeldError when another lease
+is active, LeaseLostError when a renewal comes too late), used by `run_lease.py`.
+Latency and throttling can be injected with `STORAGE_LATENCY_MS`,
+`STORAGE_LATENCY_JITTER_MS` and `STORAGE_MAX_OPS_PER_SECOND`.
+
+Filters are lists of `(property, operator, value)` tuples that are AND-ed together.
+Supported operators are eq, ne, gt, ge, lt, le and in (value is a list, OR-ed).
+"""
+from abc import ABC, abstractmethod
+from collections import deque
+from datetime import datetime, timezone
+from typing import Any, Iterator
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+import uuid
+
+from azure.core.exceptions import HttpResponseError, ResourceExistsError, ResourceNotFoundError
+
+from shared import ptmlog
+
+Filter = tuple[str, str, Any]
+
+COMPARISON_OPERATORS = ('eq', 'ne', 'gt', 'ge', 'lt', 'le')
+
+# Azure rejects entity group transactions with more than 100 operations
+MAX_BATCH_SIZE = 100
+
+
+class StorageThrottledError(HttpResponseError):
+    """Raised by throttled stores when the injected ops/second budget is exceeded (mirrors a 503 ServerBusy)."""
+
+    def __init__(self, message: str) -> None:
+        super().__init__(message=message)
+        self.status_code = 503
+
+
+class LeaseHeldError(ResourceExistsError):
+    """Raised when acquiring a lease on a blob that another lease holds (Azure 409 LeaseAlreadyPresent)."""
+
+
+class LeaseLostError(HttpResponseError):
+    """Raised when renewing a lease that expired and was taken, or no longer exists."""
+
+    def __init__(self, message: str) -> None:
+        super().__init__(message=message)
+        self.status_code = 409
+
+
+def utc_now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def _as_utc(value: datetime) -> datetime:
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+
+def _compare(left: Any, operator: str, right: Any) -> bool:
+    if isinstance(left, datetime) and isinstance(right, datetime):
+        left, right = _as_utc(left), _as_utc(right)
+    try:
+        match operator:
+            case 'eq': return left == right
+            case 'ne': return left != right
+            case 'gt': return left > right
+            case 'ge': return left >= right
+            case 'lt': return left < right
+            case 'le': return left <= right
+    except TypeError:
+        # Like Table Storage, comparisons across types never match
+        return False
+    raise ValueError(f'unsupported filter operator: {operator}')
+
+
+def matches_filters(entity: dict[str, Any], filters: list[Filter]) -> bool:
+    """
+    Evaluate filters against an entity in memory.
+    Entities missing a filtered property never match, as in Table Storage.
+    """
+    for name, operator, value in filters:
+        if name not in entity:
+            return False
+        if operator == 'in':
+            if not any(_compare(entity[name], 'eq', v) for v in value):
+                return False
+        elif not _compare(entity[name], operator, value):
+            return False
+    return True
+
+
+def _project(entity: dict[str, Any], select: list[str] | None) -> dict[str, Any]:
+    if select is None:
+        return dict(entity)
+    return {key: entity[key] for key in select if key in entity}
+
+
+class TableStore(ABC):
+    """A single table of entities addressed by PartitionKey and RowKey."""
+
+    table_name: str
+
+    @abstractmethod
+    def create_entity(self, entity: dict[str, Any]) -> None:
+        """Insert an entity. Raises ResourceExistsError if it already exists."""
+
+    @abstractmethod
+    def get_entity(self, partition_key: str, row_key: str) -> dict[str, Any]:
+        """Read an entity. Raises ResourceNotFoundError if it does not exist."""
+
+    @abstractmethod
+    def update_entity(self, entity: dict[str, Any]) -> None:
+        """Merge properties into an existing entity. Raises ResourceNotFoundError if it does not exist."""
+
+    @abstractmethod
+    def upsert_entity(self, entity: dict[str, Any]) -> None:
+        """Merge properties into an entity, inserting it if needed."""
+
+    @abstractmethod
+    def delete_entity(self, partition_key: str, row_key: str) -> None:
+        """Delete an entity. Deleting a missing entity is not an error."""
+
+    @abstractmethod
+    def query_entities(self, filters: list[Filter] | None = None, select: list[str] | None = None) -> Iterator[dict[str, Any]]:
+        """Stream entities matching every filter. Entities carry a `Timestamp` of their last write."""
+
+    def submit_batch(self, operations: list[tuple[str, dict[str, Any]]]) -> None:
+        """
+        Apply ('create' | 'update' | 'upsert' | 'delete', entity) operations.
+        Backends without native batching apply them one by one.
+        """
+        for operation, entity in operations:
+            match operation:
+                case 'create': self.create_entity(entity)
+                case 'update': self.update_entity(entity)
+                case 'upsert': self.upsert_entity(entity)
+                case 'delete': self.delete_entity(entity['PartitionKey'], entity['RowKey'])
+                case _: raise ValueError(f'unsupported batch operation: {operation}')
+
+
+class BlobStore(ABC):
+    """Named binary blobs grouped in containers."""
+
+    @abstractmethod
+    def download_blob(self, container: str, name: str) -> bytes:
+        """Raises ResourceNotFoundError if the blob does not exist."""
+
+    @abstractmethod
+    def upload_blob(self, container: str, name: str, data: bytes | str, overwrite: bool = True) -> None:
+        """Raises ResourceExistsError if the blob exists and `overwrite` is False."""
+
+    @abstractmethod
+    def delete_blob(self, container: str, name: str) -> None:
+        """Raises ResourceNotFoundError if the blob does not exist."""
+
+    @abstractmethod
+    def list_blobs(self, container: str, prefix: str = '') -> list[str]:
+        """Names of the blobs in the container starting with `prefix`, sorted."""
+
+    @abstractmethod
+    def acquire_lease(self, container: str, name: str, duration_s: int) -> str:
+        """
+        Lease the blob, created empty if missing, for `duration_s` seconds (15-60 on Azure)
+        and return the lease id. Raises LeaseHeldError if an unexpired lease is held.
+        """
+
+    @abstractmethod
+    def renew_lease(self, container: str, name: str, lease_id: str) -> None:
+        """Restart the lease's duration. Raises LeaseLostError if `lease_id` no longer holds the blob."""
+
+    @abstractmethod
+    def release_lease(self, container: str, name: str, lease_id: str) -> None:
+        """End the lease so the blob can be leased again at once; a lease already lost is ignored."""
+
+
+# --------------------------------------------------------------------------- azure
+
+class AzureTableStore(TableStore):
+    def __init__(self, connection_string: str, table_name: str) -> None:
+        from azure.data.tables import TableClient
+        self.table_name   = table_name
+        self.table_client = TableClient.from_connection_string(connection_string, table_name)
+
+    @staticmethod
+    def _to_dict(entity) -> dict[str, Any]:
+        result = dict(entity)
+        timestamp = entity.metadata.get('timestamp') if hasattr(entity, 'metadata') else None
+        if timestamp is not None:
+            result['Timestamp'] = timestamp
+        return result
+
+    @staticmethod
+    def _render_filters(filters: list[Filter]) -> tuple[str, dict[str, Any]]:
+        # The SDK substitutes @parameters word by word, so every token must be space separated
+        clauses: list[str] = []
+        parameters: dict[str, Any] = {}
+        for name, operator, value in filters:
+            if operator == 'in':
+                alternatives = []
+                for v in value:
+                    key = f'p{len(parameters)}'
+                    parameters[key] = v
+                    alternatives.append(f'{name} eq @{key}')
+                clauses.append(f"( {' or '.join(alternatives)} )" if alternatives else 'false')
+            elif operator in COMPARISON_OPERATORS:
+                key = f'p{len(parameters)}'
+                parameters[key] = value
+                clauses.append(f'{name} {operator} @{key}')
+            else:
+                raise ValueError(f'unsupported filter operator: {operator}')
+        return ' and '.join(clauses), parameters
+
+    def create_entity(self, entity: dict[str, Any]) -> None:
+        self.table_client.create_entity(entity)
+
+    def get_entity(self, partition_key: str, row_key: str) -> dict[str, Any]:
+        return self._to_dict(self.table_client.get_entity(partition_key, row_key))
+
+    def update_entity(self, entity: dict[str, Any]) -> None:
+        self.table_client.update_entity(entity)
+
+    def upsert_entity(self, entity: dict[str, Any]) -> None:
+        self.table_client.upsert_entity(entity)
+
+    def delete_entity(self, partition_key: str, row_key: str) -> None:
+        self.table_client.delete_entity(partition_key, row_key)
+
+    def query_entities(self, filters: list[Filter] | None = None, select: list[str] | None = None) -> Iterator[dict[str, Any]]:
+        if filters:
+            query_filter, parameters = self._render_filters(filters)
+            entities = self.table_client.query_entities(query_filter, parameters=parameters, select=select)
+        else:
+            entities = self.table_client.list_entities(select=select)
+        for entity in entities:
+            yield self._to_dict(entity)
+
+    def submit_batch(self, operations: list[tuple[str, dict[str, Any]]]) -> None:
+        # Entity group transactions must share a partition key and hold at most 100 operations
+        by_partition: dict[str, list[tuple[str, dict[str, Any]]]] = {}
+        for operation, entity in operations:
+            by_partition.setdefault(entity['PartitionKey'], []).append((operation, entity))
+        for partition_operations in by_partition.values():
+            for start in range(0, len(partition_operations), MAX_BATCH_SIZE):
+                self.table_client.submit_transaction(partition_operations[start:start + MAX_BATCH_SIZE])
+
+
+class AzureBlobStore(BlobStore):
+    def __init__(self, connection_string: str) -> None:
+        from azure.storage.blob import BlobServiceClient
+        self.service_client = BlobServiceClient.from_connection_string(connection_string)
+
+    def download_blob(self, container: str, name: str) -> bytes:
+        return self.service_client.get_blob_client(container, name).download_blob().readall()
+
+    def upload_blob(self, container: str, name: str, data: bytes | str, overwrite: bool = True) -> None:
+        blob_client = self.service_client.get_blob_client(container, name)
+        try:
+            blob_client.upload_blob(data, overwrite=overwrite)
+        except ResourceNotFoundError:
+            # Container does not exist yet
+            try:
+                self.service_client.create_container(container)
+            except ResourceExistsError:
+                pass
+            blob_client.upload_blob(data, overwrite=overwrite)
+
+    def delete_blob(self, container: str, name: str) -> None:
+        self.service_client.get_blob_client(container, name).delete_blob()
+
+    def list_blobs(self, container: str, prefix: str = '') -> list[str]:
+        container_client = self.service_client.get_container_client(container)
+        try:
+            return sorted(blob.name for blob in container_client.list_blobs(name_starts_with=prefix or None))
+        except ResourceNotFoundError:
+            return []
+
+    def acquire_lease(self, container: str, name: str, duration_s: int) -> str:
+        from azure.storage.blob import BlobLeaseClient
+        try:
+            self.upload_blob(container, name, b'', overwrite=False)
+        except ResourceExistsError:
+            pass
+        lease_client = BlobLeaseClient(self.service_client.get_blob_client(container, name))
+        try:
+            lease_client.acquire(lease_duration=duration_s)
+        except HttpResponseError as e:
+            if e.error_code == 'LeaseAlreadyPresent':
+                raise LeaseHeldError(f'blob already leased: {container}/{name}')
+            raise
+        return lease_client.id
+
+    def renew_lease(self, container: str, name: str, lease_id: str) -> None:
+        from azure.storage.blob import BlobLeaseClient
+        try:
+            BlobLeaseClient(self.service_client.get_blob_client(container, name), lease_id=lease_id).renew()
+        except HttpResponseError as e:
+            # LeaseIdMismatchWithLeaseOperation, LeaseIsBrokenAndCannotBeRenewed, BlobNotFound, ...
+            if e.status_code in (404, 409):
+                raise LeaseLostError(f'lease lost: {container}/{name} ({e.error_code})')
+            raise
+
+    def release_lease(self, container: str, name: str, lease_id: str) -> None:
+        from azure.storage.blob import BlobLeaseClient
+        try:
+            BlobLeaseClient(self.service_client.get_blob_client(container, name), lease_id=lease_id).release()
+        except HttpResponseError as e:
+            if e.status_code not in (404, 409):
+                raise
+
+
+# --------------------------------------------------------------------------- memory
+
+class InMemoryTableStore(TableStore):
+    def __init__(self, table_name: str) -> None:
+        self.table_name = table_name
+        self.entities: dict[tuple[str, str], dict[str, Any]] = {}
+        self.lock = threading.Lock()
+
+    def create_entity(self, entity: dict[str, Any]) -> None:
+        key = (entity['PartitionKey'], entity['RowKey'])
+        with self.lock:
+            if key in self.entities:
+                raise ResourceExistsError(f'entity already exists in {self.table_name}: {key}')
+            self.entities[key] = {**entity, 'Timestamp': utc_now()}
+
+    def get_entity(self, partition_key: str, row_key: str) -> dict[str, Any]:
+        with self.lock:
+            try:
+                return dict(self.entities[(partition_key, row_key)])
+            except KeyError:
+                raise ResourceNotFoundError(f'entity not found in {self.table_name}: {(partition_key, row_key)}')
+
+    def update_entity(self, entity: dict[str, Any]) -> None:
+        key = (entity['PartitionKey'], entity['RowKey'])
+        with self.lock:
+            if key not in self.entities:
+                raise ResourceNotFoundError(f'entity not found in {self.table_name}: {key}')
+            self.entities[key].update(entity, Timestamp=utc_now())
+
+    def upsert_entity(self, entity: dict[str, Any]) -> None:
+        key = (entity['PartitionKey'], entity['RowKey'])
+        with self.lock:
+            self.entities.setdefault(key, {}).update(entity, Timestamp=utc_now())
+
+    def delete_entity(self, partition_key: str, row_key: str) -> None:
+        with self.lock:
+            self.entities.pop((partition_key, row_key), None)
+
+    def query_entities(self, filters: list[Filter] | None = None, select: list[str] | None = None) -> Iterator[dict[str, Any]]:
+        with self.lock:
+            snapshot = list(self.entities.values())
+        for entity in snapshot:
+            if matches_filters(entity, filters or []):
+                yield _project(entity, select)
+
+
+class InMemoryBlobStore(BlobStore):
+    def __init__(self) -> None:
+        self.blobs: dict[tuple[str, str], bytes] = {}
+        self.leases: dict[tuple[str, str], tuple[str, float, int]] = {}  # lease id, monotonic expiry, duration
+        self.lock = threading.Lock()
+
+    def download_blob(self, container: str, name: str) -> bytes:
+        with self.lock:
+            try:
+                return self.blobs[(container, name)]
+            except KeyError:
+                raise ResourceNotFoundError(f'blob not found: {container}/{name}')
+
+    def upload_blob(self, container: str, name: str, data: bytes | str, overwrite: bool = True) -> None:
+        with self.lock:
+            if not overwrite and (container, name) in self.blobs:
+                raise ResourceExistsError(f'blob already exists: {container}/{name}')
+            self.blobs[(container, name)] = data.encode() if isinstance(data, str) else bytes(data)
+
+    def delete_blob(self, container: str, name: str) -> None:
+        with self.lock:
+            if self.blobs.pop((container, name), None) is None:
+                raise ResourceNotFoundError(f'blob not found: {container}/{name}')
+
+    def list_blobs(self, container: str, prefix: str = '') -> list[str]:
+        with self.lock:
+            return sorted(name for c, name in self.blobs if c == container and name.startswith(prefix))
+
+    def acquire_lease(self, container: str, name: str, duration_s: int) -> str:
+        with self.lock:
+            self.blobs.setdefault((container, name), b'')
+            lease = self.leases.get((container, name))
+            if lease is not None and lease[1] > time.monotonic():
+                raise LeaseHeldError(f'blob already leased: {container}/{name}')
+            lease_id = str(uuid.uuid4())
+            self.leases[(container, name)] = (lease_id, time.monotonic() + duration_s, duration_s)
+            return lease_id
+
+    def renew_lease(self, container: str, name: str, lease_id: str) -> None:
+        with self.lock:
+            lease = self.leases.get((container, name))
+            if lease is None or lease[0] != lease_id:
+                raise LeaseLostError(f'lease lost: {container}/{name}')
+            # Like Azure, an expired lease can be renewed as long as nobody else took the blob
+            self.leases[(container, name)] = (lease_id, time.monotonic() + lease[2], lease[2])
+
+    def release_lease(self, container: str, name: str, lease_id: str) -> None:
+        with self.lock:
+            lease = self.leases.get((container, name))
+            if lease is not None and lease[0] == lease_id:
+                del self.leases[(container, name)]
+
+
+# --------------------------------------------------------------------------- sqlite
+
+def _encode_properties(entity: dict[str, Any]) -> tuple[str, str]:
+    """Split an entity into JSON properties and a JSON map of the properties that were datetimes."""
+    properties: dict[str, Any] = {}
+    types: dict[str, str] = {}
+    for key, value in entity.items():
+        if key in ('PartitionKey', 'RowKey', 'Timestamp'):
+            continue
+        if isinstance(value, datetime):
+            properties[key] = _as_utc(value).strftime(r'%Y-%m-%dT%H:%M:%S.%fZ')
+            types[key] = 'datetime'
+        else:
+            properties[key] = value
+    return json.dumps(properties), json.dumps(types)
+
+
+def _decode_entity(partition_key: str, row_key: str, timestamp: str, properties: str, types: str) -> dict[str, Any]:
+    entity: dict[str, Any] = {'PartitionKey': partition_key, 'RowKey': row_key}
+    decoded = json.loads(properties)
+    for key in json.loads(types):
+        decoded[key] = datetime.strptime(decoded[key], r'%Y-%m-%dT%H:%M:%S.%fZ').replace(tzinfo=timezone.utc)
+    entity.update(decoded)
+    entity['Timestamp'] = datetime.strptime(timestamp, r'%Y-%m-%dT%H:%M:%S.%fZ').replace(tzinfo=timezone.utc)
+    return entity
+
+
+def _sql_value(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return _as_utc(value).strftime(r'%Y-%m-%dT%H:%M:%S.%fZ')
+    return value
+
+
+def _sql_column(name: str) -> str:
+    match name:
+        case 'PartitionKey': return 'partition_key'
+        case 'RowKey'      : return 'row_key'
+        case 'Timestamp'   : return 'timestamp'
+    if not name.replace('_', '').isalnum():
+        raise ValueError(f'unsupported property name: {name}')
+    return f"json_extract(properties, '$.{name}')"
+
+
+def _sql_same_type(name: str, value: Any) -> str | None:
+    """
+    SQL condition that property `name` holds a value of the same type as `value`,
+    since SQLite would otherwise order text, numbers and datetime strings against
+    each other. None for the key columns and types compared without a guard.
+    """
+    if name in ('PartitionKey', 'RowKey', 'Timestamp'):
+        return None
+    json_type   = f"json_type(properties, '$.{name}')"
+    stored_type = f"json_extract(types, '$.{name}')"
+    if isinstance(value, datetime):
+        return f"{stored_type} IS 'datetime'"
+    if isinstance(value, str):
+        return f"{json_type} = 'text' AND {stored_type} IS NULL"
+    if isinstance(value, (bool, int, float)):
+        return f"{json_type} IN ('integer', 'real', 'true', 'false')"
+    return None
+
+
+def _sql_comparison(name: str, operator: str, value: Any) -> str:
+    """One filter as SQL with a single `?` parameter; across types only `ne` matches, as in `_compare`."""
+    column = _sql_column(name)
+    same_type = _sql_same_type(name, value)
+    if same_type is None:
+        return f'{column} {_SQL_OPERATORS[operator]} ?'
+    if operator == 'ne':
+        return f"(json_type(properties, '$.{name}') IS NOT NULL AND NOT ({same_type} AND {column} = ?))"
+    return f'({same_type} AND {column} {_SQL_OPERATORS[operator]} ?)'
+
+
+_SQL_OPERATORS = {'eq': '=', 'ne': '!=', 'gt': '>', 'ge': '>=', 'lt': '<', 'le': '<='}
+
+
+class SqliteTableStore(TableStore):
+    def __init__(self, connection: sqlite3.Connection, lock: threading.Lock, table_name: str) -> None:
+        self.table_name = table_name
+        self.connection = connection
+        self.lock       = lock
+        self.sql_table  = f'table_{table_name}'
+        with self.lock, self.connection:
+            self.connection.execute(
+                f'CREATE TABLE IF NOT EXISTS "{self.sql_table}" ('
+                'partition_key TEXT NOT NULL, row_key TEXT NOT NULL, timestamp TEXT NOT NULL, '
+                'properties TEXT NOT NULL, types TEXT NOT NULL, PRIMARY KEY (partition_key, row_key))'
+            )
+
+    def _select(self, partition_key: str, row_key: str) -> tuple | None:
+        return self.connection.execute(
+            f'SELECT partition_key, row_key, timestamp, properties, types FROM "{self.sql_table}" WHERE partition_key = ? AND row_key = ?',
+            (partition_key, row_key),
+        ).fetchone()
+
+    def _write(self, entity: dict[str, Any], merge_into: tuple | None) -> None:
+        if merge_into is not None:
+            entity = {**_decode_entity(*merge_into), **entity}
+        properties, types = _encode_properties(entity)
+        self.connection.execute(
+            f'INSERT OR REPLACE INTO "{self.sql_table}" VALUES (?, ?, ?, ?, ?)',
+            (entity['PartitionKey'], entity['RowKey'], _sql_value(utc_now()), properties, types),
+        )
+
+    def create_entity(self, entity: dict[str, Any]) -> None:
+        with self.lock, self.connection:
+            if self._select(entity['PartitionKey'], entity['RowKey']) is not None:
+                raise ResourceExistsError(f"entity already exists in {self.table_name}: {(entity['PartitionKey'], entity['RowKey'])}")
+            self._write(entity, None)
+
+    def get_entity(self, partition_key: str, row_key: str) -> dict[str, Any]:
+        with self.lock:
+            row = self._select(partition_key, row_key)
+        if row is None:
+            raise ResourceNotFoundError(f'entity not found in {self.table_name}: {(partition_key, row_key)}')
+        return _decode_entity(*row)
+
+    def update_entity(self, entity: dict[str, Any]) -> None:
+        with self.lock, self.connection:
+            row = self._select(entity['PartitionKey'], entity['RowKey'])
+            if row is None:
+                raise ResourceNotFoundError(f"entity not found in {self.table_name}: {(entity['PartitionKey'], entity['RowKey'])}")
+            self._write(entity, row)
+
+    def upsert_entity(self, entity: dict[str, Any]) -> None:
+        with self.lock, self.connection:
+            self._write(entity, self._select(entity['PartitionKey'], entity['RowKey']))
+
+    def delete_entity(self, partition_key: str, row_key: str) -> None:
+        with self.lock, self.connection:
+            self.connection.execute(
+                f'DELETE FROM "{self.sql_table}" WHERE partition_key = ? AND row_key = ?',
+                (partition_key, row_key),
+            )
+
+    def query_entities(self, filters: list[Filter] | None = None, select: list[str] | None = None) -> Iterator[dict[str, Any]]:
+        clauses: list[str] = []
+        parameters: list[Any] = []
+        for name, operator, value in filters or []:
+            if operator == 'in':
+                clauses.append(f"({' OR '.join(_sql_comparison(name, 'eq', v) for v in value)})" if value else '0')
+                parameters.extend(_sql_value(v) for v in value)
+            elif operator in _SQL_OPERATORS:
+                clauses.append(_sql_comparison(name, operator, value))
+                parameters.append(_sql_value(value))
+            else:
+                raise ValueError(f'unsupported filter operator: {operator}')
+
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ''
+        with self.lock:
+            rows = self.connection.execute(
+                f'SELECT partition_key, row_key, timestamp, properties, types FROM "{self.sql_table}"{where}',
+                parameters,
+            ).fetchall()
+        for row in rows:
+            yield _project(_decode_entity(*row), select)
+
+    def submit_batch(self, operations: list[tuple[str, dict[str, Any]]]) -> None:
+        # One SQLite transaction per batch, so a failure leaves no partial writes
+        with self.lock, self.connection:
+            for operation, entity in operations:
+                row = self._select(entity['PartitionKey'], entity['RowKey'])
+                match operation:
+                    case 'create':
+                        if row is not None:
+                            raise ResourceExistsError(f"entity already exists in {self.table_name}: {(entity['PartitionKey'], entity['RowKey'])}")
+                        self._write(entity, None)
+                    case 'update':
+                        if row is None:
+                            raise ResourceNotFoundError(f"entity not found in {self.table_name}: {(entity['PartitionKey'], entity['RowKey'])}")
+                        self._write(entity, row)
+                    case 'upsert':
+                        self._write(entity, row)
+                    case 'delete':
+                        self.connection.execute(
+                            f'DELETE FROM "{self.sql_table}" WHERE partition_key = ? AND row_key = ?',
+                            (entity['PartitionKey'], entity['RowKey']),
+                        )
+                    case _:
+                        raise ValueError(f'unsupported batch operation: {operation}')
+
+
+class SqliteBlobStore(BlobStore):
+    def __init__(self, connection: sqlite3.Connection, lock: threading.Lock) -> None:
+        self.connection = connection
+        self.lock       = lock
+        with self.lock, self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS blobs (container TEXT NOT NULL, name TEXT NOT NULL, data BLOB NOT NULL, PRIMARY KEY (container, name))'
+            )
+            # Expiry is wall-clock time, so leases hold between the processes sharing the file
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS blob_leases (container TEXT NOT NULL, name TEXT NOT NULL, lease_id TEXT NOT NULL, expires_at REAL NOT NULL, duration_s INTEGER NOT NULL, PRIMARY KEY (container, name))'
+            )
+
+    def download_blob(self, container: str, name: str) -> bytes:
+        with self.lock:
+            row = self.connection.execute('SELECT data FROM blobs WHERE container = ? AND name = ?', (container, name)).fetchone()
+        if row is None:
+            raise ResourceNotFoundError(f'blob not found: {container}/{name}')
+        return row[0]
+
+    def upload_blob(self, container: str, name: str, data: bytes | str, overwrite: bool = True) -> None:
+        data = data.encode() if isinstance(data, str) else bytes(data)
+        with self.lock, self.connection:
+            if overwrite:
+                self.connection.execute('INSERT OR REPLACE INTO blobs VALUES (?, ?, ?)', (container, name, data))
+                return
+            try:
+                self.connection.execute('INSERT INTO blobs VALUES (?, ?, ?)', (container, name, data))
+            except sqlite3.IntegrityError:
+                raise ResourceExistsError(f'blob already exists: {container}/{name}')
+
+    def delete_blob(self, container: str, name: str) -> None:
+        with self.lock, self.connection:
+            cursor = self.connection.execute('DELETE FROM blobs WHERE container = ? AND name = ?', (container, name))
+        if cursor.rowcount == 0:
+            raise ResourceNotFoundError(f'blob not found: {container}/{name}')
+
+    def list_blobs(self, container: str, prefix: str = '') -> list[str]:
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT name FROM blobs WHERE container = ? AND substr(name, 1, ?) = ? ORDER BY name',
+                (container, len(prefix), prefix),
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def acquire_lease(self, container: str, name: str, duration_s: int) -> str:
+        lease_id = str(uuid.uuid4())
+        with self.lock, self.connection:
+            # BEGIN IMMEDIATE takes the write lock first, so two processes cannot both see the lease free
+            self.connection.execute('BEGIN IMMEDIATE')
+            self.connection.execute('INSERT OR IGNORE INTO blobs VALUES (?, ?, ?)', (container, name, b''))
+            row = self.connection.execute('SELECT expires_at FROM blob_leases WHERE container = ? AND name = ?', (container, name)).fetchone()
+            if row is not None and row[0] > time.time():
+                raise LeaseHeldError(f'blob already leased: {container}/{name}')
+            self.connection.execute('INSERT OR REPLACE INTO blob_leases VALUES (?, ?, ?, ?, ?)', (container, name, lease_id, time.time() + duration_s, duration_s))
+        return lease_id
+
+    def renew_lease(self, container: str, name: str, lease_id: str) -> None:
+        with self.lock, self.connection:
+            cursor = self.connection.execute(
+                'UPDATE blob_leases SET expires_at = ? + duration_s WHERE container = ? AND name = ? AND lease_id = ?',
+                (time.time(), container, name, lease_id),
+            )
+        if cursor.rowcount == 0:
+            raise LeaseLostError(f'lease lost: {container}/{name}')
+
+    def release_lease(self, container: str, name: str, lease_id: str) -> None:
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM blob_leases WHERE container = ? AND name = ? AND lease_id = ?', (container, name, lease_id))
+
+
+# --------------------------------------------------------------------------- latency and throttling
+
+class Throttle:
+    """
+    Injects latency before each storage operation and rejects operations beyond
+    `max_ops_per_second` with StorageThrottledError, the way Azure answers 503 ServerBusy.
+    """
+
+    def __init__(self, latency_ms: float = 0, jitter_ms: float = 0, max_ops_per_second: float | None = None) -> None:
+        self.latency_ms         = latency_ms
+        self.jitter_ms          = jitter_ms
+        self.max_ops_per_second = max_ops_per_second
+        self.recent_ops: deque[float] = deque()
+        self.lock = threading.Lock()
+
+    def __call__(self, operation: str) -> None:
+        if self.max_ops_per_second:
+            now = time.monotonic()
+            with self.lock:
+                while self.recent_ops and now - self.recent_ops[0] >= 1:
+                    self.recent_ops.popleft()
+                if len(self.recent_ops) >= self.max_ops_per_second:
+                    raise StorageThrottledError(f'injected throttling on {operation}: over {self.max_ops_per_second} ops/second')
+                self.recent_ops.append(now)
+        delay_ms = self.latency_ms + random.uniform(0, self.jitter_ms)
+        if delay_ms > 0:
+            time.sleep(delay_ms / 1000)
+
+
+class _ThrottledStore:
+    """Wraps a TableStore or BlobStore so every public operation goes through a Throttle first."""
+
+    def __init__(self, inner: TableStore | BlobStore, throttle: Throttle) -> None:
+        self._inner    = inner
+        self._throttle = throttle
+
+    def __getattr__(self, name: str) -> Any:
+        attribute = getattr(self._inner, name)
+        if name.startswith('_') or not callable(attribute):
+            return attribute
+
+        def throttled(*args: Any, **kwargs: Any) -> Any:
+            self._throttle(name)
+            return attribute(*args, **kwargs)
+        return throttled
+
+
+# --------------------------------------------------------------------------- factory
+
+_stores: dict[Any, Any] = {}
+_stores_lock = threading.Lock()
+
+
+def _throttle_from_env() -> Throttle | None:
+    latency_ms         = float(os.getenv('STORAGE_LATENCY_MS', '0'))
+    jitter_ms          = float(os.getenv('STORAGE_LATENCY_JITTER_MS', '0'))
+    max_ops_per_second = float(os.getenv('STORAGE_MAX_OPS_PER_SECOND', '0')) or None
+    if not latency_ms and not jitter_ms and not max_ops_per_second:
+        return None
+    return Throttle(latency_ms, jitter_ms, max_ops_per_second)
+
+
+def _sqlite_connection() -> tuple[sqlite3.Connection, threading.Lock]:
+    if 'sqlite' not in _stores:
+        path = os.getenv('STORAGE_SQLITE_PATH', 'storage.sqlite3')
+        connection = sqlite3.connect(path, check_same_thread=False)
+        # WAL keeps per-write commits from being fsync bound, which would dominate any benchmark
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        _stores['sqlite'] = (connection, threading.Lock())
+    return _stores['sqlite']
+
+
+def get_table_store(table_name: str) -> TableStore:
+    """Return the process-wide store for `table_name` on the configured backend."""
+    with _stores_lock:
+        if ('table', table_name) not in _stores:
+            backend = os.getenv('STORAGE_BACKEND', 'azure')
+            match backend:
+                case 'azure' : store = AzureTableStore(os.environ['STORAGE_ACCOUNT_CONNECTION_STRING'], table_name)
+                case 'memory': store = InMemoryTableStore(table_name)
+                case 'sqlite': store = SqliteTableStore(*_sqlite_connection(), table_name)
+                case _       : raise ValueError(f'unsupported STORAGE_BACKEND: {backend}')
+            throttle = _throttle_from_env()
+            _stores[('table', table_name)] = _ThrottledStore(store, throttle) if throttle else store
+            ptmlog.get_logger().debug('created table store', backend=backend, table_name=table_name, throttled=throttle is not None)
+        return _stores[('table', table_name)]
+
+
+def get_blob_store() -> BlobStore:
+    """Return the process-wide blob store on the configured backend."""
+    with _stores_lock:
+        if 'blob' not in _stores:
+            backend = os.getenv('STORAGE_BACKEND', 'azure')
+            match backend:
+                case 'azure' : store = AzureBlobStore(os.environ['STORAGE_ACCOUNT_CONNECTION_STRING'])
+                case 'memory': store = InMemoryBlobStore()
+                case 'sqlite': store = SqliteBlobStore(*_sqlite_connection())
+                case _       : raise ValueError(f'unsupported STORAGE_BACKEND: {backend}')
+            throttle = _throttle_from_env()
+            _stores['blob'] = _ThrottledStore(store, throttle) if throttle else store
+            ptmlog.get_logger().debug('created blob store', backend=backend, throttled=throttle is not None)
+        return _stores['blob']
+
+
+def reset_stores() -> None:
+    """Drop cached stores so the next call picks up changed environment variables (benchmarks, tests)."""
+    with _stores_lock:
+        connection = _stores.get('sqlite')
+        if connection is not None:
+            connection[0].close()
+        _stores.clear()
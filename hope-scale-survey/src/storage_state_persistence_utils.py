@@ -1,23 +1,17 @@
 from pathlib import Path
 import json
-from azure.storage.blob import BlobClient
 from azure.core.exceptions import ResourceNotFoundError
-import os
 
 from shared import ptmlog
+from storage_backends import get_blob_store
 
-STORAGE_ACCOUNT_CONNECTION_STRING = os.environ['STORAGE_ACCOUNT_CONNECTION_STRING']
+CONTAINER_NAME = 'playwright-storage-state'
 
 
 def get_playwright_storage_state(id: str):
     logger = ptmlog.get_logger()
-    client = BlobClient.from_connection_string(
-        conn_str       = STORAGE_ACCOUNT_CONNECTION_STRING,
-        container_name = 'playwright-storage-state',
-        blob_name      = id,
-    )
     try:
-        storage_state = json.load(client.download_blob())
+        storage_state = json.loads(get_blob_store().download_blob(CONTAINER_NAME, id))
         logger.debug('loaded playwright storage state from blob', id=id)
         return storage_state
     except ResourceNotFoundError:
@@ -27,13 +21,10 @@ def get_playwright_storage_state(id: str):
 
 def save_playwright_storage_state(id: str, storage_state) -> None:
     logger = ptmlog.get_logger()
-    client = BlobClient.from_connection_string(
-        conn_str       = STORAGE_ACCOUNT_CONNECTION_STRING,
-        container_name = 'playwright-storage-state',
-        blob_name      = id,
-    )
-    client.upload_blob(
-        data = json.dumps(storage_state),
+    get_blob_store().upload_blob(
+        container = CONTAINER_NAME,
+        name      = id,
+        data      = json.dumps(storage_state),
         overwrite = True,
     )
     logger.debug('saved playwright storage state to blob', id=id)
@@ -45,13 +36,8 @@ def delete_playwright_storage_state(id: str) -> None:
     Called when session is detected as expired/invalid to force fresh login.
     """
     logger = ptmlog.get_logger()
-    client = BlobClient.from_connection_string(
-        conn_str       = STORAGE_ACCOUNT_CONNECTION_STRING,
-        container_name = 'playwright-storage-state',
-        blob_name      = id,
-    )
     try:
-        client.delete_blob()
+        get_blob_store().delete_blob(CONTAINER_NAME, id)
         logger.info('deleted playwright storage state from blob', id=id)
     except ResourceNotFoundError:
         logger.debug('no playwright storage state to delete', id=id)
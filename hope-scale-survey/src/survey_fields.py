@@ -0,0 +1,135 @@
+"""
+Survey response fields written to appointment rows by the submit function.
+
+The table holds two generations of the form: the original Hope Scale survey
+(`*_before`/`*_after` items, agreement questions) and the current BHUC
+satisfaction survey. Both are listed here so reporting code can type and score
+responses without scanning the table to discover columns.
+"""
+from datetime import datetime, timedelta, timezone
+import os
+import re
+
+# Survey completions only exist after this date; the lower bound for "completed since" queries
+EPOCH = datetime(2000, 1, 1, tzinfo=timezone.utc)
+
+COMPLETION_SETTLE_SECONDS_DEFAULT = 300
+
+HOPE_SCALE = {
+    'No Hope'    : 1,
+    'Little Hope': 2,
+    'Some Hope'  : 3,
+    'Strong Hope': 4,
+}
+
+AGREEMENT_SCALE = {
+    'Strongly Disagree': 1,
+    'Disagree'         : 2,
+    'Neutral'          : 3,
+    'Agree'            : 4,
+    'Strongly Agree'   : 5,
+}
+
+SATISFACTION_SCALE = {
+    'Very Unsatisfied': 1,
+    'Unsatisfied'     : 2,
+    'Neutral'         : 3,
+    'Satisfied'       : 4,
+    'Very Satisfied'  : 5,
+}
+
+LIKELIHOOD_SCALE = {
+    'Very Unlikely': 1,
+    'Unlikely'     : 2,
+    'Neutral'      : 3,
+    'Likely'       : 4,
+    'Very Likely'  : 5,
+}
+
+# The original form stored 1-5 ratings, the current form stores labels on the same 1-5 direction
+EASE_SCALE = {
+    '1': 1, '2': 2, '3': 3, '4': 4, '5': 5,
+    'Very difficult': 1,
+    'Difficult'     : 2,
+    'Neutral'       : 3,
+    'Easy'          : 4,
+    'Very Easy'     : 5,
+}
+
+RATING_SCALE = {'1': 1, '2': 2, '3': 3, '4': 4, '5': 5}
+
+YES_NO_SCALE = {
+    'No' : 0,
+    'Yes': 1,
+}
+
+HOPE_SCALE_ITEMS = [
+    'ContactSomeoneIfINeedSupport',
+    'FindResourcesToHelpMe',
+    'HaveTheAbilityToIdentifyTheThingsInLifeThatAreImportanToMe',
+    'MeetTheGoalsThatISetForMyself',
+    'TryNewSolutionsToMyChallenges',
+]
+
+HOPE_SCALE_FIELDS = [f'{item}_{when}' for item in HOPE_SCALE_ITEMS for when in ('before', 'after')]
+
+# Field -> label to score mapping
+SCORED_FIELDS: dict[str, dict[str, int]] = {
+    **{field: HOPE_SCALE for field in HOPE_SCALE_FIELDS},
+    'RecommendCommonGroundToFriendInNeed': AGREEMENT_SCALE,
+    'MoreHopeByVisit'                    : AGREEMENT_SCALE,
+    'SatisfiedWithHelpReceived'          : AGREEMENT_SCALE,
+    'InformationClearly'                 : YES_NO_SCALE,
+    'reasonAppropriatelyAddressed'       : YES_NO_SCALE,
+    'rateYourOverallExperience'          : RATING_SCALE,
+    'ExperienceOfSchedulingAnAppointment': EASE_SCALE,
+    'SatisfactionWithService'            : SATISFACTION_SCALE,
+    'LikelihoodToRecommendBHUC'          : LIKELIHOOD_SCALE,
+}
+
+# Free text, or answers whose meaning changed between form versions (StaffFriendlyAndWelcoming was agreement, now yes/no)
+TEXT_FIELDS = [
+    'StaffFriendlyAndWelcoming',
+    'WaitingRoomTimeExperience',
+    'ProceedWithMoreQuestions',
+    'HowDidYouHearAboutBHUC',
+    'HowDidYouHearAboutBHUC_Other',
+    'AreThereAnyOtherCommentsYouWouldLikeToMake',
+]
+
+# Appointment columns that identify the patient; never copied into reporting outputs
+PATIENT_IDENTIFYING_FIELDS = ['patientName', 'patientDOB', 'patientPhone']
+
+
+def score(field: str, value: object) -> int | None:
+    """Numeric score of a response, or None when the field is not scored or the label is unknown."""
+    scale = SCORED_FIELDS.get(field)
+    if scale is None or not isinstance(value, str):
+        return None
+    return scale.get(value.strip())
+
+
+def completions_settled_through() -> datetime:
+    """
+    Newest `surveyCompletedOn` that watermark readers may consume. The survey
+    service stamps a submission when it is received but writes it up to
+    `SUBMIT_MAX_ATTEMPTS` flushes later, so a row completed just before a read
+    can still land after it; readers leave the last `SURVEY_COMPLETION_SETTLE_SECONDS`
+    for the next run instead of moving their watermark past it.
+    """
+    settle = float(os.getenv('SURVEY_COMPLETION_SETTLE_SECONDS', str(COMPLETION_SETTLE_SECONDS_DEFAULT)))
+    return datetime.now(timezone.utc) - timedelta(seconds=settle)
+
+
+def parse_datetime(value: object) -> datetime | None:
+    """Table DateTime values come back as datetimes; older rows may hold ISO strings with 7 fractional digits."""
+    if isinstance(value, datetime):
+        return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+    if not isinstance(value, str) or not value:
+        return None
+    value = re.sub(r'(\.\d{6})\d+', r'\1', value.strip()).replace('Z', '+00:00')
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
@@ -0,0 +1,409 @@
+"""
+Concurrent survey sending.
+
+Appointments are sent by a bounded pool of workers (`TWILIO_SEND_WORKERS`)
+sharing one Twilio client, while a token bucket keeps the overall rate within
+the messaging service's throughput (`TWILIO_MESSAGES_PER_SECOND`, bursts of up
+to `TWILIO_SEND_BURST`). Each accepted message is written to the local send
+journal (`send_journal.py`) before the worker moves on; the table is updated
+from the journal in batches by a background flusher, so sends never wait on a
+table round trip and a failed update cannot lead to a second text.
+
+When a send window or pace is configured (see `send_scheduler.py`), each
+appointment is given a send slot and dispatched to the pool when it comes due.
+
+Phone numbers are normalized to E.164 and checked against the local cache of
+numbers Twilio rejected before (`phone_utils.py`) before anything is sent, so
+impossible or known-bad numbers never cost an API call.
+
+A patient (by normalized phone) is surveyed at most once per
+`SURVEY_COOLDOWN_DAYS`, checked against the in-memory contact index
+(`contact_index.py`) right before each send.
+
+Failed sends are classified by `twilio_utils.classify_error`. Retryable and
+throttled failures are retried within the run (up to `TWILIO_SEND_MAX_ATTEMPTS`
+attempts) after a jittered exponential backoff that honors Retry-After, and
+throttling halves the number of sends in flight until requests succeed again.
+Sends that may have reached Twilio (uncertain) are never retried: they are
+journaled without a SID and left for delivery reconciliation.
+"""
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+import os
+import threading
+import time
+
+from twilio.base.exceptions import TwilioRestException
+
+import appointments_table_utils
+import contact_index
+import deadlines
+import phone_utils
+import twilio_utils
+from models import TableAppointment
+from contact_index import ContactIndex
+from phone_utils import BAD_NUMBER_ERROR_CODES, BadPhoneNumbers, InvalidPhoneNumber
+from rate_limit_utils import AdaptiveConcurrencyLimit, TokenBucket, backoff_delay
+from run_lease import RunLease
+from send_journal import SEND_UNCERTAIN, SendJournal
+from send_scheduler import EASTERN_TZ, Dispatcher, SendSchedule, assign_slots
+from shared import ptmlog
+
+# Twilio queues messages for a long-code messaging service at about 1 per second per sender
+MESSAGES_PER_SECOND_DEFAULT = 1.0
+MAX_ATTEMPTS_DEFAULT        = 5
+
+
+def get_messages_per_second() -> float:
+    return float(os.getenv('TWILIO_MESSAGES_PER_SECOND', str(MESSAGES_PER_SECOND_DEFAULT)))
+
+
+def get_send_burst() -> float | None:
+    burst = os.getenv('TWILIO_SEND_BURST')
+    return float(burst) if burst else None
+
+
+def get_max_attempts() -> int:
+    return max(1, int(os.getenv('TWILIO_SEND_MAX_ATTEMPTS', str(MAX_ATTEMPTS_DEFAULT))))
+
+
+class SendPipeline:
+    """State shared by every send worker of one run: rate limits, retry policy, journal and bad-number cache."""
+
+    def __init__(
+        self,
+        bucket      : TokenBucket,
+        concurrency : AdaptiveConcurrencyLimit,
+        max_attempts: int,
+        journal     : SendJournal,
+        bad_numbers : BadPhoneNumbers,
+        contacts    : ContactIndex,
+    ) -> None:
+        self.bucket           = bucket
+        self.concurrency      = concurrency
+        self.max_attempts     = max_attempts
+        self.journal          = journal
+        self.bad_numbers      = bad_numbers
+        self.contacts         = contacts
+        self.cooldown_skipped : list[TableAppointment] = []
+        self.stopping         = threading.Event()
+
+    def send_with_retries(self, table_appointment: TableAppointment, counts: Counter[str]) -> str | None:
+        """
+        Send one survey, retrying retryable and throttled failures.
+        Returns the message SID, or None once the send has failed for good.
+        """
+        logger = ptmlog.get_logger()
+
+        for attempt in range(1, self.max_attempts + 1):
+            waited = self.bucket.acquire()
+            self.concurrency.acquire()
+            logger.info('sending survey', patient_name=table_appointment.patient_name, attempt=attempt, rate_limit_wait_s=round(waited, 3))
+            try:
+                message_sid = twilio_utils.send_survey(
+                    id            = table_appointment.row_key,
+                    patient_name  = table_appointment.patient_name,
+                    patient_phone = table_appointment.patient_phone,
+                )
+            except Exception as e:
+                error_class = twilio_utils.classify_error(e)
+                retry_after = twilio_utils.retry_after_seconds()
+                self.concurrency.release(throttled=error_class == twilio_utils.THROTTLED)
+                counts[error_class] += 1
+
+                if error_class == twilio_utils.UNCERTAIN:
+                    logger.exception('survey send outcome unknown, leaving it for reconciliation', patient_name=table_appointment.patient_name, attempts=attempt, error=str(e))
+                    return None
+
+                if error_class == twilio_utils.PERMANENT or attempt == self.max_attempts:
+                    logger.exception('error sending survey', patient_name=table_appointment.patient_name, error_class=error_class, attempts=attempt, error=str(e))
+                    if error_class != twilio_utils.PERMANENT:
+                        counts['retries_exhausted'] += 1
+                    elif isinstance(e, TwilioRestException) and e.code in BAD_NUMBER_ERROR_CODES:
+                        self.bad_numbers.add(table_appointment.patient_phone, BAD_NUMBER_ERROR_CODES[e.code], e.code)
+                    return None
+
+                delay = backoff_delay(attempt, retry_after=retry_after)
+                logger.warning('retrying survey send',
+                    patient_name = table_appointment.patient_name,
+                    error_class  = error_class,
+                    attempt      = attempt,
+                    retry_after  = retry_after,
+                    delay_s      = round(delay, 3),
+                    concurrency  = self.concurrency.limit,
+                    error        = str(e),
+                )
+                counts['retries'] += 1
+                time.sleep(delay)
+                continue
+
+            self.concurrency.release()
+            return message_sid
+
+        return None
+
+    def send_and_record(self, table_appointment: TableAppointment) -> Counter[str]:
+        """
+        Send one survey and journal its SID for the table flusher.
+        Returns this appointment's counts; errors are logged, never raised.
+        """
+        logger = ptmlog.get_logger()
+        counts: Counter[str] = Counter()
+
+        if self.stopping.is_set():
+            # Past the send deadline: leave the appointment pending for the next run
+            counts['deadline_skipped'] += 1
+            return counts
+
+        if not self.contacts.claim(table_appointment.patient_phone, datetime.now(timezone.utc), table_appointment.row_key):
+            logger.info('skipping survey, patient surveyed within cooldown', patient_name=table_appointment.patient_name)
+            self.cooldown_skipped.append(table_appointment)
+            counts['cooldown_skipped'] += 1
+            return counts
+
+        message_sid = self.send_with_retries(table_appointment, counts)
+        if message_sid is None and counts[twilio_utils.UNCERTAIN]:
+            # The patient may have the text: keep the claim and keep the row out of later runs
+            self.record_uncertain(table_appointment, counts)
+            return counts
+        if message_sid is None:
+            self.contacts.release(table_appointment.patient_phone)
+            counts['errors'] += 1
+            return counts
+        counts['sent'] += 1
+        sent_on = datetime.now(timezone.utc)
+        self.contacts.record_sent(table_appointment.patient_phone, table_appointment.row_key, sent_on)
+
+        try:
+            self.journal.record_sent(table_appointment.row_key, table_appointment.partition_key, table_appointment.patient_phone, message_sid, sent_on)
+            counts['recorded'] += 1
+            return counts
+        except Exception as e:
+            logger.exception('error writing send journal, updating table appointment directly', patient_name=table_appointment.patient_name, error=str(e))
+
+        self.upsert_contact(table_appointment, sent_on)
+        try:
+            appointments_table_utils.update_appointment(
+                row_key       = table_appointment.row_key,
+                partition_key = table_appointment.partition_key,
+                sent_on       = sent_on,
+                message_sid   = message_sid,
+            )
+        except Exception as e:
+            logger.exception('error updating table appointment', patient_name=table_appointment.patient_name, error=str(e))
+            counts['errors'] += 1
+            return counts
+
+        counts['recorded'] += 1
+        return counts
+
+    def record_uncertain(self, table_appointment: TableAppointment, counts: Counter[str]) -> None:
+        """Set aside a send that may have reached Twilio, so reconciliation decides whether it went out."""
+        logger = ptmlog.get_logger()
+        sent_on = datetime.now(timezone.utc)
+
+        try:
+            self.journal.record_uncertain(table_appointment.row_key, table_appointment.partition_key, table_appointment.patient_phone, sent_on)
+            return
+        except Exception as e:
+            logger.exception('error writing send journal, marking table appointment directly', patient_name=table_appointment.patient_name, error=str(e))
+
+        self.upsert_contact(table_appointment, sent_on)
+        try:
+            appointments_table_utils.update_appointment(
+                row_key        = table_appointment.row_key,
+                partition_key  = table_appointment.partition_key,
+                sent_on        = sent_on,
+                message_sid    = '',
+                skipped_reason = SEND_UNCERTAIN,
+            )
+        except Exception as e:
+            logger.exception('error marking uncertain send', patient_name=table_appointment.patient_name, error=str(e))
+            counts['errors'] += 1
+
+    def upsert_contact(self, table_appointment: TableAppointment, sent_on: datetime) -> None:
+        """Write the contact row directly, for a send the journal could not take (its flusher normally does this)."""
+        logger = ptmlog.get_logger()
+        try:
+            contact_index.upsert_contacts([(table_appointment.patient_phone, table_appointment.row_key, sent_on)])
+        except Exception as e:
+            logger.exception('error updating contact index', patient_name=table_appointment.patient_name, error=str(e))
+
+
+def mark_cooldown_skipped(table_appointments: list[TableAppointment]) -> None:
+    """
+    Close out appointments skipped because the patient was surveyed recently, so
+    they are not sent once the cooldown ends. `sentOn` is set with an empty
+    `message_sid` and `surveySkippedReason`.
+    """
+    logger = ptmlog.get_logger()
+    if not table_appointments:
+        return
+    skipped_on = datetime.now(timezone.utc)
+    try:
+        appointments_table_utils.update_appointments([
+            dict(
+                PartitionKey        = table_appointment.partition_key,
+                RowKey              = table_appointment.row_key,
+                sentOn              = skipped_on,
+                message_sid         = '',
+                surveySkippedReason = 'contact_cooldown',
+            )
+            for table_appointment in table_appointments
+        ])
+    except Exception as e:
+        # They stay pending and are checked against the cooldown again next run
+        logger.exception('error marking cooldown-skipped appointments', count=len(table_appointments), error=str(e))
+
+
+def validate_phones(table_appointments: list[TableAppointment], bad_numbers: BadPhoneNumbers) -> tuple[list[TableAppointment], Counter[str]]:
+    """
+    Normalize phone numbers to E.164, dropping numbers that cannot exist and numbers
+    Twilio already rejected. Dropped appointments stay pending and cost no API call.
+    """
+    logger = ptmlog.get_logger()
+    counts: Counter[str] = Counter()
+
+    valid: list[TableAppointment] = []
+    for table_appointment in table_appointments:
+        try:
+            phone = phone_utils.normalize_phone(table_appointment.patient_phone)
+        except InvalidPhoneNumber as e:
+            logger.warning('skipping survey, invalid phone number', patient_name=table_appointment.patient_name, reason=e.reason)
+            counts['invalid_phone'] += 1
+            continue
+        if phone in bad_numbers:
+            logger.warning('skipping survey, phone number previously rejected', patient_name=table_appointment.patient_name, reason=bad_numbers.reason(phone))
+            counts['known_bad_phone'] += 1
+            continue
+        valid.append(table_appointment.model_copy(update={'patient_phone': phone}))
+
+    return valid, counts
+
+
+def send_surveys_concurrently(
+    table_appointments: list[TableAppointment],
+    max_workers: int | None = None,
+    messages_per_second: float | None = None,
+    lease: RunLease | None = None,
+) -> dict[str, int | float]:
+    """
+    Send surveys for `table_appointments` with a bounded worker pool and a shared rate limit.
+    Appointments already in the send journal are skipped. If the run's `send` lease is lost,
+    no new sends are handed out, as at the send deadline.
+    Returns counts of messages sent, rows recorded, errors, retries and each error class.
+    """
+    logger = ptmlog.get_logger()
+
+    # Replay: commit sends an earlier run journaled but never wrote to the table
+    journal = SendJournal.open()
+    replayed, _ = journal.commit_pending()
+
+    unsent = [table_appointment for table_appointment in table_appointments if table_appointment.row_key not in journal]
+    skipped_journaled = len(table_appointments) - len(unsent)
+    if skipped_journaled:
+        logger.warning('skipping appointments already in send journal', count=skipped_journaled)
+
+    bad_numbers = BadPhoneNumbers.load()
+    unsent, rejected = validate_phones(unsent, bad_numbers)
+
+    max_workers = max_workers or twilio_utils.get_send_workers()
+    pipeline = SendPipeline(
+        bucket       = TokenBucket(messages_per_second or get_messages_per_second(), get_send_burst()),
+        concurrency  = AdaptiveConcurrencyLimit(max_workers),
+        max_attempts = get_max_attempts(),
+        journal      = journal,
+        bad_numbers  = bad_numbers,
+        contacts     = ContactIndex.load(),
+    )
+    logger.info('sending surveys',
+        count               = len(unsent),
+        workers             = max_workers,
+        messages_per_second = pipeline.bucket.rate,
+        max_attempts        = pipeline.max_attempts,
+        invalid_phone       = rejected['invalid_phone'],
+        known_bad_phone     = rejected['known_bad_phone'],
+    )
+
+    schedule = SendSchedule.from_env()
+    dispatcher = Dispatcher() if schedule is not None else None
+    deferred = 0
+
+    def stop_sending() -> None:
+        pipeline.stopping.set()
+        if dispatcher is not None:
+            dispatcher.stop()
+
+    if lease is not None:
+        lease.on_lost(stop_sending)
+
+    totals: Counter[str] = Counter()
+    journal.start_flusher()
+    try:
+        with deadlines.watch('send', on_expire=stop_sending, count=len(unsent)), ptmlog.span('sms_sends'), ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='survey-sender') as executor:
+            # Workers run in a copy of the caller's context so their logs keep the procedure's run_id
+            send_and_record = ptmlog.in_context(pipeline.send_and_record)
+
+            def submit(table_appointment: TableAppointment):
+                return executor.submit(send_and_record, table_appointment)
+
+            if dispatcher is None:
+                futures = [submit(table_appointment) for table_appointment in unsent]
+            else:
+                now = datetime.now(EASTERN_TZ)
+                slots = assign_slots(unsent, schedule, now)
+                for slot, table_appointment in slots:
+                    dispatcher.add(slot, table_appointment)
+                logger.info('scheduled survey sends',
+                    count      = len(slots),
+                    first_slot = slots[0][0] if slots else None,
+                    last_slot  = slots[-1][0] if slots else None,
+                    schedule   = schedule.model_dump(mode='json'),
+                )
+                futures, deferred = dispatcher.run(submit, until=now + timedelta(minutes=schedule.max_wait_minutes))
+                if deferred:
+                    logger.warning('send slots beyond max wait or send deadline, leaving for a later run', deferred=deferred)
+
+            for future in futures:
+                totals.update(future.result())
+    finally:
+        _, uncommitted = journal.close()
+        try:
+            bad_numbers.save()
+        except Exception as e:
+            logger.exception('error saving bad phone numbers', error=str(e))
+        try:
+            mark_cooldown_skipped(pipeline.cooldown_skipped)
+        except Exception as e:
+            logger.exception('error marking cooldown-skipped appointments', count=len(pipeline.cooldown_skipped), error=str(e))
+
+    if totals['deadline_skipped']:
+        logger.warning('send deadline reached, leaving appointments for a later run', deadline_skipped=totals['deadline_skipped'])
+
+    attempted    = len(unsent) - deferred - totals['deadline_skipped']
+    failed_calls = totals[twilio_utils.RETRYABLE] + totals[twilio_utils.THROTTLED] + totals[twilio_utils.PERMANENT] + totals[twilio_utils.UNCERTAIN]
+    result = {
+        'sent'             : totals['sent'],
+        'recorded'         : totals['recorded'],
+        'errors'           : totals['errors'],
+        'retries'          : totals['retries'],
+        'retryable_errors' : totals[twilio_utils.RETRYABLE],
+        'throttled_errors' : totals[twilio_utils.THROTTLED],
+        'permanent_errors' : totals[twilio_utils.PERMANENT],
+        'uncertain_sends'  : totals[twilio_utils.UNCERTAIN],
+        'retries_exhausted': totals['retries_exhausted'],
+        'cooldown_skipped' : totals['cooldown_skipped'],
+        'invalid_phone'    : rejected['invalid_phone'],
+        'known_bad_phone'  : rejected['known_bad_phone'],
+        'wasted_api_calls' : failed_calls,
+        'failed_send_rate' : round(totals['errors'] / attempted, 4) if attempted else 0.0,
+        'final_concurrency': pipeline.concurrency.limit,
+        'skipped_journaled': skipped_journaled,
+        'deferred'         : deferred,
+        'deadline_skipped' : totals['deadline_skipped'],
+        'replayed'         : replayed,
+        'uncommitted'      : uncommitted,
+    }
+    logger.info('send error summary', **result)
+    return result
@@ -0,0 +1,360 @@
+"""
+ASGI service serving the survey form and recording submissions.
+
+The Python counterpart of the `AzureFunction/serve` and `AzureFunction/submit`
+PowerShell functions, with the same routes and pages:
+
+- `GET /api/serve?token=...` (or the legacy `?id=<row key>`) returns the form.
+  A signed token (`survey_token_utils`) is checked without touching storage; a
+  bare row key is checked against a short-TTL cache of appointment states, so
+  repeated opens of the same link cost one table read per
+  `SURVEY_ID_CACHE_SECONDS`.
+- `GET|POST /api/submit` checks the appointment is still pending, then queues
+  the answers (known survey fields only) in a buffered writer that merges them
+  into the appointments table in batches of `SURVEY_SUBMIT_BATCH_SIZE`, or
+  every `SURVEY_SUBMIT_FLUSH_SECONDS`, whichever comes first.
+- `GET /api/health` returns cache and writer counters.
+
+The HTML pages are read once at startup from `SURVEY_TEMPLATES_DIR` (default
+the repository's `AzureFunction` directory). Queued submissions are flushed on
+shutdown; a crash loses at most one flush interval of answers.
+
+Run with:
+    cd src && uvicorn survey_service:app --port 7071
+"""
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Awaitable, Callable
+from urllib.parse import parse_qsl
+import asyncio
+import html
+import json
+import os
+import time
+
+from azure.core.exceptions import ResourceNotFoundError
+
+import appointments_table_utils
+from shared import ptmlog
+from survey_fields import SCORED_FIELDS, TEXT_FIELDS
+from survey_token_utils import InvalidSurveyToken, verify_token
+
+ID_CACHE_SECONDS_DEFAULT      = 60
+ID_CACHE_MAX_ENTRIES          = 50_000
+SUBMIT_BATCH_SIZE_DEFAULT     = 100
+SUBMIT_FLUSH_SECONDS_DEFAULT  = 1.0
+SUBMIT_MAX_ATTEMPTS           = 3
+MAX_BODY_BYTES                = 64 * 1024
+MAX_ANSWER_LENGTH             = 2000
+
+# Appointment states cached by RowStateCache
+PENDING   = 'pending'
+COMPLETED = 'completed'
+MISSING   = 'missing'
+
+SURVEY_ANSWER_FIELDS = set(SCORED_FIELDS) | set(TEXT_FIELDS)
+
+NO_STORE_HEADERS = [
+    (b'cache-control', b'no-store, no-cache, must-revalidate, max-age=0'),
+    (b'pragma', b'no-cache'),
+]
+
+Receive = Callable[[], Awaitable[dict[str, Any]]]
+Send    = Callable[[dict[str, Any]], Awaitable[None]]
+
+
+class Templates:
+    """The service's HTML pages, read once and kept encoded."""
+
+    def __init__(self, form: str, invalid: str, success: str) -> None:
+        # The hidden link field is inserted before </form>, as the PowerShell function does
+        head, separator, tail = form.rpartition('</form>')
+        self.form_head = head.encode()
+        self.form_tail = (separator + tail).encode()
+        self.invalid   = invalid.encode()
+        self.success   = success.encode()
+
+    @classmethod
+    def load(cls, directory: Path | None = None) -> 'Templates':
+        directory = directory or Path(os.getenv('SURVEY_TEMPLATES_DIR', Path(__file__).resolve().parent.parent / 'AzureFunction'))
+        return cls(
+            form    = (directory / 'serve' / 'form.html').read_text(encoding='utf-8'),
+            invalid = (directory / 'serve' / 'invalid.html').read_text(encoding='utf-8'),
+            success = (directory / 'submit' / 'success.html').read_text(encoding='utf-8'),
+        )
+
+    def render_form(self, name: str, value: str) -> bytes:
+        hidden = f"<input type='hidden' name='{name}' value='{html.escape(value, quote=True)}' />"
+        return self.form_head + hidden.encode() + self.form_tail
+
+
+class RowStateCache:
+    """Appointment state (pending, completed or missing) by row key, each entry kept for `ttl` seconds."""
+
+    def __init__(self, ttl: float) -> None:
+        self.ttl     = ttl
+        self.entries : dict[str, tuple[str, float]] = {}
+        self.hits    = 0
+        self.misses  = 0
+
+    @staticmethod
+    def read_state(row_key: str) -> str:
+        entity = appointments_table_utils.get_appointment(row_key)
+        if entity is None:
+            return MISSING
+        return COMPLETED if entity.get('surveyCompletedOn') else PENDING
+
+    async def get(self, row_key: str) -> str:
+        now = time.monotonic()
+        entry = self.entries.get(row_key)
+        if entry is not None and entry[1] > now:
+            self.hits += 1
+            return entry[0]
+
+        self.misses += 1
+        state = await asyncio.to_thread(self.read_state, row_key)
+        current = self.entries.get(row_key)
+        if current is not None and current[0] == COMPLETED:
+            # Submitted by another request while this one was reading
+            return COMPLETED
+        self.set(row_key, state)
+        return state
+
+    def set(self, row_key: str, state: str) -> None:
+        now = time.monotonic()
+        if len(self.entries) >= ID_CACHE_MAX_ENTRIES:
+            self.entries = {key: entry for key, entry in self.entries.items() if entry[1] > now}
+            if len(self.entries) >= ID_CACHE_MAX_ENTRIES:
+                self.entries.clear()
+        self.entries[row_key] = (state, now + self.ttl)
+
+
+class SubmissionWriter:
+    """
+    Buffers survey answers and merges them into the appointments table in batches.
+    A batch that fails is retried row by row; rows that keep failing are logged with
+    their answers and dropped after `SUBMIT_MAX_ATTEMPTS` flushes.
+    """
+
+    def __init__(self, batch_size: int, flush_seconds: float) -> None:
+        self.batch_size    = batch_size
+        self.flush_seconds = flush_seconds
+        self.buffer        : list[tuple[dict[str, Any], int]] = []
+        self.full          = asyncio.Event()
+        self.task          : asyncio.Task | None = None
+        self.stats         = dict(queued=0, written=0, dropped=0, flushes=0)
+
+    def start(self) -> None:
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        while self.buffer:
+            await self.flush()
+
+    def submit(self, update: dict[str, Any]) -> None:
+        self.start()
+        self.buffer.append((update, 0))
+        self.stats['queued'] += 1
+        if len(self.buffer) >= self.batch_size:
+            self.full.set()
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self.full.wait(), timeout=self.flush_seconds)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    async def flush(self) -> None:
+        self.full.clear()
+        if not self.buffer:
+            return
+        batch, self.buffer = self.buffer, []
+        failed = await asyncio.to_thread(self.write, batch)
+        self.stats['flushes'] += 1
+        self.stats['written'] += len(batch) - len(failed)
+        self.buffer.extend(failed)
+
+    def write(self, batch: list[tuple[dict[str, Any], int]]) -> list[tuple[dict[str, Any], int]]:
+        """Write `batch`; returns the rows to try again on the next flush."""
+        logger = ptmlog.get_logger()
+        try:
+            appointments_table_utils.update_appointments([update for update, _ in batch])
+            return []
+        except Exception as e:
+            logger.warning('batched survey write failed, writing rows one by one', count=len(batch), error=str(e))
+
+        failed = []
+        for update, attempts in batch:
+            try:
+                appointments_table_utils.update_appointments([update])
+            except ResourceNotFoundError:
+                logger.error('dropping survey for missing appointment', row_key=update['RowKey'])
+                self.stats['dropped'] += 1
+            except Exception as e:
+                if attempts + 1 >= SUBMIT_MAX_ATTEMPTS:
+                    logger.error('dropping survey after repeated write failures', update=update, error=str(e))
+                    self.stats['dropped'] += 1
+                else:
+                    failed.append((update, attempts + 1))
+        return failed
+
+
+class SurveyService:
+    """The ASGI application."""
+
+    def __init__(self, templates: Templates, states: RowStateCache, writer: SubmissionWriter) -> None:
+        self.templates = templates
+        self.states    = states
+        self.writer    = writer
+        self.routes    = {
+            '/api/serve' : self.serve,
+            '/api/submit': self.submit,
+            '/api/health': self.health,
+        }
+
+    @classmethod
+    def from_env(cls) -> 'SurveyService':
+        return cls(
+            templates = Templates.load(),
+            states    = RowStateCache(ttl=float(os.getenv('SURVEY_ID_CACHE_SECONDS', str(ID_CACHE_SECONDS_DEFAULT)))),
+            writer    = SubmissionWriter(
+                batch_size    = int(os.getenv('SURVEY_SUBMIT_BATCH_SIZE', str(SUBMIT_BATCH_SIZE_DEFAULT))),
+                flush_seconds = float(os.getenv('SURVEY_SUBMIT_FLUSH_SECONDS', str(SUBMIT_FLUSH_SECONDS_DEFAULT))),
+            ),
+        )
+
+    async def __call__(self, scope: dict[str, Any], receive: Receive, send: Send) -> None:
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+
+        handler = self.routes.get(scope['path'])
+        if handler is None:
+            await respond(send, 404, b'Not Found', 'text/plain')
+            return
+        if scope['method'] not in ('GET', 'POST'):
+            await respond(send, 405, b'Method Not Allowed', 'text/plain')
+            return
+
+        params = dict(parse_qsl(scope.get('query_string', b'').decode('latin-1'), keep_blank_values=True))
+        if scope['method'] == 'POST':
+            body = await read_body(receive)
+            if body is None:
+                await respond(send, 413, b'Payload Too Large', 'text/plain')
+                return
+            params.update(parse_qsl(body.decode('utf-8', 'replace'), keep_blank_values=True))
+
+        await handler(params, send)
+
+    async def lifespan(self, receive: Receive, send: Send) -> None:
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.writer.start()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.writer.stop()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def resolve(self, params: dict[str, str]) -> tuple[str, str, str] | None:
+        """
+        (row key, link field, link value) for the request, or None when the link is invalid.
+        Tokens are checked by signature alone; bare ids must be a pending appointment.
+        """
+        logger = ptmlog.get_logger()
+        if token := params.get('token'):
+            try:
+                return verify_token(token).row_key, 'token', token
+            except InvalidSurveyToken as e:
+                logger.info('invalid survey token', reason=e.reason)
+                return None
+        if row_key := params.get('id'):
+            if await self.states.get(row_key) == PENDING:
+                return row_key, 'id', row_key
+        return None
+
+    async def serve(self, params: dict[str, str], send: Send) -> None:
+        resolved = await self.resolve(params)
+        if resolved is None:
+            await respond(send, 200, self.templates.invalid, 'text/html', NO_STORE_HEADERS)
+            return
+        _, field, value = resolved
+        await respond(send, 200, self.templates.render_form(field, value), 'text/html', NO_STORE_HEADERS)
+
+    async def submit(self, params: dict[str, str], send: Send) -> None:
+        logger = ptmlog.get_logger()
+        resolved = await self.resolve(params)
+        # Token links are only checked against the table here, at submit time
+        if resolved is None or await self.states.get(resolved[0]) != PENDING:
+            await respond(send, 200, self.templates.invalid, 'text/html', NO_STORE_HEADERS)
+            return
+        row_key = resolved[0]
+
+        answers = {
+            field: value[:MAX_ANSWER_LENGTH]
+            for field, value in params.items()
+            if field in SURVEY_ANSWER_FIELDS
+        }
+        self.states.set(row_key, COMPLETED)
+        self.writer.submit(dict(
+            PartitionKey      = row_key[-1],
+            RowKey            = row_key,
+            surveyCompletedOn = datetime.now(timezone.utc),
+            **answers,
+        ))
+        logger.info('survey submitted', row_key=row_key, answers=len(answers))
+        await respond(send, 200, self.templates.success, 'text/html')
+
+    async def health(self, params: dict[str, str], send: Send) -> None:
+        body = json.dumps(dict(
+            id_cache_entries = len(self.states.entries),
+            id_cache_hits    = self.states.hits,
+            id_cache_misses  = self.states.misses,
+            pending_writes   = len(self.writer.buffer),
+            **self.writer.stats,
+        ))
+        await respond(send, 200, body.encode(), 'application/json')
+
+
+async def read_body(receive: Receive) -> bytes | None:
+    """Request body, or None if it is larger than MAX_BODY_BYTES."""
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size > MAX_BODY_BYTES:
+            return None
+        chunks.append(chunk)
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+
+async def respond(send: Send, status: int, body: bytes, content_type: str, headers: list[tuple[bytes, bytes]] | None = None) -> None:
+    await send({
+        'type'   : 'http.response.start',
+        'status' : status,
+        'headers': [
+            (b'content-type', f'{content_type}; charset=utf-8'.encode()),
+            (b'content-length', str(len(body)).encode()),
+            *(headers or []),
+        ],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+app = SurveyService.from_env()
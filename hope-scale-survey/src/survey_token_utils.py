@@ -0,0 +1,114 @@
+"""
+Signed, expiring survey tokens.
+
+The survey link carries `token=<row key>.<issued>.<signature>` instead of the
+bare row key: `issued` is the send time in Unix seconds (base 36) and the
+signature is a truncated HMAC-SHA256 of the first two parts under
+`SURVEY_TOKEN_SECRET`. The serve endpoint can check a token and render the form
+with CPU work only; the appointments table is read when the survey is
+submitted.
+
+`SURVEY_TOKEN_SECRET` may hold several comma-separated secrets: the first signs
+new tokens and all of them verify, so a secret can be rotated without breaking
+links already sent.
+"""
+from datetime import datetime, timedelta, timezone
+import base64
+import hashlib
+import hmac
+import os
+import re
+
+from pydantic import BaseModel
+
+TOKEN_TTL_DAYS_DEFAULT = 30
+
+# 128 bits of the HMAC-SHA256 digest keeps the SMS link short
+SIGNATURE_BYTES = 16
+
+ROW_KEY_PATTERN = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$')
+
+
+class InvalidSurveyToken(ValueError):
+    def __init__(self, reason: str) -> None:
+        super().__init__(reason)
+        self.reason = reason
+
+
+class SurveyToken(BaseModel):
+    row_key   : str
+    issued_on : datetime
+
+    @property
+    def partition_key(self) -> str:
+        return self.row_key[-1]
+
+
+def get_secrets() -> list[bytes]:
+    """Configured signing secrets, newest first; empty when tokens are disabled."""
+    return [secret.strip().encode() for secret in os.getenv('SURVEY_TOKEN_SECRET', '').split(',') if secret.strip()]
+
+
+def get_token_ttl() -> timedelta:
+    return timedelta(days=float(os.getenv('SURVEY_TOKEN_TTL_DAYS', str(TOKEN_TTL_DAYS_DEFAULT))))
+
+
+def _sign(secret: bytes, message: str) -> str:
+    digest = hmac.new(secret, message.encode(), hashlib.sha256).digest()[:SIGNATURE_BYTES]
+    return base64.urlsafe_b64encode(digest).rstrip(b'=').decode()
+
+
+def _to_base36(number: int) -> str:
+    digits = '0123456789abcdefghijklmnopqrstuvwxyz'
+    encoded = ''
+    while True:
+        number, remainder = divmod(number, 36)
+        encoded = digits[remainder] + encoded
+        if not number:
+            return encoded
+
+
+def issue_token(row_key: str, issued_on: datetime | None = None, secret: bytes | None = None) -> str:
+    """Token for the survey of appointment `row_key`, sent at `issued_on` (default now)."""
+    if secret is None:
+        secrets = get_secrets()
+        if not secrets:
+            raise RuntimeError('SURVEY_TOKEN_SECRET is not set')
+        secret = secrets[0]
+    issued_on = issued_on or datetime.now(timezone.utc)
+
+    message = f'{row_key}.{_to_base36(int(issued_on.timestamp()))}'
+    return f'{message}.{_sign(secret, message)}'
+
+
+def verify_token(
+    token   : str,
+    now     : datetime | None = None,
+    secrets : list[bytes] | None = None,
+    ttl     : timedelta | None = None,
+) -> SurveyToken:
+    """
+    Check the signature and age of `token` and return what it carries.
+    Raises InvalidSurveyToken with reason 'malformed', 'bad_signature' or 'expired'.
+    """
+    secrets = get_secrets() if secrets is None else secrets
+    ttl     = get_token_ttl() if ttl is None else ttl
+    now     = now or datetime.now(timezone.utc)
+
+    parts = (token or '').split('.')
+    if len(parts) != 3 or not ROW_KEY_PATTERN.match(parts[0]):
+        raise InvalidSurveyToken('malformed')
+    row_key, issued, signature = parts
+    try:
+        issued_on = datetime.fromtimestamp(int(issued, 36), timezone.utc)
+    except (ValueError, OverflowError, OSError):
+        raise InvalidSurveyToken('malformed')
+
+    message = f'{row_key}.{issued}'
+    if not any(hmac.compare_digest(_sign(secret, message), signature) for secret in secrets):
+        raise InvalidSurveyToken('bad_signature')
+    # A little allowance for clock skew between the sender and the serve host
+    if issued_on > now + timedelta(minutes=5) or now - issued_on > ttl:
+        raise InvalidSurveyToken('expired')
+
+    return SurveyToken(row_key=row_key, issued_on=issued_on)
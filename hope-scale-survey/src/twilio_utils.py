@@ -1,22 +1,111 @@
-from twilio.rest import Client
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from functools import cache
 import os
+import threading
+
+from pydantic import BaseModel
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectTimeout, ConnectionError as RequestsConnectionError, Timeout as RequestsTimeout
+from twilio.base.exceptions import TwilioRestException
+from twilio.http.http_client import TwilioHttpClient
+from twilio.http.response import Response
+from twilio.rest import Client
+from urllib3.exceptions import NewConnectionError
+
+import survey_token_utils
 from shared import ptmlog
 
+# Concurrent sends allowed per process; also sizes the HTTP connection pool
+SEND_WORKERS_DEFAULT = 4
+
+# Send error classes
+RETRYABLE = 'retryable'  # transient; safe to send again in this run
+THROTTLED = 'throttled'  # rate limited; retry after backing off and lowering concurrency
+PERMANENT = 'permanent'  # will fail again (bad number, opted out, auth)
+UNCERTAIN = 'uncertain'  # the request may have reached Twilio; never resent until reconciled
+
+# Twilio error codes for rate limiting that are not always returned with HTTP 429
+THROTTLED_ERROR_CODES = {20429, 14107}
+
+TWILIO_API_ORIGIN = 'https://api.twilio.com'
+
+
+class TwilioSettings(BaseModel):
+    account_sid  : str
+    auth_token   : str
+    campaign_sid : str
+    survey_link  : str
+
+
+@cache
+def get_settings() -> TwilioSettings:
+    """Twilio configuration, read from the environment once per process."""
+    return TwilioSettings(
+        account_sid  = os.environ['TWILIO_ACCOUNT_SID'],
+        auth_token   = os.environ['TWILIO_AUTH_TOKEN'],
+        campaign_sid = os.environ['TWILIO_CAMPAIGN_SID'],
+        survey_link  = os.environ['TWILIO_SURVEY_LINK'],
+    )
+
+
+def get_send_workers() -> int:
+    return max(1, int(os.getenv('TWILIO_SEND_WORKERS', str(SEND_WORKERS_DEFAULT))))
+
+
+class RecordingHttpClient(TwilioHttpClient):
+    """
+    TwilioHttpClient that remembers the last response of each thread. A
+    TwilioRestException does not carry response headers, so this is how a
+    worker reads Retry-After for the request that just failed.
+
+    With `base_url`, requests meant for api.twilio.com are sent there instead
+    (e.g. to the local emulator in `mock/twilio.py`).
+    """
+
+    def __init__(self, *args, base_url: str | None = None, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.base_url     = base_url.rstrip('/') if base_url else None
+        self.thread_local = threading.local()
+
+    def request(self, method: str, url: str, *args, **kwargs) -> Response:
+        if self.base_url and url.startswith(TWILIO_API_ORIGIN):
+            url = self.base_url + url[len(TWILIO_API_ORIGIN):]
+        self.thread_local.last_response = None
+        response = super().request(method, url, *args, **kwargs)
+        self.thread_local.last_response = response
+        return response
+
+    def last_response(self) -> Response | None:
+        return getattr(self.thread_local, 'last_response', None)
+
+
+@cache
+def get_client() -> Client:
+    """
+    One Twilio client per process. Its keep-alive session is shared by all send
+    workers, with a connection pool large enough that no worker waits for a socket.
+    """
+    settings = get_settings()
+    http_client = RecordingHttpClient(pool_connections=True, timeout=30, base_url=os.getenv('TWILIO_BASE_URL'))
+    for prefix in ('https://', 'http://'):
+        http_client.session.mount(prefix, HTTPAdapter(pool_connections=1, pool_maxsize=get_send_workers()))
+    return Client(settings.account_sid, settings.auth_token, http_client=http_client)
+
+
 def send_survey(id: str, patient_name: str, patient_phone: str) -> str:
     """
     Send a survey to the patient using Twilio.
     Returns the message SID.
     """
     logger = ptmlog.get_logger()
+    settings = get_settings()
 
-    TWILIO_ACCOUNT_SID  = os.environ['TWILIO_ACCOUNT_SID']
-    TWILIO_AUTH_TOKEN   = os.environ['TWILIO_AUTH_TOKEN']
-    TWILIO_CAMPAIGN_SID = os.environ['TWILIO_CAMPAIGN_SID']
-    TWILIO_SURVEY_LINK  = os.environ['TWILIO_SURVEY_LINK']
-
-    client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
-
-    link = f'{TWILIO_SURVEY_LINK}&id={id}'
+    # Signed links let the serve endpoint skip the table read; without a secret the bare row key is sent
+    if survey_token_utils.get_secrets():
+        link = f'{settings.survey_link}&token={survey_token_utils.issue_token(id)}'
+    else:
+        link = f'{settings.survey_link}&id={id}'
     message_body = (
         f"Hi {patient_name.title()}, thank you for visiting us! "
         f"We hope your recent appointment today was helpful. "
@@ -24,8 +113,8 @@ def send_survey(id: str, patient_name: str, patient_phone: str) -> str:
         f"Your input helps us improve our services. Tap {link} to start. Thank you!"
     )
 
-    message = client.messages.create(
-        messaging_service_sid=TWILIO_CAMPAIGN_SID,
+    message = get_client().messages.create(
+        messaging_service_sid=settings.campaign_sid,
         to=patient_phone,
         body=message_body,
     )
@@ -36,3 +125,37 @@ def send_survey(id: str, patient_name: str, patient_phone: str) -> str:
         raise Exception('message sent is missing sid')
 
     return message.sid
+
+
+def classify_error(error: Exception) -> str:
+    """Classify a send failure as RETRYABLE, THROTTLED, PERMANENT or UNCERTAIN."""
+    if isinstance(error, TwilioRestException):
+        if error.status == 429 or error.code in THROTTLED_ERROR_CODES:
+            return THROTTLED
+        if error.status >= 500:
+            return RETRYABLE
+        return PERMANENT
+    # A connection that was never made is retried. A read timeout or a connection
+    # dropped once the request was out is not: Twilio may already have accepted the
+    # message, and sending again would text the patient twice.
+    if isinstance(error, ConnectTimeout) or isinstance(getattr(error.args[0] if error.args else None, 'reason', None), NewConnectionError):
+        return RETRYABLE
+    if isinstance(error, (RequestsConnectionError, RequestsTimeout)):
+        return UNCERTAIN
+    return PERMANENT
+
+
+def retry_after_seconds() -> float | None:
+    """Retry-After of the calling thread's last Twilio response, in seconds, if it sent one."""
+    response = get_client().http_client.last_response()
+    value = response.headers.get('Retry-After') if response is not None and response.headers else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,28 @@
+from datetime import date, datetime
+
+import pytest
+from azure.core.exceptions import ResourceExistsError
+
+
+def test_archived_appointment_is_not_recreated(monkeypatch):
+    monkeypatch.setenv('STORAGE_BACKEND', 'memory')
+    monkeypatch.setenv('RUN_HISTORY', '0')
+    import appointments_table_utils
+    import archive_appointments
+    monkeypatch.setattr(archive_appointments, '_cutoff_loaded', False)
+    monkeypatch.setattr(archive_appointments, '_archived_row_keys', {})
+
+    appointment = dict(
+        patient_name       = 'PATIENT ONE',
+        patient_dob        = date(1980, 5, 17),
+        patient_phone      = '+12485550217',
+        appointment_time   = datetime(2020, 3, 4, 9, 30),
+        appointment_status = 'Seen',
+        provider           = 'ES OAKLAND',
+        type               = 'CLINICIAN',
+    )
+    appointments_table_utils.create_new_appointment(**appointment)
+    assert archive_appointments.archive_appointments(max_age_days=180)['deleted'] == 1
+
+    with pytest.raises(ResourceExistsError):
+        appointments_table_utils.create_new_appointment(**appointment)
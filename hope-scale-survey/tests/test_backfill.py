@@ -0,0 +1,50 @@
+from datetime import date, datetime
+
+import pytest
+
+from backfill_plan import BackfillPlan, FETCHED, PENDING, SYNCED
+from models import PracticeFusionAppointment
+
+
+@pytest.fixture
+def backfill(monkeypatch, tmp_path):
+    monkeypatch.setenv('STORAGE_BACKEND', 'memory')
+    monkeypatch.setenv('KNOWN_ROW_KEYS_PATH', str(tmp_path / 'known_row_keys.json'))
+    monkeypatch.setenv('BACKFILL_STATE_PATH', str(tmp_path / 'backfill_state.json'))
+    monkeypatch.setenv('RUN_HISTORY', '0')
+    import backfill
+    return backfill
+
+
+def test_resume_writes_fetched_chunk_before_scraping_pending(backfill, monkeypatch):
+    plan = BackfillPlan.create(date(2025, 1, 6), date(2025, 1, 9), chunk_days=2)
+    appointment = PracticeFusionAppointment(
+        patient_name       = 'PATIENT ONE',
+        patient_dob        = date(1980, 5, 17),
+        patient_phone      = '(248) 555-0217',
+        appointment_time   = datetime(2025, 1, 6, 9, 30),
+        appointment_status = 'Seen',
+        provider           = 'ES OAKLAND',
+        type               = 'CLINICIAN',
+    )
+    plan.set_status(plan.chunks[0], FETCHED, attempts=1, appointments=[appointment.model_dump(mode='json')])
+    plan = BackfillPlan.load(plan.path)
+
+    scraped = {}
+
+    async def get_schedule_pages_chunked(chunks, workers, on_chunk, on_failure):
+        scraped.update(chunks)
+        for index in chunks:
+            await on_chunk(index, [])
+
+    monkeypatch.setattr(backfill.practice_fusion_utils, 'get_schedule_pages_chunked', get_schedule_pages_chunked)
+    monkeypatch.setattr(backfill.practice_fusion_utils, 'parse_schedule_pages', lambda schedule_pages: [])
+
+    result = backfill.backfill_sync_appointments(plan)
+
+    assert result['created'] == 1
+    assert result['chunks_remaining'] == 0
+    assert list(scraped) == [1]
+    assert [chunk['status'] for chunk in plan.chunks] == [SYNCED, SYNCED]
+    assert 'appointments' not in plan.chunks[0]
+    assert not BackfillPlan.load(plan.path).chunks_with(PENDING, FETCHED)
@@ -0,0 +1,26 @@
+from datetime import datetime, timedelta, timezone
+
+from contact_index import ContactIndex
+
+
+def test_claim_lets_resend_of_last_survey_through_cooldown():
+    now = datetime.now(timezone.utc)
+    contacts = ContactIndex(timedelta(days=7), {'+12485550217': now - timedelta(days=1)}, {'+12485550217': 'row-1'})
+
+    assert not contacts.claim('+12485550217', now, 'row-2')
+    assert contacts.claim('+12485550217', now, 'row-1')
+    assert not contacts.claim('+12485550217', now, 'row-1')
+
+
+def test_journal_commit_writes_contact_row(monkeypatch, tmp_path):
+    monkeypatch.setenv('STORAGE_BACKEND', 'memory')
+    from send_journal import SendJournal
+
+    journal = SendJournal.open(tmp_path / 'send_journal.jsonl')
+    journal.record_uncertain('row-1', '2025-01', '+12485550217', datetime.now(timezone.utc))
+    journal.commit_pending()
+    journal.close()
+
+    contacts = ContactIndex.load(timedelta(days=7))
+    assert not contacts.claim('+12485550217', datetime.now(timezone.utc), 'row-2')
+    assert contacts.claim('+12485550217', datetime.now(timezone.utc), 'row-1')
@@ -0,0 +1,40 @@
+from datetime import datetime, timezone
+
+
+def survey(row_key, provider, appointment_time, completed_on):
+    return {
+        'PartitionKey'     : row_key[-1],
+        'RowKey'           : row_key,
+        'provider'         : provider,
+        'appointmentTime'  : appointment_time,
+        'surveyCompletedOn': completed_on,
+    }
+
+
+def test_update_reads_providers_without_watermark_from_archive(monkeypatch):
+    monkeypatch.setenv('STORAGE_BACKEND', 'memory')
+    monkeypatch.setenv('RUN_HISTORY', '0')
+    import storage_backends
+    storage_backends.reset_stores()
+    import archive_appointments
+    import hope_scale_rollups
+
+    # ES OAKLAND already has rollups and a watermark; CNS only has an archived survey
+    storage_backends.get_table_store('appointments').upsert_entity(
+        survey('row-1', 'ES OAKLAND', '2025-03-03T09:00', datetime(2025, 3, 4, tzinfo=timezone.utc)),
+    )
+    archive_appointments.write_archive_month('2024-01', {
+        'row-2': survey('row-2', 'CNS', '2024-01-08T09:00', datetime(2024, 1, 9, tzinfo=timezone.utc)),
+    })
+    hope_scale_rollups.write_provider('ES OAKLAND', {}, datetime(2025, 3, 1, tzinfo=timezone.utc))
+
+    hope_scale_rollups.update_rollups()
+
+    rollups = storage_backends.get_table_store(hope_scale_rollups.TABLE_NAME)
+    assert rollups.get_entity('CNS', '2024-01-08')['surveys'] == 1
+    assert rollups.get_entity('ES OAKLAND', '2025-03-03')['surveys'] == 1
+    assert hope_scale_rollups.read_global_watermark() == datetime(2025, 3, 4, tzinfo=timezone.utc)
+
+    # Nothing new: the next update reads from the global watermark and folds nothing in
+    assert hope_scale_rollups.update_rollups()['surveys_folded'] == 0
+    storage_backends.reset_stores()
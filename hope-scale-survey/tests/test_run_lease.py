@@ -0,0 +1,37 @@
+import time
+
+import pytest
+
+from shared import ptmlog
+
+
+@pytest.fixture
+def run_lease(monkeypatch):
+    monkeypatch.setenv('STORAGE_BACKEND', 'memory')
+    import run_lease
+    monkeypatch.setattr(run_lease, 'RENEW_SECONDS', 0.05)
+    monkeypatch.setattr(run_lease, '_renewer', None)
+    yield run_lease
+    run_lease.release_all()
+
+
+def test_lost_lease_is_counted_in_the_holders_run(run_lease):
+    from storage_backends import get_blob_store
+    runs = []
+    ptmlog.add_run_listener(runs.append)
+
+    @ptmlog.procedure('test_run_lease')
+    def hold_until_lost() -> list[int]:
+        lost = []
+        lease = run_lease.acquire('send')
+        lease.on_lost(lambda: lost.append(1))
+        # Another run takes the lease over
+        get_blob_store().release_lease(run_lease.CONTAINER_NAME, 'send', lease.lease_id)
+        get_blob_store().acquire_lease(run_lease.CONTAINER_NAME, 'send', run_lease.LEASE_SECONDS)
+        deadline = time.monotonic() + 2
+        while not lease.lost.is_set() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return lost
+
+    assert hold_until_lost() == [1]
+    assert runs[-1]['metrics'] == {'leases_lost': 1}
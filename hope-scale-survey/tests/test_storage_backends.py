@@ -0,0 +1,35 @@
+from datetime import datetime, timezone
+
+import pytest
+
+import storage_backends
+
+CASES = [
+    ([('sentOn', 'gt', datetime(2020, 1, 1, tzinfo=timezone.utc))], {'datetime'}),
+    ([('sentOn', 'eq', '')],                                         {'empty'}),
+    ([('sentOn', 'ne', '')],                                         {'datetime', 'text'}),
+    ([('sentOn', 'ge', '')],                                         {'empty', 'text'}),
+    ([('n', 'gt', 6)],                                               {'empty'}),
+    ([('n', 'lt', '8')],                                             {'datetime'}),
+    ([('n', 'in', [7, '7'])],                                        {'empty', 'datetime'}),
+]
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def table_store(request, monkeypatch, tmp_path):
+    monkeypatch.setenv('STORAGE_BACKEND', request.param)
+    monkeypatch.setenv('STORAGE_SQLITE_PATH', str(tmp_path / 'storage.sqlite3'))
+    storage_backends.reset_stores()
+    table_store = storage_backends.get_table_store('appointments')
+    table_store.submit_batch([
+        ('create', {'PartitionKey': 'p', 'RowKey': 'empty',    'sentOn': '',                                        'n': 7}),
+        ('create', {'PartitionKey': 'p', 'RowKey': 'datetime', 'sentOn': datetime(2025, 1, 1, tzinfo=timezone.utc), 'n': '7'}),
+        ('create', {'PartitionKey': 'p', 'RowKey': 'text',     'sentOn': 'x',                                       'n': 5.5}),
+    ])
+    yield table_store
+    storage_backends.reset_stores()
+
+
+@pytest.mark.parametrize('filters, expected', CASES)
+def test_query_compares_only_same_types(table_store, filters, expected):
+    assert {entity['RowKey'] for entity in table_store.query_entities(filters)} == expected
@@ -0,0 +1,16 @@
+from http.client import RemoteDisconnected
+
+from requests.exceptions import ConnectTimeout, ConnectionError, ReadTimeout
+from urllib3.exceptions import MaxRetryError, NewConnectionError, ProtocolError
+
+import twilio_utils
+
+
+def test_classify_error_separates_unsent_from_uncertain_connection_failures():
+    refused = ConnectionError(MaxRetryError(None, '/Messages.json', NewConnectionError(None, 'connection refused')))
+    dropped = ConnectionError(ProtocolError('Connection aborted.', RemoteDisconnected()))
+
+    assert twilio_utils.classify_error(ConnectTimeout()) == twilio_utils.RETRYABLE
+    assert twilio_utils.classify_error(refused) == twilio_utils.RETRYABLE
+    assert twilio_utils.classify_error(ReadTimeout()) == twilio_utils.UNCERTAIN
+    assert twilio_utils.classify_error(dropped) == twilio_utils.UNCERTAIN